@@ -0,0 +1,68 @@
+"""Benchmark the continuous-run detector against the list based original.
+
+Run with ``python benchmarks/bench_continuous.py``.
+"""
+
+import timeit
+import warnings
+
+import numpy as np
+from scipy.stats import mode
+
+from rio_alpha.utils import _compute_continuous
+
+
+def legacy_compute_continuous(rgb_mod, loc):
+    """The rio-alpha 1.0 implementation of _compute_continuous."""
+    diff_array = np.diff(rgb_mod, axis=int(loc))
+    diff_array = np.insert(diff_array, 0, [99, 99, 99], axis=int(loc))
+    lst = (rgb_mod[diff_array == [0, 0, 0]]).tolist()
+    arr = np.asarray(list(zip(*[lst[i::3] for i in range(3)])))
+    mode_vals = mode(arr)
+    continuous = [int((mode_vals[0])[0, i]) for i in range(3)]
+    return continuous, arr
+
+
+def collared_image(size, collar=0.15, seed=0):
+    """Returns a noisy (size, size, 3) uint8 image with a white collar."""
+    rng = np.random.RandomState(seed)
+    img = rng.randint(0, 250, (size, size, 3)).astype(np.uint8)
+    # Smooth areas produce the short runs real imagery has
+    img[size // 3 : size // 2] = 120
+    edge = int(size * collar)
+    img[:edge] = 255
+    img[:, :edge] = 255
+    return img
+
+
+def main(sizes=(200, 500, 1000, 2000), repeat=5):
+    """Print the best time of each implementation per image size."""
+    # scipy.stats.mode warns about its keepdims default on every call
+    warnings.simplefilter("ignore", FutureWarning)
+    print(
+        "{:>6} {:>12} {:>12} {:>8}".format(
+            "size", "legacy (ms)", "runs (ms)", "speedup"
+        )
+    )
+    for size in sizes:
+        img = collared_image(size)
+        number = max(1, 200 // size)
+        legacy = min(
+            timeit.repeat(
+                lambda: legacy_compute_continuous(img, 1), number=number, repeat=repeat
+            )
+        )
+        runs = min(
+            timeit.repeat(
+                lambda: _compute_continuous(img, 1), number=number, repeat=repeat
+            )
+        )
+        print(
+            "{:>6} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+                size, 1e3 * legacy / number, 1e3 * runs / number, legacy / runs
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Benchmark the masking and discovery kernels on synthetic images.
+
+Each kernel runs on uint8 and uint16 images of several sizes and three
+nodata layouts: a collar, scattered holes with lossy compression
+artefacts around them, and no nodata at all. The best time and the
+peak allocation traced by tracemalloc are reported per case.
+
+Run with ``python benchmarks/bench_kernels.py``. ``--save base.json``
+stores the results as a baseline, and ``--compare base.json`` exits
+with status 1 if a case got slower or allocates more than the baseline
+allows. Comparisons time each case at least COMPARE_REPEAT times, so
+that noise isn't reported as a regression. Baselines are only
+comparable on the same machine.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+import tracemalloc
+
+import numpy as np
+
+from rio_alpha.alpha_mask import mask_exact
+from rio_alpha.findnodata import discover_ndv
+from rio_alpha.islossy import count_ndv_regions
+from rio_alpha.utils import _find_continuous_rgb, _search_image_edge
+
+DTYPES = ("uint8", "uint16")
+LAYOUTS = ("collar", "holes", "none")
+SIZES = (256, 1024, 2048)
+# Fewer repeats make a self-compare flag the fastest cases as slower
+COMPARE_REPEAT = 20
+
+
+def synthetic_image(size, dtype, layout, seed=0):
+    """Returns a noisy (size, size, 3) image and its nodata value.
+
+    The nodata value is 0. Valid pixels are never 0, except the lossy
+    artefacts of the "holes" layout which have one band at 0.
+    """
+    rng = np.random.RandomState(seed)
+    top = 250 if dtype == "uint8" else 4000
+    img = rng.randint(1, top, (size, size, 3)).astype(dtype)
+    # Smooth areas produce the short runs real imagery has
+    img[size // 3 : size // 2] = top // 2
+
+    if layout == "collar":
+        edge = int(size * 0.15)
+        img[:edge] = 0
+        img[:, :edge] = 0
+        img[-edge:, -edge // 2 :] = 0
+    elif layout == "holes":
+        for row, col in rng.randint(0, size - 8, (size // 4, 2)):
+            img[row : row + 8, col : col + 8] = 0
+            # Ringing around the hole, off by one band
+            img[row + 8 : row + 10, col : col + 8, 0] = 0
+    elif layout != "none":
+        raise ValueError("Unknown nodata layout {!r}".format(layout))
+
+    return img, [0, 0, 0]
+
+
+def _mask_exact(img, ndv):
+    bands = np.ascontiguousarray(img.transpose(2, 0, 1))
+    return lambda: mask_exact(bands, ndv)
+
+
+def _discover_ndv(img, ndv):
+    return lambda: discover_ndv(img, False, False)
+
+
+def _find_continuous(img, ndv):
+    return lambda: _find_continuous_rgb(img, 1)
+
+
+def _search_edge(img, ndv):
+    return lambda: _search_image_edge(img, ndv, [1, 1, 1])
+
+
+def _count_regions(img, ndv):
+    bands = np.ascontiguousarray(img.transpose(2, 0, 1))
+    return lambda: count_ndv_regions(bands, ndv)
+
+
+# Each kernel takes the image and its nodata value and returns the call
+# to time, with whatever input preparation it needs done beforehand
+KERNELS = {
+    "mask_exact": _mask_exact,
+    "discover_ndv": _discover_ndv,
+    "_find_continuous_rgb": _find_continuous,
+    "_search_image_edge": _search_edge,
+    "count_ndv_regions": _count_regions,
+}
+
+
+def measure(call, repeat=5, min_time=0.02):
+    """Returns the best time per call in seconds and the peak bytes
+    allocated by one call."""
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    once = timeit.timeit(call, number=1)
+    number = max(1, int(min_time / max(once, 1e-9)))
+    best = min(timeit.repeat(call, number=number, repeat=repeat)) / number
+    return best, peak
+
+
+def run(kernels=None, dtypes=DTYPES, sizes=SIZES, layouts=LAYOUTS, repeat=5):
+    """Returns a results dict of each case, keyed kernel/dtype/size/layout."""
+    results = {}
+    for dtype in dtypes:
+        for size in sizes:
+            for layout in layouts:
+                img, ndv = synthetic_image(size, dtype, layout)
+                for name in kernels or KERNELS:
+                    seconds, peak = measure(KERNELS[name](img, ndv), repeat=repeat)
+                    key = "/".join((name, dtype, str(size), layout))
+                    results[key] = {"seconds": seconds, "peak_bytes": peak}
+                    print(
+                        "{:<50} {:>10.3f} ms {:>10.1f} KiB".format(
+                            key, 1e3 * seconds, peak / 1024.0
+                        )
+                    )
+    return results
+
+
+def compare(baseline, results, time_tolerance=0.25, memory_tolerance=0.1):
+    """Returns the keys of the cases that regressed against baseline.
+
+    A case regressed if its time grew by more than time_tolerance or its
+    peak allocation by more than memory_tolerance, as fractions of the
+    baseline. Cases missing from either side are ignored.
+    """
+    regressed = []
+    for key in sorted(set(baseline) & set(results)):
+        old, new = baseline[key], results[key]
+        slower = new["seconds"] > old["seconds"] * (1 + time_tolerance)
+        larger = new["peak_bytes"] > old["peak_bytes"] * (1 + memory_tolerance)
+        if slower or larger:
+            regressed.append(key)
+            print(
+                "REGRESSION {:<50} {:>6.2f}x time {:>6.2f}x memory".format(
+                    key,
+                    new["seconds"] / old["seconds"],
+                    new["peak_bytes"] / max(old["peak_bytes"], 1),
+                )
+            )
+    return regressed
+
+
+def main(argv=None):
+    """Runs the selected cases and saves or compares their results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--kernel", action="append", choices=sorted(KERNELS))
+    parser.add_argument("--dtype", action="append", choices=DTYPES)
+    parser.add_argument("--size", action="append", type=int)
+    parser.add_argument("--layout", action="append", choices=LAYOUTS)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        help="timing repeats per case "
+        "(default: 5, at least {} with --compare)".format(COMPARE_REPEAT),
+    )
+    parser.add_argument("--save", metavar="JSON", help="write a baseline")
+    parser.add_argument("--compare", metavar="JSON", help="compare to a baseline")
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--memory-tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    repeat = args.repeat or 5
+    if args.compare:
+        repeat = max(repeat, COMPARE_REPEAT)
+    results = run(
+        kernels=args.kernel,
+        dtypes=args.dtype or DTYPES,
+        sizes=args.size or SIZES,
+        layouts=args.layout or LAYOUTS,
+        repeat=repeat,
+    )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressed = compare(
+            baseline, results, args.time_tolerance, args.memory_tolerance
+        )
+        if regressed:
+            print("{} of {} cases regressed".format(len(regressed), len(results)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""Benchmark the packed uint8 masking kernel against the band kernel.
+
+The speedup is the packed kernel's against the band kernel on planar
+bands, the layout windows are read in. Run with
+``python benchmarks/bench_mask.py``.
+"""
+
+import timeit
+
+import numpy as np
+
+from rio_alpha.alpha_mask import mask_exact
+
+
+def interleaved_window(size, bands, seed=0):
+    """Returns a (bands, size, size) view of a (size, size, 4) uint8 buffer."""
+    rng = np.random.RandomState(seed)
+    buf = rng.randint(0, 4, (size, size, 4)).astype(np.uint8)
+    return buf.transpose(2, 0, 1)[:bands]
+
+
+def main(size=4096, repeat=5):
+    """Print the best time of each kernel on interleaved and planar windows."""
+    out = np.empty((size, size), dtype=np.uint8)
+    print(
+        "{:>5} {:>14} {:>16} {:>13} {:>9}".format(
+            "bands", "planar (ms)", "interleaved (ms)", "packed (ms)", "vs planar"
+        )
+    )
+    for bands in (3, 4):
+        img = interleaved_window(size, bands)
+        planar = np.ascontiguousarray(img)
+        ndv = [0] * bands
+        assert np.array_equal(
+            mask_exact(img, ndv, kernel="bands"), mask_exact(img, ndv, kernel="packed")
+        )
+
+        def best(arr, kernel):
+            return min(
+                timeit.repeat(
+                    lambda: mask_exact(arr, ndv, out=out, kernel=kernel),
+                    number=1,
+                    repeat=repeat,
+                )
+            )
+
+        planar_time = best(planar, "bands")
+        bands_time = best(img, "bands")
+        packed_time = best(img, "packed")
+        print(
+            "{:>5} {:>14.2f} {:>16.2f} {:>13.2f} {:>8.2f}x".format(
+                bands,
+                1e3 * planar_time,
+                1e3 * bands_time,
+                1e3 * packed_time,
+                planar_time / packed_time,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""Run rio alpha, findnodata and islossy end to end on large rasters.
+
+A tiled GeoTIFF of the requested size, dtype and compression is
+generated block row by block row, with a nodata collar and optionally
+the near-nodata artefacts lossy compression leaves around it. Each
+command then runs in a child process, once per worker count for
+``rio alpha``, and its wall time, peak RSS, bytes read and written and
+throughput are recorded.
+
+Run with ``python benchmarks/scale.py --width 32768 --height 32768``.
+``--report run.json`` writes the results, and ``--compare run.json``
+prints the ratios of this run to an earlier report and exits with
+status 1 if a command got slower or used more memory than the
+tolerances allow. Bytes read and written are only measured on Linux.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+
+def generate(
+    path,
+    width,
+    height,
+    dtype="uint8",
+    compress="deflate",
+    collar=0.1,
+    artefacts=False,
+    blocksize=512,
+    seed=0,
+):
+    """Writes a synthetic tiled RGB GeoTIFF with a nodata collar of 0
+
+    Valid pixels are smooth gradients with a little noise, so that
+    both deflate and JPEG compress them like imagery. Only one row of
+    blocks is held in memory at a time.
+
+    Parameters
+    ----------
+    path: string
+    width: integer
+    height: integer
+    dtype: string
+    compress: string, "deflate" or "jpeg"
+    collar: float
+        width of the collar as a fraction of each dimension. The collar
+        is a skewed frame, like the one around a reprojected scene.
+    artefacts: boolean
+        scatter near-nodata pixels along the collar's edge and inside
+        it, as lossy compression does
+    blocksize: integer
+    seed: integer
+    """
+    rng = np.random.RandomState(seed)
+    top = np.iinfo(dtype).max
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 3,
+        "dtype": dtype,
+        "crs": "EPSG:3857",
+        "transform": from_origin(-(width // 2), height // 2, 1, 1),
+        "tiled": True,
+        "blockxsize": blocksize,
+        "blockysize": blocksize,
+        "compress": compress,
+        "BIGTIFF": "IF_SAFER",
+    }
+    if compress == "jpeg":
+        profile["photometric"] = "YCBCR"
+
+    edge = int(collar * min(width, height))
+    cols = np.arange(width)
+    with rasterio.open(path, "w", **profile) as dst:
+        for row in range(0, height, blocksize):
+            rows = min(blocksize, height - row)
+            y = np.arange(row, row + rows)[:, np.newaxis]
+            data = np.empty((3, rows, width), dtype=dtype)
+            for band in range(3):
+                gradient = (cols * (band + 1) + y * (3 - band)) % (top // 2)
+                noise = rng.randint(0, 8, (rows, width))
+                data[band] = top // 4 + gradient + noise
+
+            # The collar's inner edge moves by one pixel every 8 rows
+            left = edge + y // 8 % max(edge, 1)
+            right = width - edge + y // 8 % max(edge, 1)
+            nodata = (cols < left) | (cols >= right) | (y < edge) | (y >= height - edge)
+            data[:, nodata] = 0
+
+            if artefacts and edge:
+                ring = ~nodata & ((cols < left + 3) | (cols >= right - 3))
+                near = ring | (nodata & (rng.randint(0, 500, nodata.shape) == 0))
+                data[0, near] = rng.randint(1, 4, int(near.sum()))
+
+            dst.write(data, window=Window(0, row, width, rows))
+
+
+def _io_counters():
+    """Returns this process's rchar and wchar, None off Linux
+
+    Linux adds the I/O of children to their parent once they are
+    reaped, so the difference around a wait is the child's.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None
+    return int(fields["rchar"]), int(fields["wchar"])
+
+
+def measure(args):
+    """Runs a command and returns its wall time, peak RSS and I/O
+
+    Peak RSS covers the command and the worker processes it reaped.
+    Bytes read and written are those of all read and write calls,
+    including the ones loading Python modules at startup.
+
+    Parameters
+    ----------
+    args: list of strings
+
+    Returns
+    -------
+    dict
+    """
+    before = _io_counters()
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=err)
+        # Read the output before reaping, and reap with wait4 for the rusage
+        with proc.stdout:
+            out = proc.stdout.read()
+        _, status, usage = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+        after = _io_counters()
+        # Like Popen, a negative return code is the signal that killed it
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        err.seek(0)
+        err = err.read()
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "returncode": proc.returncode,
+        "seconds": seconds,
+        "max_rss_bytes": usage.ru_maxrss * scale,
+        "read_bytes": after[0] - before[0] if before else None,
+        "written_bytes": after[1] - before[1] if before else None,
+        "output": out.decode().strip(),
+        "error": err.decode().strip()[-2000:],
+    }
+
+
+def run(src_path, tmpdir, workers=(1, 2, 4), rio="rio", ndv="0"):
+    """Returns the measurements of each command on src_path"""
+    with rasterio.open(src_path) as src:
+        megapixels = src.width * src.height / 1e6
+    size = os.path.getsize(src_path)
+
+    commands = [
+        ("findnodata", 1, [rio, "findnodata", src_path, "--discovery", "--no-cache"]),
+        ("islossy", 1, [rio, "islossy", src_path, "--ndv", ndv]),
+    ]
+    for n in workers:
+        dst_path = os.path.join(tmpdir, "alpha-%d.tif" % n)
+        commands.append(
+            (
+                "alpha",
+                n,
+                [rio, "alpha", src_path, dst_path, "--ndv", ndv, "-j", str(n)]
+                + ["--co", "tiled=true", "--co", "compress=deflate"],
+            )
+        )
+
+    results = []
+    for name, n, args in commands:
+        result = measure(args)
+        result.update(
+            command=name,
+            workers=n,
+            megapixels_per_second=megapixels / result["seconds"],
+            source_bytes_per_second=size / result["seconds"],
+        )
+        results.append(result)
+        print(
+            "{:<10} {:>3} workers {:>9.2f} s {:>9.1f} MiB rss {:>9.1f} Mpx/s".format(
+                name,
+                n,
+                result["seconds"],
+                result["max_rss_bytes"] / 1024.0**2,
+                result["megapixels_per_second"],
+            )
+        )
+        if result["returncode"]:
+            print(result["error"], file=sys.stderr)
+        if name == "alpha" and os.path.exists(args[3]):
+            os.remove(args[3])
+    return results
+
+
+def compare(baseline, results, time_tolerance=0.25, memory_tolerance=0.1):
+    """Returns the (command, workers) runs that regressed against baseline.
+
+    Runs are matched by command and worker count, and missing ones are
+    ignored. Tolerances are fractions of the baseline.
+    """
+    old_runs = {(r["command"], r["workers"]): r for r in baseline}
+    regressed = []
+    for new in results:
+        key = (new["command"], new["workers"])
+        old = old_runs.get(key)
+        if old is None:
+            continue
+        time_ratio = new["seconds"] / old["seconds"]
+        rss_ratio = new["max_rss_bytes"] / max(old["max_rss_bytes"], 1)
+        flag = ""
+        if time_ratio > 1 + time_tolerance or rss_ratio > 1 + memory_tolerance:
+            regressed.append(key)
+            flag = "REGRESSION"
+        print(
+            "{:<10} {:>3} workers {:>6.2f}x time {:>6.2f}x rss {}".format(
+                key[0], key[1], time_ratio, rss_ratio, flag
+            )
+        )
+    return regressed
+
+
+def main(argv=None):
+    """Generates or opens a raster, runs the commands and reports them"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=16384)
+    parser.add_argument("--height", type=int, default=16384)
+    parser.add_argument("--dtype", choices=("uint8", "uint16"), default="uint8")
+    parser.add_argument("--compress", choices=("deflate", "jpeg"), default="deflate")
+    parser.add_argument("--collar", type=float, default=0.1)
+    parser.add_argument("--artefacts", action="store_true")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--src", help="use this raster instead of generating one")
+    parser.add_argument("--rio", default=shutil.which("rio") or "rio")
+    parser.add_argument("--tmpdir", help="where the rasters are written")
+    parser.add_argument("--report", metavar="JSON", help="write the results")
+    parser.add_argument("--compare", metavar="JSON", help="compare to a report")
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--memory-tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.compress == "jpeg" and args.dtype != "uint8":
+        parser.error("JPEG compression requires --dtype uint8")
+
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+    try:
+        src_path = args.src
+        if src_path is None:
+            src_path = os.path.join(tmpdir, "src.tif")
+            start = time.perf_counter()
+            generate(
+                src_path,
+                args.width,
+                args.height,
+                dtype=args.dtype,
+                compress=args.compress,
+                collar=args.collar,
+                artefacts=args.artefacts,
+            )
+            print(
+                "Generated {} ({:.1f} MiB) in {:.1f} s".format(
+                    src_path,
+                    os.path.getsize(src_path) / 1024.0**2,
+                    time.perf_counter() - start,
+                )
+            )
+        results = run(src_path, tmpdir, workers=args.workers, rio=args.rio)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.report:
+        params = vars(args).copy()
+        for name in ("report", "compare", "tmpdir", "rio"):
+            del params[name]
+        with open(args.report, "w") as f:
+            json.dump(
+                {
+                    "params": params,
+                    "python": platform.python_version(),
+                    "gdal": rasterio.__gdal_version__,
+                    "machine": platform.machine(),
+                    "cpus": os.cpu_count(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+
+    failed = [r for r in results if r["returncode"]]
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(baseline, results, args.time_tolerance, args.memory_tolerance):
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,69 @@
 """Alpha masking worker and concurrent processor."""
 
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+from math import gcd
+from multiprocessing import Pool
+import os
+from queue import Queue
+import threading
+import time
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
 import numpy as np
 import rasterio
+from rasterio.io import MemoryFile
+from rasterio.windows import Window
 import riomucho
-from rio_alpha.alpha_mask import mask_exact
+from riomucho.single_process_pool import MockTub
+
+from rio_alpha.alpha_mask import _opaque_value, mask_exact, mask_fuzzy
+from rio_alpha.filters import _check_filter, apply_filters, filter_halo
+from rio_alpha.stats import _timed
+from rio_alpha.utils import _parse_ndv
+
+MASK_MODES = ("band", "internal", "sidecar")
+
+_buffers = threading.local()
+
+
+def _window_buffer(name, shape, dtype):
+    """Returns this worker's buffer for windows of a shape
+
+    Buffers of the last few shapes are kept, so that the ragged
+    windows along the right and bottom edges don't force
+    reallocations.
+    """
+    cache = getattr(_buffers, name, None)
+    if cache is None:
+        cache = OrderedDict()
+        setattr(_buffers, name, cache)
+
+    key = (shape, np.dtype(dtype).str)
+    buf = cache.pop(key, None)
+    if buf is None:
+        buf = np.empty(shape, dtype=dtype)
+        if len(cache) >= 4:
+            cache.popitem(last=False)
+    cache[key] = buf
+    return buf
 
 
 def alpha_worker(open_file, window, ij, g_args):
     """rio mucho worker for alpha. It reads input
     files and perform alpha calculations on each window.
 
+    The returned arrays are views of a buffer owned by the worker,
+    which it reuses for the next window of the same shape. Write or
+    copy them before calling the worker again.
+
     Parameters
     ------------
     open_files: list of rasterio open files
@@ -17,6 +71,7 @@ def alpha_worker(open_file, window, ij, g_args):
             A window is a view onto a rectangular subset of a
             raster dataset.
     g_args: dictionary
+            "ndv" and optionally "mask_mode", one of MASK_MODES
 
     Returns
     ---------
@@ -24,38 +79,770 @@ def alpha_worker(open_file, window, ij, g_args):
           ndarray with original RGB bands of shape (3, rows, cols)
           and a mask of shape (rows, cols) where
           opaque == 0 and transparent == max of dtype
+    (rgb, mask): tuple of ndarrays
+          if mask_mode is not "band", the RGB bands of shape
+          (3, rows, cols) and a uint8 mask of shape (rows, cols)
+          where nodata == 0 and valid == 255
     """
-    src = open_file[0]
+    return _worker_window(open_file[0], window, g_args)
 
-    arr = src.read(window=window)
 
-    # Determine Alpha Band
-    if g_args["ndv"]:
-        # User-supplied nodata value
-        alpha = mask_exact(arr, g_args["ndv"])
+def _worker_window(src, window, g_args, timings=None):
+    """alpha_worker on a dataset, appending stage timings if not None"""
+    _check_bands(src)
+
+    # Bands are read straight into a reused planar buffer with room for
+    # the alpha, which is written as is, without another copy
+    shape = (4, int(window.height), int(window.width))
+    rgba = _window_buffer("rgba", shape, src.dtypes[0])
+    mask = _window_buffer("mask", shape[1:], np.uint8)
+    return _alpha_window(src, window, g_args, rgba, mask, timings)
+
+
+def _alpha_worker_timings(open_file, window, ij, g_args):
+    """alpha_worker, also returning the stage timings of the window"""
+    timings = []
+    return _worker_window(open_file[0], window, g_args, timings), timings
+
+
+def _timings(g_args):
+    """Returns a list for a window's stage timings, None if not wanted"""
+    return [] if g_args.get("stats") else None
+
+
+def _check_bands(src):
+    if src.count not in (3, 4):
+        raise ValueError("Array must have 3 or 4 bands (RGB or RGBA)")
+
+
+def _new_buffers(window, dtype):
+    """Returns new (rgba, mask) buffers for _alpha_window"""
+    shape = (int(window.height), int(window.width))
+    rgba = np.empty((4,) + shape, dtype=dtype)
+    return rgba, np.empty(shape, dtype=np.uint8)
+
+
+def _alpha_result(rgba, mask, mask_mode):
+    """Returns the alpha_worker result held by a window's buffers
+
+    rgba is a (4, rows, cols) array of the dataset's dtype, mask a
+    (rows, cols) uint8 array that only holds the alpha in the mask
+    modes for data other than uint8. Returns the result and its alpha.
+    """
+    if mask_mode == "band":
+        # replace or add band 4 with new alpha mask
+        # (likely the same but let's not make that assumption)
+        return rgba, rgba[3]
+    elif rgba.dtype == np.uint8:
+        return (rgba[:3], rgba[3]), rgba[3]
     else:
+        return (rgba[:3], mask), mask
+
+
+def _alpha_window(src, window, g_args, rgba, mask, timings=None):
+    """Reads a window into the given buffers and computes its alpha
+
+    Returns the results of alpha_worker as views of the buffers. The
+    read and mask stage timings are appended to timings if not None.
+    """
+    result, alpha = _alpha_result(rgba, mask, g_args.get("mask_mode", "band"))
+    arr = rgba[: src.count]
+    nbytes = arr.nbytes + (0 if g_args["ndv"] else alpha.nbytes)
+    halo = _timed(
+        timings, "read", nbytes, _read_bands, src, window, g_args, rgba, alpha
+    )
+    _timed(timings, "mask", arr.nbytes, _mask_bands, g_args, arr, alpha, halo)
+    return result
+
+
+def _read_bands(src, window, g_args, rgba, alpha):
+    """Reads a window's bands, and its dataset mask if there's no ndv
+
+    With filters, the window is read along with the halo they need,
+    and the (bands, mask, pad) _mask_bands filters are returned, see
+    _read_halo. Returns None otherwise.
+    """
+    if g_args.get("filters"):
+        return _read_halo(src, window, g_args, rgba)
+    src.read(out=rgba[: src.count], window=window)
+    if not g_args["ndv"]:
         # Let rasterio decide
-        alpha = src.dataset_mask(window=window)
+        alpha[...] = src.dataset_mask(window=window)
 
-    # Replace or Add alpha band to input data
-    if arr.shape[0] == 4:
-        # replace band 4 with new alpha mask
-        # (likely the same but let's not make that assumption)
-        rgba = arr.copy()
-        rgba[3] = alpha
-    elif arr.shape[0] == 3:
-        # stack the alpha mask to add band 4
-        rgba = np.append(arr, alpha[np.newaxis, :, :], axis=0)
+
+def _halo_window(src, window, halo):
+    """Returns a window grown by halo pixels on each side
+
+    The window is clipped to the dataset, and returned with the
+    ((top, bottom), (left, right)) padding that restores the clipped
+    part of the halo.
+    """
+    row, col = int(window.row_off), int(window.col_off)
+    bottom, right = row + int(window.height), col + int(window.width)
+    top, left = max(row - halo, 0), max(col - halo, 0)
+    height, width = min(bottom + halo, src.height), min(right + halo, src.width)
+    pad = (
+        (halo - (row - top), halo - (height - bottom)),
+        (halo - (col - left), halo - (width - right)),
+    )
+    return Window(left, top, width - left, height - top), pad
+
+
+def _read_halo(src, window, g_args, rgba):
+    """Reads a window and the halo of its filters
+
+    The window's bands are copied into rgba. Returns the bands of the
+    grown window, its dataset mask if there's no ndv (None otherwise)
+    and its padding, see _halo_window.
+    """
+    halo = filter_halo(g_args["filters"])
+    grown, pad = _halo_window(src, window, halo)
+    bands = src.read(window=grown)
+    row, col = halo - pad[0][0], halo - pad[1][0]
+    rows, cols = rgba.shape[1:]
+    rgba[: src.count] = bands[:, row : row + rows, col : col + cols]
+    mask = None if g_args["ndv"] else src.dataset_mask(window=grown)
+    return bands, mask, pad
+
+
+def _mask_halo(g_args, alpha, bands, mask, pad):
+    """Computes the filtered alpha of a window read by _read_halo
+
+    The halo clipped at the edges of the dataset is padded with the
+    nearest pixels, so windows along the edges are filtered like the
+    ones inside, and the halo is cropped off once filtered.
+    """
+    if g_args["ndv"]:
+        mask = np.empty(bands.shape[1:], dtype=np.uint8)
+        if g_args.get("tolerance"):
+            mask_fuzzy(bands, g_args["ndv"], g_args["tolerance"], out=mask)
+        else:
+            mask_exact(bands, g_args["ndv"], out=mask)
+        opaque = _opaque_value(alpha.dtype)
     else:
-        raise ValueError("Array must have 3 or 4 bands (RGB or RGBA)")
+        opaque = 255
+
+    valid = apply_filters(np.pad(mask != 0, pad, mode="edge"), g_args["filters"])
+    halo = filter_halo(g_args["filters"])
+    rows, cols = alpha.shape
+    core = valid[halo : halo + rows, halo : halo + cols]
+    np.multiply(core, alpha.dtype.type(opaque), out=alpha)
 
-    return rgba
+
+def _mask_bands(g_args, arr, alpha, halo=None):
+    """Computes the alpha of bands read by _read_bands
+
+    halo is what _read_bands returned.
+    """
+    if halo is not None:
+        _mask_halo(g_args, alpha, *halo)
+    elif g_args["ndv"]:
+        # User-supplied nodata value
+        if g_args.get("tolerance"):
+            mask_fuzzy(arr, g_args["ndv"], g_args["tolerance"], out=alpha)
+        else:
+            mask_exact(arr, g_args["ndv"], out=alpha)
 
 
 _alpha_worker = alpha_worker
 
 
-def add_alpha(src_path, dst_path, ndv, creation_options, processes):
+def _write_window(dst, result, window, mask_mode):
+    """Writes an alpha_worker result to the destination dataset"""
+    if mask_mode == "band":
+        dst.write(result, window=window)
+    else:
+        data, mask = result
+        dst.write(data, window=window)
+        dst.write_mask(mask, window=window)
+
+
+def _result_nbytes(result):
+    """Returns the bytes of an alpha_worker result"""
+    if isinstance(result, tuple):
+        return sum(arr.nbytes for arr in result)
+    return result.nbytes
+
+
+def _in_order(submit, windows, limit):
+    """Submits windows ahead of their consumer
+
+    Yields (window, submit(window)) pairs in window order, keeping at
+    most limit of them submitted but not yet consumed. A window is only
+    submitted when the consumer asks for the next pair, so whatever it
+    releases before that can be reused by the new submission.
+    """
+    pending = deque()
+    windows = iter(windows)
+    while True:
+        for window in islice(windows, limit - len(pending)):
+            pending.append((window, submit(window)))
+        if not pending:
+            return
+        yield pending.popleft()
+
+
+def _serial_windows(src_path, g_args, workers, windows, write, in_flight):
+    """Runs alpha_worker over windows in this thread"""
+    with rasterio.open(src_path) as src:
+        for window in windows:
+            timings = _timings(g_args)
+            write(_worker_window(src, window, g_args, timings), window, timings)
+
+
+def _process_windows(src_path, g_args, workers, windows, write, in_flight):
+    """Maps alpha_worker over windows with a pool of processes
+
+    Results are sent back through a shared memory ring where available,
+    and pickled by a rio-mucho pool otherwise.
+    """
+    if workers > 1 and shared_memory is not None:
+        return _ring_windows(src_path, g_args, workers, windows, write, in_flight)
+
+    if workers == 1:
+        pool = MockTub(riomucho.init_worker, ([src_path], g_args))
+        imap = pool.imap_unordered  # MockTub runs in order
+    else:
+        pool = Pool(workers, riomucho.init_worker, ([src_path], g_args))
+        imap = pool.imap
+
+    worker = _alpha_worker_timings if g_args.get("stats") else _alpha_worker
+    try:
+        for result, window in imap(
+            riomucho.manual_reader(worker),
+            [(window, None) for window in windows],
+        ):
+            timings = None
+            if worker is _alpha_worker_timings:
+                result, timings = result
+            write(result, window, timings)
+    finally:
+        pool.close()
+        pool.join()
+
+
+_ring = {}
+
+
+def _slot_buffers(buf, offset, window, dtype):
+    """Returns the (rgba, mask) buffers of a window in a ring slot"""
+    shape = (int(window.height), int(window.width))
+    rgba = np.ndarray((4,) + shape, dtype=dtype, buffer=buf, offset=offset)
+    offset += rgba.nbytes
+    mask = np.ndarray(shape, dtype=np.uint8, buffer=buf, offset=offset)
+    return rgba, mask
+
+
+def _slot_size(window, dtype):
+    """Returns the bytes of a ring slot for a window, 64 byte aligned"""
+    pixels = int(window.height) * int(window.width)
+    size = pixels * (4 * np.dtype(dtype).itemsize + 1)
+    return -(-size // 64) * 64
+
+
+def _init_ring_worker(name, slot_size):
+    """Attaches the ring in a worker process"""
+    _ring.update(
+        shm=shared_memory.SharedMemory(name=name),
+        slot_size=slot_size,
+        datasets=OrderedDict(),
+    )
+
+
+def _ring_dataset(src_path):
+    """Returns this worker's handle on a source, keeping the last 4 open"""
+    datasets = _ring["datasets"]
+    src = datasets.pop(src_path, None)
+    if src is None:
+        src = rasterio.open(src_path)
+        if len(datasets) >= 4:
+            datasets.popitem(last=False)[1].close()
+    datasets[src_path] = src
+    return src
+
+
+def _ring_worker(slot, src_path, window, g_args):
+    """Computes a window of a source into a ring slot
+
+    Returns the window's stage timings if g_args asks for them.
+    """
+    src = _ring_dataset(src_path)
+    _check_bands(src)
+    buffers = _slot_buffers(
+        _ring["shm"].buf, slot * _ring["slot_size"], window, src.dtypes[0]
+    )
+    timings = _timings(g_args)
+    _alpha_window(src, window, g_args, *buffers, timings)
+    return timings
+
+
+@contextmanager
+def _ring_pool(workers, slots, slot_size):
+    """Starts ring workers attached to a new shared memory block"""
+    shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+    try:
+        pool = Pool(workers, _init_ring_worker, (shm.name, slot_size))
+        try:
+            yield pool, shm
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            # An error traceback still references a result; the mapping
+            # is released along with it
+            pass
+
+
+def _ring_windows(src_path, g_args, workers, windows, write, in_flight):
+    """Maps _alpha_window over windows with a pool of processes
+
+    Workers compute windows straight into the in_flight slots of a
+    shared memory ring, and only slot numbers and windows are sent
+    between processes. A slot is reused once its window has been
+    written, so workers wait whenever the writer falls behind.
+    """
+    with rasterio.open(src_path) as src:
+        _check_bands(src)
+        dtype = src.dtypes[0]
+
+    mask_mode = g_args.get("mask_mode", "band")
+    windows = list(windows)
+    slots = in_flight
+    slot_size = max([_slot_size(window, dtype) for window in windows] or [64])
+    free = list(range(slots))
+
+    with _ring_pool(workers, slots, slot_size) as (pool, shm):
+
+        def submit(window):
+            slot = free.pop()
+            args = (slot, src_path, window, g_args)
+            return slot, pool.apply_async(_ring_worker, args)
+
+        for window, (slot, task) in _in_order(submit, windows, slots):
+            timings = task.get()
+            rgba, mask = _slot_buffers(shm.buf, slot * slot_size, window, dtype)
+            write(_alpha_result(rgba, mask, mask_mode)[0], window, timings)
+            del rgba, mask
+            free.append(slot)
+
+
+def _thread_windows(src_path, g_args, workers, windows, write, in_flight):
+    """Maps _alpha_window over windows with a pool of threads
+
+    Each thread opens its own handle on the source. At most in_flight
+    windows are computed ahead of the writer, and their buffers are
+    reused once written.
+    """
+    local = threading.local()
+    lock = threading.Lock()
+    handles = []
+    free = {}
+
+    def work(window):
+        src = getattr(local, "src", None)
+        if src is None:
+            src = local.src = rasterio.open(src_path)
+            with lock:
+                handles.append(src)
+        _check_bands(src)
+
+        key = (int(window.height), int(window.width))
+        with lock:
+            spare = free.get(key)
+            buffers = spare.pop() if spare else None
+        if buffers is None:
+            buffers = _new_buffers(window, src.dtypes[0])
+        timings = _timings(g_args)
+        return _alpha_window(src, window, g_args, *buffers, timings), buffers, timings
+
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            for window, future in _in_order(
+                lambda window: executor.submit(work, window), windows, in_flight
+            ):
+                result, buffers, timings = future.result()
+                write(result, window, timings)
+                with lock:
+                    free.setdefault(buffers[1].shape, []).append(buffers)
+    finally:
+        for src in handles:
+            src.close()
+
+
+def _pipeline_windows(src_path, g_args, workers, windows, write, in_flight):
+    """Runs a reader, compute workers and this thread as the writer
+
+    A reader thread reads windows ahead into a ring of in_flight window
+    sized slots, worker threads compute their alpha and this thread
+    writes them in window order, handing each slot back to the reader.
+    The stages are connected by queues, so that reading, masking and
+    writing overlap even with a single worker.
+    """
+    with rasterio.open(src_path) as src:
+        _check_bands(src)
+        dtype = src.dtypes[0]
+        count = src.count
+
+    mask_mode = g_args.get("mask_mode", "band")
+    windows = list(windows)
+    slot_size = max([_slot_size(window, dtype) for window in windows] or [64])
+    ring = np.empty((in_flight, slot_size), dtype=np.uint8)
+
+    free = Queue()
+    for slot in range(in_flight):
+        free.put(slot)
+    read = Queue()
+    done = Queue()
+    stop = threading.Event()
+
+    def arrays(slot, window):
+        rgba, mask = _slot_buffers(ring[slot], 0, window, dtype)
+        result, alpha = _alpha_result(rgba, mask, mask_mode)
+        return rgba, result, alpha
+
+    def reader():
+        try:
+            with rasterio.open(src_path) as src:
+                for index, window in enumerate(windows):
+                    slot = free.get()
+                    if stop.is_set():
+                        return
+                    rgba, _, alpha = arrays(slot, window)
+                    timings = _timings(g_args)
+                    nbytes = rgba[:count].nbytes + (
+                        0 if g_args["ndv"] else alpha.nbytes
+                    )
+                    halo = _timed(
+                        timings,
+                        "read",
+                        nbytes,
+                        _read_bands,
+                        src,
+                        window,
+                        g_args,
+                        rgba,
+                        alpha,
+                    )
+                    read.put((index, window, slot, timings, halo))
+        except Exception as exc:
+            done.put((None, exc))
+        finally:
+            for _ in range(workers):
+                read.put(None)
+
+    def compute():
+        for index, window, slot, timings, halo in iter(read.get, None):
+            try:
+                if not stop.is_set():
+                    rgba, _, alpha = arrays(slot, window)
+                    arr = rgba[:count]
+                    _timed(
+                        timings,
+                        "mask",
+                        arr.nbytes,
+                        _mask_bands,
+                        g_args,
+                        arr,
+                        alpha,
+                        halo,
+                    )
+            except Exception as exc:
+                done.put((None, exc))
+            else:
+                done.put((index, (window, slot, timings)))
+
+    threads = [threading.Thread(target=reader)]
+    threads += [threading.Thread(target=compute) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        ready = {}
+        for index in range(len(windows)):
+            while index not in ready:
+                key, value = done.get()
+                if key is None:
+                    raise value
+                ready[key] = value
+            window, slot, timings = ready.pop(index)
+            write(arrays(slot, window)[1], window, timings)
+            free.put(slot)
+    finally:
+        stop.set()
+        free.put(None)
+        for thread in threads:
+            thread.join()
+
+
+ENGINES = OrderedDict(
+    [
+        ("processes", _process_windows),
+        ("threads", _thread_windows),
+        ("pipeline", _pipeline_windows),
+        ("serial", _serial_windows),
+    ]
+)
+
+
+def _run_windows(
+    src_path, g_args, workers, windows, write, engine="processes", in_flight=None
+):
+    """Maps alpha_worker over windows with an execution engine
+
+    write(result, window) is called in this thread, in window order, so
+    that every engine writes the same bytes. The result arrays are only
+    valid until write returns. in_flight caps the number of windows held
+    in memory by the threads, pipeline and shared memory engines.
+
+    If g_args["stats"] is true, write(result, window, timings) gets the
+    read and mask timings of the window as a list of (stage, seconds,
+    nbytes, worker) tuples.
+    """
+    in_flight = _in_flight(workers, in_flight)
+    if not g_args.get("stats"):
+        write = partial(_without_timings, write)
+    ENGINES[engine](src_path, g_args, workers, windows, write, in_flight)
+
+
+def _without_timings(write, result, window, timings):
+    write(result, window)
+
+
+def _in_flight(workers, in_flight=None):
+    """Defaults in_flight to 2 windows per worker, plus one being written"""
+    if in_flight is None:
+        return 2 * workers + 1
+    return in_flight
+
+
+def _windows_held(engine, workers, in_flight=None):
+    """Returns the number of windows an engine holds in memory at once"""
+    if engine == "serial" or (engine == "processes" and workers == 1):
+        return 1
+    return _in_flight(workers, in_flight)
+
+
+def _pixel_bytes(dtype, held, workers):
+    """Returns the memory used per pixel of the largest window
+
+    Each window held has a planar RGBA buffer and a uint8 mask, and
+    each worker has up to 6 bytes of scratch per pixel for mask_exact
+    or dataset_mask.
+    """
+    return held * (4 * np.dtype(dtype).itemsize + 1) + 6 * workers
+
+
+# Memory budget of add_alpha_many, and the most a window of blocks
+# aligned to the source and the destination takes without a budget
+BATCH_MEMORY = 256 * 1024**2
+
+
+def _min_memory(dtype, engine, workers, in_flight=None):
+    """Returns the smallest max_memory add_alpha can plan windows in"""
+    return _pixel_bytes(dtype, _windows_held(engine, workers, in_flight), workers)
+
+
+def _lcm(a, b):
+    return a * b // gcd(a, b)
+
+
+def _fit_window(alignments, height, width, max_pixels):
+    """Returns the largest aligned (rows, cols) of at most max_pixels
+
+    The coarsest alignment whose unit fits the budget is used. Units
+    are merged into full width bands when one row of units fits,
+    across a band of units otherwise.
+    """
+    for rows, cols in alignments:
+        if rows * cols <= max_pixels:
+            break
+
+    if rows * width <= max_pixels:
+        return min(height, rows * (max_pixels // (rows * width))), width
+    else:
+        return rows, min(width, cols * max(1, max_pixels // (rows * cols)))
+
+
+def plan_windows(src, dst_block_shape=None, max_memory=None, held=1, workers=1):
+    """Plans the windows add_alpha processes
+
+    Windows are aligned to the blocks of both the source and the
+    destination, so that no block is decoded or encoded twice. Without
+    a memory budget each window is one such aligned unit, or a source
+    block if the unit takes more than BATCH_MEMORY, otherwise units are
+    merged up to the budget. Windows are ordered block by
+    block of the source, so that a source block split between windows
+    stays in the GDAL block cache until all of them are read.
+
+    Parameters
+    ----------
+    src: rasterio dataset opened in "r" mode
+    dst_block_shape: tuple, optional
+        (rows, cols) of the destination's blocks, defaults to the source's
+    max_memory: integer, optional
+        memory budget in bytes of the windows held at once
+    held: integer
+        number of windows held in memory at once
+    workers: integer
+
+    Returns
+    -------
+    list of Window objects
+
+    Raises
+    ------
+    ValueError
+        if max_memory can't hold a single pixel
+    """
+    height, width = src.height, src.width
+    src_rows, src_cols = src.block_shapes[0]
+    dst_rows, dst_cols = dst_block_shape or src.block_shapes[0]
+
+    alignments = [
+        (_lcm(src_rows, dst_rows), _lcm(src_cols, dst_cols)),
+        (src_rows, src_cols),
+        (dst_rows, dst_cols),
+        (1, 1),
+    ]
+    alignments = [(min(rows, height), min(cols, width)) for rows, cols in alignments]
+
+    pixel_bytes = _pixel_bytes(src.dtypes[0], held, workers)
+    if max_memory is None:
+        rows, cols = alignments[0]
+        if rows * cols * pixel_bytes > BATCH_MEMORY:
+            rows, cols = alignments[1]
+    else:
+        max_pixels = max_memory // pixel_bytes
+        if max_pixels < 1:
+            raise ValueError(
+                "max_memory of {} bytes can't hold a pixel of {} bytes".format(
+                    max_memory, pixel_bytes
+                )
+            )
+        rows, cols = _fit_window(alignments, height, width, max_pixels)
+
+    windows = [
+        Window(col, row, min(cols, width - col), min(rows, height - row))
+        for row in range(0, height, rows)
+        for col in range(0, width, cols)
+    ]
+    windows.sort(
+        key=lambda w: (w.row_off // src_rows, w.col_off // src_cols, w.row_off)
+    )
+    return windows
+
+
+def estimate_memory(windows, dtype, held=1, workers=1):
+    """Estimates the peak memory in bytes of the buffers for windows"""
+    pixels = max([int(w.height) * int(w.width) for w in windows] or [0])
+    return pixels * _pixel_bytes(dtype, held, workers)
+
+
+def _dst_profile(src, creation_options, mask_mode):
+    """Returns the profile of add_alpha's output"""
+    dst_profile = src.profile
+
+    dst_profile.update(**creation_options)
+
+    dst_profile.pop("photometric", None)
+
+    if mask_mode == "band":
+        dst_profile.update(count=4, nodata=None)
+    else:
+        dst_profile.update(count=3, nodata=None)
+
+    return dst_profile
+
+
+def _check_options(
+    mask_mode, engine, in_flight, max_memory, tolerance=None, filters=None
+):
+    if mask_mode not in MASK_MODES:
+        raise ValueError(
+            "mask_mode must be one of {}, not {!r}".format(MASK_MODES, mask_mode)
+        )
+    if engine not in ENGINES:
+        raise ValueError(
+            "engine must be one of {}, not {!r}".format(tuple(ENGINES), engine)
+        )
+    if in_flight is not None and in_flight < 1:
+        raise ValueError("in_flight must be at least 1, not {!r}".format(in_flight))
+    if max_memory is not None and max_memory < 1:
+        raise ValueError("max_memory must be positive, not {!r}".format(max_memory))
+    if tolerance is not None and not tolerance >= 0:
+        raise ValueError("tolerance must not be negative, not {!r}".format(tolerance))
+    for name, size in filters or []:
+        _check_filter(name, size)
+
+
+def plan_alpha(
+    src_path,
+    creation_options,
+    processes,
+    mask_mode="band",
+    engine="processes",
+    in_flight=None,
+    max_memory=None,
+):
+    """Returns the windows add_alpha would process, without running it
+
+    Takes the arguments of add_alpha that shape its plan.
+
+    Returns
+    ---------
+    plan: dict
+        "src_block_shape" and "dst_block_shape", "held" the number of
+        windows held in memory at once, "windows" a list of
+        [col_off, row_off, width, height] lists in processing order,
+        and "peak_memory" the estimated peak memory of their buffers
+        in bytes
+    """
+    _check_options(mask_mode, engine, in_flight, max_memory)
+
+    with rasterio.open(src_path) as src:
+        dst_profile = _dst_profile(src, creation_options, mask_mode)
+        if dst_profile["driver"] == "GTiff":
+            dst_profile["sparse_ok"] = True
+        with MemoryFile() as memfile:
+            with memfile.open(**dst_profile) as dst:
+                dst_block_shape = dst.block_shapes[0]
+
+        held = _windows_held(engine, processes, in_flight)
+        windows = plan_windows(src, dst_block_shape, max_memory, held, processes)
+
+        return {
+            "src_block_shape": list(src.block_shapes[0]),
+            "dst_block_shape": list(dst_block_shape),
+            "held": held,
+            "windows": [
+                [int(w.col_off), int(w.row_off), int(w.width), int(w.height)]
+                for w in windows
+            ],
+            "peak_memory": estimate_memory(windows, src.dtypes[0], held, processes),
+        }
+
+
+def add_alpha(
+    src_path,
+    dst_path,
+    ndv,
+    creation_options,
+    processes,
+    mask_mode="band",
+    engine="processes",
+    in_flight=None,
+    max_memory=None,
+    on_window=None,
+    stats=None,
+    tolerance=None,
+    filters=None,
+):
     """
     Parameters
     ------------
@@ -66,6 +853,40 @@ def add_alpha(src_path, dst_path, ndv, creation_options, processes):
          length of the list = band count
     creation_options: dict
     processes: integer
+         number of workers
+    mask_mode: string
+         "band" (default) writes the mask as a 4th band, "internal"
+         as a 1-bit GDAL mask inside the output and "sidecar" as a
+         1-bit GDAL mask in an external .msk file
+    engine: string
+         "processes" (default) runs a rio-mucho pool of processes
+         workers, "threads" a pool of threads sharing this process,
+         "serial" reads and masks windows in this thread and
+         "pipeline" runs a reader thread, processes workers threads
+         and a writer concurrently. All engines write identical outputs.
+    in_flight: integer, optional
+         maximum number of windows held in memory by the threads,
+         pipeline and (shared memory) processes engines. Defaults to
+         2 per worker plus 1.
+    max_memory: integer, optional
+         memory budget in bytes for the windows held in memory. Block
+         aligned windows are merged up to it, see plan_windows.
+    on_window: callable, optional
+         called with the (3, rows, cols) RGB bands as read, the (rows,
+         cols) alpha array and the window of each window once written,
+         in plan_windows order. Windows above and to the left of a
+         window are always written before it.
+    stats: StageStats, optional
+         records the read, mask and write durations and bytes of each
+         window, see rio_alpha.stats.
+    tolerance: number, optional
+         also mask pixels whose bands are all within tolerance of ndv,
+         like lossy compression leaves around nodata. See mask_fuzzy.
+    filters: list of (name, size) tuples, optional
+         cleanup applied in order to the mask of each window, read with
+         the halo the filters need so that the output has no seams.
+         "open" and "close" take a radius, "sieve" an area in pixels.
+         See rio_alpha.filters.
 
 
     Returns
@@ -73,25 +894,262 @@ def add_alpha(src_path, dst_path, ndv, creation_options, processes):
     None
         Output is written to dst_path
     """
+    _check_options(mask_mode, engine, in_flight, max_memory, tolerance, filters)
 
     with rasterio.open(src_path) as src:
-        dst_profile = src.profile
+        dst_profile = _dst_profile(src, creation_options, mask_mode)
 
-    dst_profile.update(**creation_options)
+    global_args = {
+        "src_nodata": 0,
+        "dst_dtype": dst_profile["dtype"],
+        "ndv": ndv,
+        "mask_mode": mask_mode,
+        "stats": stats is not None,
+        "tolerance": tolerance,
+        "filters": filters,
+    }
 
-    dst_profile.pop("photometric", None)
+    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=(mask_mode != "sidecar")):
+        with rasterio.open(dst_path, "w", **dst_profile) as dst:
+            with rasterio.open(src_path) as src:
+                held = _windows_held(engine, processes, in_flight)
+                windows = plan_windows(
+                    src, dst.block_shapes[0], max_memory, held, processes
+                )
+
+            def write(result, window, timings=None):
+                if stats is not None:
+                    stats.record_all(timings, window)
+                    timings = []
+                _timed(
+                    timings,
+                    "write",
+                    _result_nbytes(result),
+                    _write_window,
+                    dst,
+                    result,
+                    window,
+                    mask_mode,
+                )
+                if stats is not None:
+                    stats.record_all(timings, window)
+                if on_window is not None:
+                    if mask_mode == "band":
+                        on_window(result[:3], result[3], window)
+                    else:
+                        on_window(result[0], result[1], window)
+
+            _run_windows(
+                src_path, global_args, processes, windows, write, engine, in_flight
+            )
+
+
+def _put(queue, *item):
+    queue.put(item)
+
+
+class _BatchJob(object):
+    """A file of add_alpha_many, written window by window in order"""
+
+    def __init__(self, src_path, dst_path):
+        self.src_path = src_path
+        self.dst_path = dst_path
+        self.start = time.time()
+        self.error = None
+        self.dtype = None
+        self.g_args = None
+        self.dst = None
+        self.windows = []
+        self.submitted = 0
+        self.written = 0
+        self.running = 0
+        self.ready = {}
+
+    @property
+    def submittable(self):
+        return self.error is None and self.submitted < len(self.windows)
+
+    @property
+    def done(self):
+        return self.running == 0 and (
+            self.error is not None or self.written == len(self.windows)
+        )
+
+    def fail(self, exc):
+        if self.error is None:
+            self.error = "{}: {}".format(type(exc).__name__, exc)
+
+    def close(self):
+        """Closes the output, removing it if the job failed"""
+        if self.dst is not None:
+            self.dst.close()
+            self.dst = None
+            if self.error is not None:
+                for path in (self.dst_path, self.dst_path + ".msk"):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def report(self):
+        return {
+            "src_path": self.src_path,
+            "dst_path": self.dst_path,
+            "status": "ok" if self.error is None else "error",
+            "error": self.error,
+            "windows": len(self.windows),
+            "seconds": round(time.time() - self.start, 3),
+        }
+
+
+def add_alpha_many(
+    jobs,
+    ndv,
+    creation_options,
+    processes,
+    mask_mode="band",
+    in_flight=None,
+    max_memory=None,
+    tolerance=None,
+    filters=None,
+):
+    """Adds alpha to many files with a single pool of workers
+
+    Each file is planned by plan_windows within the memory budget, so
+    small files are computed as one window and large ones are split
+    between workers. The windows of all files share the shared memory
+    ring of one process pool, and the next files are computed while a
+    file is finishing, so a large file doesn't leave workers idle.
+    Each file is written in window order, like add_alpha does.
+
+    Parameters
+    ------------
+    jobs: iterable of (src_path, dst_path) tuples
+    ndv: list or string
+         a list of floats where the length of the list = band count,
+         or a string parsed for each file like rio alpha --ndv
+    creation_options: dict
+    processes: integer
+         number of workers
+    mask_mode: string
+         see add_alpha
+    in_flight: integer, optional
+         number of windows held in shared memory at once. Defaults
+         to 2 per worker plus 1.
+    max_memory: integer, optional
+         memory budget in bytes for the windows held, 256 MB by default
+    tolerance: number, optional
+         see add_alpha
+    filters: list of (name, size) tuples, optional
+         see add_alpha
+
+    Yields
+    ---------
+    report: dict
+        one per file as it completes, with its "src_path" and
+        "dst_path", "status" "ok" or "error", the "error" message,
+        its number of "windows" and the "seconds" it took
+    """
+    _check_options(mask_mode, "processes", in_flight, max_memory, tolerance, filters)
+    if shared_memory is None:
+        raise RuntimeError("add_alpha_many requires Python 3.8 or later")
+
+    slots = _in_flight(processes, in_flight)
+    max_memory = max_memory or BATCH_MEMORY
+    slot_size = max_memory // slots // 64 * 64
+
+    jobs = iter(jobs)
+    free = list(range(slots))
+    done = Queue()
+    active = []
+    current = None
+    running = 0
+
+    def start(src_path, dst_path):
+        job = _BatchJob(src_path, dst_path)
+        try:
+            with rasterio.open(src_path) as src:
+                _check_bands(src)
+                job.dtype = src.dtypes[0]
+                job.g_args = {
+                    "src_nodata": 0,
+                    "dst_dtype": src.dtypes[0],
+                    "ndv": _parse_ndv(ndv, src.count) if isinstance(ndv, str) else ndv,
+                    "mask_mode": mask_mode,
+                    "tolerance": tolerance,
+                    "filters": filters,
+                }
+                dst_profile = _dst_profile(src, creation_options, mask_mode)
+                job.dst = rasterio.open(dst_path, "w", **dst_profile)
+                job.windows = plan_windows(
+                    src, job.dst.block_shapes[0], max_memory, slots, processes
+                )
+            if max(_slot_size(w, job.dtype) for w in job.windows) > slot_size:
+                raise ValueError("max_memory is too small for a single row")
+        except Exception as exc:
+            job.fail(exc)
+        return job
+
+    def write(job):
+        """Writes the job's results that are next in window order"""
+        while job.written in job.ready:
+            slot = job.ready.pop(job.written)
+            window = job.windows[job.written]
+            if job.error is None:
+                try:
+                    rgba, mask = _slot_buffers(
+                        shm.buf, slot * slot_size, window, job.dtype
+                    )
+                    result = _alpha_result(rgba, mask, mask_mode)[0]
+                    _write_window(job.dst, result, window, mask_mode)
+                    del rgba, mask, result
+                except Exception as exc:
+                    job.fail(exc)
+            free.append(slot)
+            job.written += 1
+        if job.error is not None:
+            free.extend(job.ready.values())
+            job.ready.clear()
+
+    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=(mask_mode != "sidecar")):
+        with _ring_pool(processes, slots, slot_size) as (pool, shm):
+            try:
+                while True:
+                    while free:
+                        if current is None or not current.submittable:
+                            current = next(jobs, None)
+                            if current is None:
+                                break
+                            current = start(*current)
+                            active.append(current)
+                            continue
 
-    dst_profile.update(count=4, nodata=None)
+                        slot, index = free.pop(), current.submitted
+                        current.submitted += 1
+                        current.running += 1
+                        running += 1
+                        args = (slot, current.src_path, current.windows[index])
+                        notify = partial(_put, done, slot, current, index)
+                        pool.apply_async(
+                            _ring_worker,
+                            args + (current.g_args,),
+                            callback=notify,
+                            error_callback=notify,
+                        )
 
-    global_args = {"src_nodata": 0, "dst_dtype": dst_profile["dtype"], "ndv": ndv}
+                    for job in [job for job in active if job.done]:
+                        active.remove(job)
+                        job.close()
+                        yield job.report()
 
-    with riomucho.RioMucho(
-        [src_path],
-        dst_path,
-        _alpha_worker,
-        options=dst_profile,
-        global_args=global_args,
-        mode="manual_read",
-    ) as rm:
+                    if not running:
+                        return
 
-        rm.run(processes)
+                    slot, job, index, error = done.get()
+                    running -= 1
+                    job.running -= 1
+                    if error is not None:
+                        job.fail(error)
+                    job.ready[index] = slot
+                    write(job)
+            finally:
+                for job in active:
+                    job.close()
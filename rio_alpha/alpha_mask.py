@@ -1,25 +1,293 @@
 """Alpha masking."""
 
+import math
+import threading
+
 import numpy as np
 
+try:
+    from numpy.lib.array_utils import byte_bounds
+except ImportError:  # NumPy < 2.0
+    byte_bounds = np.byte_bounds
+
+_work_arrays = threading.local()
+
+
+def _work_array(name, shape, dtype):
+    """Returns a per-thread scratch array, reused while shapes match"""
+    arr = getattr(_work_arrays, name, None)
+    if arr is None or arr.shape != shape or arr.dtype != dtype:
+        arr = np.empty(shape, dtype=dtype)
+        setattr(_work_arrays, name, arr)
+    return arr
+
+
+def _opaque_value(dtype):
+    """Returns the alpha value of valid pixels for a dtype
+
+    The maximum of integer dtypes, and 255 for floats like GDAL masks.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "ui":
+        return np.iinfo(dtype).max
+    else:
+        return 255
+
+
+def _band_differs(band, value, out):
+    """Writes band != value to the boolean out array
+
+    A NaN value matches NaN pixels. Integer bands are compared with the
+    value in their own dtype, so the comparison loop never upcasts.
+    """
+    value = float(value)
+    if band.dtype.kind == "f":
+        if np.isnan(value):
+            np.isnan(band, out=out)
+            np.logical_not(out, out=out)
+        else:
+            np.not_equal(band, band.dtype.type(value), out=out)
+    else:
+        info = np.iinfo(band.dtype)
+        if value.is_integer() and info.min <= value <= info.max:
+            np.not_equal(band, band.dtype.type(value), out=out)
+        else:
+            # The band can't hold the value, so no pixel matches it
+            out[...] = True
+    return out
+
+
+def _packed_pixels(img):
+    """Returns a (rows, cols) uint32 view of the pixels of img
+
+    Only uint8 RGB or RGBA arrays whose pixels are interleaved on a 4
+    byte stride can be viewed this way, for example bands read into a
+    (rows, cols, 4) buffer through its (4, rows, cols) transpose. For
+    RGB arrays the view includes the unused 4th byte of each pixel.
+    Returns None for any other array.
+    """
+    bands, rows, cols = img.shape
+    if img.dtype != np.uint8 or bands not in (3, 4):
+        return None
+    if img.strides[0] != 1 or img.strides[2] != 4:
+        return None
+
+    # The 4th byte of the last RGB pixel must be inside the allocation
+    base = img
+    while isinstance(base.base, np.ndarray):
+        base = base.base
+    if byte_bounds(img)[1] + 4 - bands > byte_bounds(base)[1]:
+        return None
+
+    pixels = np.lib.stride_tricks.as_strided(
+        img[0], shape=(rows, cols, 4), strides=(img.strides[1], 4, 1)
+    )
+    return pixels.view(np.uint32)[..., 0]
+
+
+def _packed_key(values):
+    """Returns values packed like _packed_pixels, None if not uint8"""
+    values = [float(v) for v in values]
+    if not all(v.is_integer() and 0 <= v <= 255 for v in values):
+        return None
+    values = [int(v) for v in values] + [0] * (4 - len(values))
+    return np.array(values, dtype=np.uint8).view(np.uint32)[0]
+
+
+def mask_exact_packed(img, ndv, out=None):
+    """Exact nodata masking of interleaved uint8 RGB(A) pixels
+
+    Each pixel is compared with the nodata value as a single uint32
+    key instead of band by band. Gives the same result as mask_exact.
+
+    Parameters
+    -----------
+    img: ndarray
+        (depth x rows x cols) uint8 array with 3 or 4 bands whose
+        pixels are interleaved on a 4 byte stride
+    ndv: (list|tuple|ndarray)
+        list of notdata values where len == img depth
+    out: ndarray, optional
+        (rows x cols) uint8 array the mask is written to
+
+    Returns
+    --------
+    alpha: ndarray
+        ndarray mask of shape (rows, cols) where
+        nodata == 0 and valid == 255
+    """
+    assert len(ndv) == img.shape[0], "ndv length must equal num bands"
+    keys = _packed_pixels(img)
+    if keys is None:
+        raise ValueError("Array is not interleaved uint8 RGB or RGBA")
 
-def mask_exact(img, ndv):
+    shape = img.shape[1:]
+    if out is None:
+        out = np.empty(shape, dtype=img.dtype)
+    elif out.shape != shape:
+        raise ValueError(
+            "out shape {} does not match image shape {}".format(out.shape, shape)
+        )
+
+    key = _packed_key(ndv)
+    if key is None:
+        # No uint8 pixel can match the nodata value
+        out[...] = 255
+        return out
+
+    valid = _work_array("valid", shape, bool)
+    if img.shape[0] == 4:
+        np.not_equal(keys, key, out=valid)
+    else:
+        # Ignore whatever the 4th byte of the pixels holds
+        scratch = _work_array("keys", shape, np.uint32)
+        np.bitwise_and(keys, _packed_key([255, 255, 255]), out=scratch)
+        np.not_equal(scratch, key, out=valid)
+
+    np.multiply(valid, out.dtype.type(255), out=out)
+    return out
+
+
+def mask_exact(img, ndv, out=None, kernel="auto"):
     """Exact nodata masking based on ndv
 
+    Bands are compared one at a time into boolean planes that are
+    reused by later calls of the same shape in the same thread, so no
+    (depth x rows x cols) temporary is allocated. Interleaved uint8
+    RGBA pixels are compared as packed keys by mask_exact_packed, which
+    is faster for them. Interleaved RGB pixels are faster to compare
+    band by band once copied to planes, so they are not packed unless
+    asked for.
+
     Parameters
     -----------
     img: ndarray
         (depth x rows x cols) array
     ndv: (list|tuple|ndarray)
         list of notdata values where len == img depth
+    out: ndarray, optional
+        (rows x cols) array the mask is written to, for reuse across
+        windows. Defaults to a new array of img's dtype.
+    kernel: string, optional
+        "packed" forces mask_exact_packed, "bands" the band by band
+        comparison, "auto" (default) uses packed keys for interleaved
+        uint8 RGBA pixels.
 
     Returns
     --------
     alpha: ndarray
         ndarray mask of shape (rows, cols) where
-        opaque == 0 and transparent == max of dtype
+        nodata == 0 and valid == max of dtype (255 for floats)
     """
     assert len(ndv) == img.shape[0], "ndv length must equal num bands"
-    alpha = np.any(np.transpose(img, [1, 2, 0]) != ndv, axis=2)
-    alpha_rescale = alpha.astype(img.dtype) * np.iinfo(img.dtype).max
-    return alpha_rescale
+    if kernel == "packed" or (
+        kernel == "auto"
+        and img.shape[0] == 4
+        and _packed_pixels(img) is not None
+        and _packed_key(ndv) is not None
+        and (out is None or out.dtype == np.uint8)
+    ):
+        return mask_exact_packed(img, ndv, out=out)
+    elif kernel not in ("auto", "bands"):
+        raise ValueError("Unknown masking kernel {!r}".format(kernel))
+
+    shape = img.shape[1:]
+    if out is None:
+        out = np.empty(shape, dtype=img.dtype)
+    elif out.shape != shape:
+        raise ValueError(
+            "out shape {} does not match image shape {}".format(out.shape, shape)
+        )
+
+    valid = _band_differs(img[0], ndv[0], _work_array("valid", shape, bool))
+    if len(ndv) > 1:
+        scratch = _work_array("differs", shape, bool)
+        for band, value in zip(img[1:], ndv[1:]):
+            np.logical_or(valid, _band_differs(band, value, scratch), out=valid)
+
+    np.multiply(valid, out.dtype.type(_opaque_value(out.dtype)), out=out)
+    return out
+
+
+def _band_within(band, value, tolerance, out, scratch):
+    """Writes abs(band - value) <= tolerance to the boolean out array
+
+    The difference is never computed: the band is compared with the
+    bounds of the tolerance range in its own dtype, so integer bands
+    neither wrap around nor upcast. A NaN value matches NaN pixels,
+    and NaN pixels only match a NaN value.
+    """
+    value, tolerance = float(value), float(tolerance)
+    if np.isnan(value):
+        if band.dtype.kind == "f":
+            return np.isnan(band, out=out)
+        out[...] = False
+        return out
+
+    low, high = value - tolerance, value + tolerance
+    if band.dtype.kind != "f":
+        info = np.iinfo(band.dtype)
+        low, high = max(math.ceil(low), info.min), min(math.floor(high), info.max)
+        if low > high:
+            # The band can't hold any value of the range
+            out[...] = False
+            return out
+
+    np.greater_equal(band, band.dtype.type(low), out=out)
+    np.less_equal(band, band.dtype.type(high), out=scratch)
+    return np.logical_and(out, scratch, out=out)
+
+
+def mask_fuzzy(img, ndv, tolerance, out=None):
+    """Nodata masking of pixels near ndv
+
+    A pixel is nodata if each of its bands is within tolerance of the
+    band's nodata value, that is if the largest absolute difference
+    over its bands is at most tolerance. This masks the pixels lossy
+    compression shifted away from the nodata value, which mask_exact
+    leaves as holes. A tolerance of 0 gives the same mask as
+    mask_exact.
+
+    Parameters
+    -----------
+    img: ndarray
+        (depth x rows x cols) array
+    ndv: (list|tuple|ndarray)
+        list of notdata values where len == img depth
+    tolerance: (number|list|tuple|ndarray)
+        largest absolute difference from ndv of nodata pixels, for all
+        bands or one per band
+    out: ndarray, optional
+        (rows x cols) array the mask is written to, for reuse across
+        windows. Defaults to a new array of img's dtype.
+
+    Returns
+    --------
+    alpha: ndarray
+        ndarray mask of shape (rows, cols) where
+        nodata == 0 and valid == max of dtype (255 for floats)
+    """
+    assert len(ndv) == img.shape[0], "ndv length must equal num bands"
+    tolerance = np.broadcast_to(np.asarray(tolerance, dtype=float), (len(ndv),))
+    if np.any(tolerance < 0) or np.any(np.isnan(tolerance)):
+        raise ValueError("tolerance must not be negative")
+
+    shape = img.shape[1:]
+    if out is None:
+        out = np.empty(shape, dtype=img.dtype)
+    elif out.shape != shape:
+        raise ValueError(
+            "out shape {} does not match image shape {}".format(out.shape, shape)
+        )
+
+    nodata = _work_array("nodata", shape, bool)
+    within = _work_array("within", shape, bool)
+    scratch = _work_array("differs", shape, bool)
+    _band_within(img[0], ndv[0], tolerance[0], nodata, scratch)
+    for band, value, band_tolerance in zip(img[1:], ndv[1:], tolerance[1:]):
+        _band_within(band, value, band_tolerance, within, scratch)
+        np.logical_and(nodata, within, out=nodata)
+
+    np.logical_not(nodata, out=nodata)
+    np.multiply(nodata, out.dtype.type(_opaque_value(out.dtype)), out=out)
+    return out
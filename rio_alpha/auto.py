@@ -0,0 +1,95 @@
+"""Discover nodata, add alpha and evaluate lossiness in one pass"""
+
+import rasterio
+
+from rio_alpha.alpha import add_alpha
+from rio_alpha.alpha_mask import mask_exact
+from rio_alpha.findnodata import determine_nodata
+from rio_alpha.islossy import RegionCounter
+from rio_alpha.utils import _parse_ndv
+
+
+def auto_alpha(src_path, dst_path, creation_options, processes, threshold=10, **kwargs):
+    """Does the work of findnodata, islossy and alpha with a single read
+
+    The nodata value is discovered from a decimated sample, like
+    ``rio findnodata --discovery``. The full resolution pass of
+    add_alpha then counts the nodata regions of each window it writes,
+    like ``rio islossy``. Regions are those of the exact nodata mask,
+    before any tolerance or filters change the alpha. Without a nodata
+    value, they are those of the dataset mask as written. The verdict
+    is stored in the output's RIO_ALPHA_NODATA ("none" if there is
+    none), RIO_ALPHA_REGIONS and RIO_ALPHA_LOSSY tags.
+
+    Parameters
+    ------------
+    src_path: string
+    dst_path: string
+    creation_options: dict
+    processes: integer
+    threshold: integer
+         number of nodata regions from which the dataset is lossy
+    kwargs:
+         other keyword arguments of add_alpha
+
+    Returns
+    ---------
+    verdict: dict
+        "nodata", the value findnodata prints, "regions" the number of
+        nodata regions and "lossy" whether it is >= threshold
+
+    Raises
+    ------
+    ValueError
+        if a tolerance is given and no nodata value is discovered, as
+        the tolerance is only applied around one. Nothing is written.
+    """
+    nodata = determine_nodata(src_path, None, True, False, False)
+
+    with rasterio.open(src_path) as src:
+        count = src.count
+        counter = RegionCounter(src.height, src.width)
+
+    # Alpha bands and sources without nodata are masked by rasterio
+    ndv = _parse_ndv(nodata, count) if nodata not in ("", "alpha") else None
+    if ndv is None and kwargs.get("tolerance") is not None:
+        raise ValueError(
+            "tolerance requires a nodata value, but {} has {}".format(
+                src_path, "an alpha band" if nodata == "alpha" else "none"
+            )
+        )
+
+    # Otherwise the alpha is the exact mask, and needn't be computed again
+    exact = ndv is not None and (
+        kwargs.get("tolerance") is not None or bool(kwargs.get("filters"))
+    )
+
+    def on_window(rgb, alpha, window):
+        if exact:
+            alpha = mask_exact(rgb, ndv)
+        counter.update(alpha == 0, window)
+
+    add_alpha(
+        src_path,
+        dst_path,
+        ndv,
+        creation_options,
+        processes,
+        on_window=on_window,
+        **kwargs
+    )
+
+    verdict = {
+        "nodata": nodata,
+        "regions": counter.count,
+        "lossy": counter.count >= threshold,
+    }
+
+    with rasterio.open(dst_path, "r+") as dst:
+        dst.update_tags(
+            RIO_ALPHA_NODATA=nodata or "none",
+            RIO_ALPHA_REGIONS=verdict["regions"],
+            RIO_ALPHA_LOSSY=verdict["lossy"],
+        )
+
+    return verdict
@@ -0,0 +1,124 @@
+"""Persistent cache of nodata discovery results"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+# Bump when discovery changes, so that older results are ignored
+CACHE_VERSION = 3
+
+
+def default_cache_dir():
+    """Returns the cache directory used unless another is given"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "rio-alpha")
+
+
+def fingerprint(path, samples=8, sample_size=64 * 1024):
+    """Returns a fingerprint of a file's content, without reading it all
+
+    It hashes the file's size and modification time with sample_size
+    bytes at samples offsets spread over the file, the first one at
+    its start where the GeoTIFF header and directories usually are.
+
+    Parameters
+    ----------
+    path: string
+    samples: integer
+    sample_size: integer
+
+    Returns
+    -------
+    string
+        hexadecimal digest
+    """
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(("%d:%d" % (stat.st_size, stat.st_mtime_ns)).encode())
+    with open(path, "rb") as f:
+        for i in range(samples):
+            f.seek(stat.st_size * i // samples)
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+class DiscoveryCache(object):
+    """An on-disk store of discovery results keyed by content
+
+    Each result is a small JSON file. Once the store grows over
+    max_bytes, the least recently used results are evicted.
+
+    Parameters
+    ----------
+    path: string, optional
+        directory of the store, default_cache_dir() by default
+    max_bytes: integer
+    """
+
+    def __init__(self, path=None, max_bytes=4 * 1024**2):
+        """Opens the store, which is only created on the first put"""
+        self.path = path or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    def key(self, src_path):
+        """Returns the key of a file's results, raises OSError if the
+        file can't be fingerprinted"""
+        return "%d-%s" % (CACHE_VERSION, fingerprint(src_path))
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        """Returns the result stored under key, or None"""
+        entry = self._entry(key)
+        try:
+            with open(entry) as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """Stores a JSON serializable result under key, raises OSError
+        if the store can't be written"""
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp, self._entry(key))
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,130 @@
+"""Neighbourhood cleanup of nodata masks."""
+
+import numpy as np
+
+# scipy.ndimage is imported by each filter, so that importing
+# rio_alpha.alpha doesn't load scipy unless masks are filtered
+
+
+def mask_open(valid, radius):
+    """Morphological opening of a valid mask
+
+    Removes valid specks and fringes narrower than 2 * radius + 1
+    pixels, like the noise lossy compression leaves in a collar.
+
+    Parameters
+    ----------
+    valid: ndarray
+        (rows, cols) boolean array, True where valid
+    radius: integer
+
+    Returns
+    -------
+    ndarray of booleans
+    """
+    from scipy.ndimage import binary_opening
+
+    structure = np.ones((2 * radius + 1, 2 * radius + 1), dtype=bool)
+    return binary_opening(valid, structure)
+
+
+def mask_close(valid, radius):
+    """Morphological closing of a valid mask
+
+    Fills nodata pinholes and cracks narrower than 2 * radius + 1
+    pixels.
+
+    Parameters
+    ----------
+    valid: ndarray
+        (rows, cols) boolean array, True where valid
+    radius: integer
+
+    Returns
+    -------
+    ndarray of booleans
+    """
+    from scipy.ndimage import binary_closing
+
+    structure = np.ones((2 * radius + 1, 2 * radius + 1), dtype=bool)
+    return binary_closing(valid, structure)
+
+
+def _small_regions(mask, area):
+    """Returns the 4-connected regions of mask with fewer than area
+    pixels that don't touch the edges of the array"""
+    from scipy.ndimage import label
+
+    labels, n = label(mask)
+    sizes = np.bincount(labels.ravel(), minlength=n + 1)
+    edges = np.concatenate((labels[0], labels[-1], labels[:, 0], labels[:, -1]))
+    small = sizes < area
+    small[0] = False
+    small[edges] = False
+    return small[labels]
+
+
+def sieve(valid, area):
+    """Removes regions of fewer than area pixels from a valid mask
+
+    Nodata regions of fewer than area pixels are filled first, then
+    valid regions of fewer than area pixels are masked, so that a
+    valid speck inside a filled hole is kept. Regions touching the
+    edges of the array are never removed, as they may continue past
+    them.
+
+    Parameters
+    ----------
+    valid: ndarray
+        (rows, cols) boolean array, True where valid
+    area: integer
+
+    Returns
+    -------
+    ndarray of booleans
+    """
+    valid = valid | _small_regions(~valid, area)
+    return valid & ~_small_regions(valid, area)
+
+
+# Each filter has its function and the halo, in pixels, around a
+# window that it needs to give the same result as on the whole mask
+FILTERS = {
+    "open": (mask_open, lambda radius: 2 * radius),
+    "close": (mask_close, lambda radius: 2 * radius),
+    "sieve": (sieve, lambda area: 2 * area),
+}
+
+
+def _check_filter(name, size):
+    """Raises ValueError if (name, size) isn't a filter of FILTERS"""
+    if name not in FILTERS:
+        raise ValueError(
+            "filters must be one of {}, not {!r}".format(tuple(FILTERS), name)
+        )
+    if size < 1:
+        raise ValueError("{} size must be at least 1, not {!r}".format(name, size))
+
+
+def filter_halo(filters):
+    """Returns the halo needed by a sequence of (name, size) filters"""
+    return sum(FILTERS[name][1](size) for name, size in filters)
+
+
+def apply_filters(valid, filters):
+    """Applies a sequence of (name, size) filters to a valid mask
+
+    Parameters
+    ----------
+    valid: ndarray
+        (rows, cols) boolean array, True where valid
+    filters: list of (name, size) tuples
+        names are keys of FILTERS, applied in order
+
+    Returns
+    -------
+    ndarray of booleans
+    """
+    for name, size in filters:
+        valid = FILTERS[name][0](valid, size)
+    return valid
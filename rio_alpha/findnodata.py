@@ -1,51 +1,163 @@
 """Find nodata value of datasets."""
 
+from functools import partial
+import logging
+import math
+from multiprocessing import Pool
+import os
+import time
+
 import click
 import numpy as np
 import rasterio
-from scipy.stats import mode
 
+from rio_alpha.histogram import count_colors, top_colors
+from rio_alpha.sampling import BlockSampler, block_windows, tile_separation
 from rio_alpha.utils import (
     _convert_rgb,
     _compute_continuous,
     _debug_mode,
     _search_image_edge,
     _evaluate_count,
+    _read_edges,
+    _read_sample,
+    _sample_factor,
+    _split_memory,
 )
 
+log = logging.getLogger(__name__)
+
+# Bytes per sample pixel that discovery allocates besides the sample
+# itself, as traced by tracemalloc on the benchmark images
+DISCOVERY_PIXEL_BYTES = 64
+
+# Discovery samplers: "grid" reads a decimated image, "blocks" reads
+# blocks in stratified random order until the modal colour is separated
+# from the runner-up
+SAMPLERS = ("grid", "blocks")
+
+# Extensions of the files find_rasters yields. Mask and overview
+# sidecars, like .msk and .ovr, are left out.
+RASTER_EXTENSIONS = (".tif", ".tiff", ".jp2", ".img", ".vrt")
 
-def discover_ndv(rgb_orig, debug, verbose):
-    """Returns nodata value by calculating mode of RGB array
+
+def _discovery_evidence(rgb_orig, read_edges=None):
+    """Returns the evidence discover_ndv decides from
 
     Parameters
     ----------
     rgb_orig: ndarray
               array of input pixels of shape (rows, cols, depth)
-    debug: Boolean
-           Enables matplotlib & printing of figures
-    verbose: Boolean
-             Prints extra information, like competing candidate values
-
+    read_edges: callable, optional
+              returns the edge pixels counted instead of the edges of
+              rgb_orig, see _read_edges. Only called if the edges are
+              searched.
 
     Returns
     -------
-    list of nodata value candidates or empty string if none found
-
+    evidence: dict
+              "original" the modal color, "continuous" the modal color
+              of continuous pixels, "confidence" the separation of the
+              modal color from the runner-up over tiles of the sample,
+              see sampling.separation, and, if the candidates differ,
+              "edge_counts" the counts of each along the image edge,
+              in full and in continuous pixels.
+    rgb_mod_flat: ndarray
+    arr: ndarray
+         continuous pixels, for debug mode
     """
     rgb_mod, rgb_mod_flat = _convert_rgb(rgb_orig)
-    # Full image mode bincount
-    mode_vals = mode(rgb_mod_flat)
-    candidate_original = [int((mode_vals[0])[0, i]) for i in range(3)]
+    # Full image modal color, and the runner-up
+    colors, _ = top_colors(rgb_mod_flat, 2)
+    candidate_original = [int(v) for v in colors[0][:3]]
 
     # Find continuous values in RGB array
     candidate_continuous, arr = _compute_continuous(rgb_mod, 1)
 
-    # If debug mode, print histograms & be verbose
-    if debug:
-        click.echo("Original image ndv candidate: %s" % (str(candidate_original)))
-        click.echo("Filtered image ndv candidate: %s" % (str(candidate_continuous)))
-        outplot = "/tmp/hist_plot.png"
-        _debug_mode(rgb_mod_flat, arr, outplot)
+    evidence = {
+        "original": candidate_original,
+        "continuous": candidate_continuous,
+        "confidence": tile_separation(rgb_mod, colors),
+    }
+    if candidate_original != candidate_continuous:
+        edges = read_edges() if read_edges is not None else None
+        evidence["edge_counts"] = _search_image_edge(
+            rgb_mod, candidate_original, candidate_continuous, edges
+        )
+
+    return evidence, rgb_mod_flat, arr
+
+
+def _block_evidence(
+    src, seed=0, min_blocks=4, max_blocks=64, max_pixels=2**22, target=0.99
+):
+    """Returns discovery evidence of blocks read in stratified random order
+
+    Blocks are read in the order of sampling.block_windows until the
+    modal color is separated from the runner-up with target confidence,
+    after at least min_blocks, or max_blocks or max_pixels are read.
+
+    Parameters
+    ----------
+    src: rasterio dataset opened in "r" mode
+    seed: integer
+    min_blocks: integer
+    max_blocks: integer
+    max_pixels: integer
+    target: float
+
+    Returns
+    -------
+    evidence: dict
+        like _discovery_evidence's, with the confidence over blocks
+        and the number of "blocks" read
+    """
+    sampler = BlockSampler(src.count, src.dtypes[0])
+    for window in block_windows(src, seed):
+        sampler.add(np.moveaxis(src.read(window=window), 0, -1))
+        blocks = len(sampler.blocks)
+        if blocks >= min_blocks and sampler.confidence >= target:
+            break
+        if blocks >= max_blocks or sampler.pixels >= max_pixels:
+            break
+
+    candidate_original = [int(v) for v in sampler.leaders(1)[0][:3]]
+    continuous = sampler.continuous()
+    evidence = {
+        "original": candidate_original,
+        "continuous": [] if continuous is None else [int(v) for v in continuous[:3]],
+        "confidence": sampler.confidence,
+        "blocks": len(sampler.blocks),
+    }
+    if continuous is None:
+        # Without continuous pixels, no candidate can win
+        evidence["edge_counts"] = ([0, 0], [0, 0])
+    elif evidence["original"] != evidence["continuous"]:
+        candidates = (candidate_original, evidence["continuous"])
+        edges = _edge_reader(src, None)()
+        evidence["edge_counts"] = (
+            count_colors(edges, candidates),
+            [sampler.col_runs.count(candidate) for candidate in candidates],
+        )
+    return evidence
+
+
+def _decide_ndv(evidence, verbose):
+    """Returns the nodata value of discovery evidence
+
+    Parameters
+    ----------
+    evidence: dict
+              returned by _discovery_evidence
+    verbose: Boolean
+             Prints extra information, like competing candidate values
+
+    Returns
+    -------
+    list of nodata value candidates or empty string if none found
+    """
+    candidate_original = evidence["original"]
+    candidate_continuous = evidence["continuous"]
 
     # Compare ndv candidates from full & squished image
     candidate_list = [
@@ -67,9 +179,7 @@ def discover_ndv(rgb_orig, debug, verbose):
                 "Candidate list: %s" % str(candidate_list)
             )
 
-        count_img_edge_full, count_img_edge_continuous = _search_image_edge(
-            rgb_mod, candidate_original, candidate_continuous
-        )
+        count_img_edge_full, count_img_edge_continuous = evidence["edge_counts"]
 
         if verbose:
             for candidate in (candidate_original, candidate_continuous):
@@ -94,7 +204,149 @@ def discover_ndv(rgb_orig, debug, verbose):
         raise ValueError("Invalid candidate list {!r}".format(candidate_list))
 
 
-def determine_nodata(src_path, user_nodata, discovery, debug, verbose):
+def discover_ndv(rgb_orig, debug, verbose, read_edges=None, confidence=False):
+    """Returns nodata value by calculating the modal color of RGB array
+
+    Parameters
+    ----------
+    rgb_orig: ndarray
+              array of input pixels of shape (rows, cols, depth)
+    debug: Boolean
+           Enables matplotlib & printing of figures
+    verbose: Boolean
+             Prints extra information, like competing candidate values
+    read_edges: callable, optional
+             returns the full resolution edge pixels of the image, see
+             _read_edges. The edges of rgb_orig are searched otherwise.
+    confidence: Boolean
+             Also returns the confidence that the modal color is
+             separated from the runner-up, between 0 and 1
+
+
+    Returns
+    -------
+    list of nodata value candidates or empty string if none found,
+    and the confidence if requested
+
+    """
+    evidence, rgb_mod_flat, arr = _discovery_evidence(rgb_orig, read_edges)
+
+    # If debug mode, print histograms & be verbose
+    if debug:
+        click.echo("Original image ndv candidate: %s" % (str(evidence["original"])))
+        click.echo("Filtered image ndv candidate: %s" % (str(evidence["continuous"])))
+        outplot = "/tmp/hist_plot.png"
+        _debug_mode(rgb_mod_flat, arr, outplot)
+
+    candidates = _decide_ndv(evidence, verbose)
+    if confidence:
+        return candidates, evidence["confidence"]
+    return candidates
+
+
+def _fit_sample(src, max_memory, size=200):
+    """Returns the decimation factor of a discovery sample that fits in
+    max_memory, None if the sample of size does
+
+    Parameters
+    ----------
+    src: rasterio dataset opened in "r" mode
+    max_memory: integer
+        memory budget in bytes of the sample and discovery's arrays
+    size: integer, target length of the smaller dimension
+
+    Returns
+    -------
+    integer or None
+    """
+    pixel_bytes = src.count * np.dtype(src.dtypes[0]).itemsize + DISCOVERY_PIXEL_BYTES
+
+    def sample_bytes(factor):
+        rows = math.ceil(src.height / factor)
+        cols = math.ceil(src.width / factor)
+        return rows * cols * pixel_bytes
+
+    default = _sample_factor(src.height, src.width, size)
+    if sample_bytes(default) <= max_memory:
+        return None
+
+    # Start from the factor that would fit if the sample was unpadded
+    pixels = src.height * src.width * pixel_bytes / max_memory
+    factor = max(default + 1, int(math.sqrt(pixels)))
+    while sample_bytes(factor) > max_memory and factor < max(src.height, src.width):
+        factor += 1
+
+    log.warning(
+        "Discovery sampled %s at 1/%d resolution instead of 1/%d to fit in "
+        "%d bytes, nodata areas narrower than %d pixels may be missed",
+        src.name,
+        factor,
+        default,
+        max_memory,
+        factor,
+    )
+    return factor
+
+
+def _edge_reader(src, factor):
+    """Returns a function reading the edges of the dataset sampled by
+    factor, or by the default factor if None"""
+    return partial(_read_edges, src, factor or _sample_factor(src.height, src.width))
+
+
+def _grid_evidence(src, factor=None):
+    """Returns discovery evidence of a sample decimated by factor"""
+    evidence, _, _ = _discovery_evidence(
+        _read_sample(src, factor=factor), _edge_reader(src, factor)
+    )
+    return evidence
+
+
+def _discover_cached(src, cache, variant, compute, verbose=False):
+    """Returns discovery evidence for a dataset, from cache if possible
+
+    Evidence of each variant of sampling, if not None, is cached apart
+    from the evidence of the default sample. compute returns the
+    evidence on a cache miss. Hits and misses are logged at INFO level,
+    and also printed to stderr if verbose. Evidence that can't be
+    stored is only returned, with a warning.
+    """
+    try:
+        key = cache.key(src.name)
+    except OSError:
+        # Not a local file, so there is no fingerprint
+        key = None
+    if key and variant:
+        key = "%s-%s" % (key, variant)
+
+    evidence = cache.get(key) if key else None
+    if key:
+        status = "hit" if evidence else "miss"
+        log.info("Discovery cache %s: %s", status, src.name)
+        if verbose:
+            click.echo("Discovery cache %s: %s" % (status, src.name), err=True)
+
+    if evidence is None:
+        evidence = compute()
+        if key:
+            try:
+                cache.put(key, evidence)
+            except OSError as err:
+                log.warning("Discovery result of %s not cached: %s", src.name, err)
+
+    return evidence
+
+
+def determine_nodata(
+    src_path,
+    user_nodata,
+    discovery,
+    debug,
+    verbose,
+    cache=None,
+    max_memory=None,
+    sampler="grid",
+):
     """Worker function for determining nodata
 
     Parameters
@@ -110,6 +362,19 @@ def determine_nodata(src_path, user_nodata, discovery, debug, verbose):
            Enables matplotlib & printing of figures
     verbose: Boolean
              Prints extra information, like competing candidate values
+    cache: DiscoveryCache, optional
+           where discovery results are looked up and stored, keyed by
+           the content of the dataset. Not used in debug mode.
+    max_memory: integer, optional
+           memory budget in bytes of the discovery sample and the
+           arrays computed from it. If the default sample doesn't fit,
+           a more decimated one is used and a warning is logged. The
+           blocks sampler reads fewer pixels to fit.
+    sampler: string
+           "grid" samples a decimated image, "blocks" reads blocks in
+           stratified random order, more of them along the edges,
+           until the modal color is separated from the runner-up.
+           Debug mode requires "grid".
 
 
     Returns
@@ -120,25 +385,203 @@ def determine_nodata(src_path, user_nodata, discovery, debug, verbose):
                   For example, string([int(ndv), int(ndv), int(ndv)])
     """
 
+    ndv, _, _ = _find_nodata(
+        src_path, user_nodata, discovery, debug, verbose, cache, max_memory, sampler
+    )
+    return ndv
+
+
+def _find_nodata(
+    src_path, user_nodata, discovery, debug, verbose, cache, max_memory, sampler
+):
+    """Returns the nodata value determine_nodata returns, how it was
+    found, "user", "alpha", "internal", "discovered" or None, and the
+    confidence of discovery or None"""
+    if sampler not in SAMPLERS:
+        raise ValueError(
+            "sampler must be one of {}, not {!r}".format(", ".join(SAMPLERS), sampler)
+        )
+    if debug and sampler != "grid":
+        raise ValueError("debug mode requires the grid sampler")
+
     if user_nodata:
-        return user_nodata
+        return user_nodata, "user", None
 
     with rasterio.open(src_path, "r") as src:
         count = src.count
 
         if count == 4:
-            return "alpha"
+            return "alpha", "alpha", None
         else:
             nodata = src.nodata
             if nodata is None:
                 if discovery:
-                    data = np.rollaxis(src.read(), 0, 3)
-                    candidates = discover_ndv(data, debug, verbose)
+                    if sampler == "blocks":
+                        variant = "blocks"
+                        compute = partial(_block_evidence, src)
+                        if max_memory:
+                            # Histograms of the pixels read and a block
+                            max_pixels = max_memory // (2 * DISCOVERY_PIXEL_BYTES)
+                            variant = "blocks-%d" % max_pixels
+                            compute = partial(compute, max_pixels=max_pixels)
+                    else:
+                        variant = _fit_sample(src, max_memory) if max_memory else None
+                        compute = partial(_grid_evidence, src, variant)
+
+                    if debug:
+                        data = _read_sample(src, factor=variant)
+                        candidates, confidence = discover_ndv(
+                            data, debug, verbose, _edge_reader(src, variant), True
+                        )
+                    else:
+                        if cache is not None:
+                            evidence = _discover_cached(
+                                src, cache, variant, compute, verbose
+                            )
+                        else:
+                            evidence = compute()
+                        candidates = _decide_ndv(evidence, verbose)
+                        confidence = evidence["confidence"]
+
+                    log.info("Discovery confidence of %s: %.4f", src_path, confidence)
                     if len(candidates) != 3:
-                        return ""
+                        return "", None, None
                     else:
-                        return "[{}, {}, {}]".format(*candidates)
+                        return (
+                            "[{}, {}, {}]".format(*candidates),
+                            "discovered",
+                            confidence,
+                        )
                 else:
-                    return ""
+                    return "", None, None
             else:
-                return "%s" % (str(int(nodata)))
+                return "%s" % (str(int(nodata))), "internal", None
+
+
+def find_rasters(directory, extensions=RASTER_EXTENSIONS):
+    """Yields the paths of the rasters under a directory
+
+    Directories are walked in sorted order, and paths are yielded as
+    they are found.
+
+    Parameters
+    ----------
+    directory: string
+    extensions: tuple of strings
+        lowercase extensions of the files yielded
+
+    Yields
+    ------
+    string
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(extensions):
+                yield os.path.join(root, name)
+
+
+def _scan_file(src_path, user_nodata, discovery, cache, max_memory, sampler):
+    """Returns the scan_nodata record of a file, never raises"""
+    start = time.perf_counter()
+    record = {"src_path": src_path, "ndv": None, "method": None, "confidence": None}
+    error = None
+    try:
+        env = {}
+        if max_memory:
+            max_memory, env["GDAL_CACHEMAX"] = _split_memory(max_memory)
+        with rasterio.Env(**env):
+            record["ndv"], record["method"], record["confidence"] = _find_nodata(
+                src_path,
+                user_nodata,
+                discovery,
+                False,
+                False,
+                cache,
+                max_memory,
+                sampler,
+            )
+    except Exception as exc:
+        error = "{}: {}".format(type(exc).__name__, exc)
+    record.update(
+        status="ok" if error is None else "error",
+        error=error,
+        seconds=round(time.perf_counter() - start, 3),
+    )
+    return record
+
+
+def scan_nodata(
+    paths,
+    workers=1,
+    user_nodata=None,
+    discovery=True,
+    cache=None,
+    max_memory=None,
+    sampler="grid",
+):
+    """Determines the nodata value of many files with a pool of workers
+
+    Each file is handled by determine_nodata in one of workers
+    processes, in this process if workers is 1, and its record is
+    yielded as soon as it is done, so records are in completion order.
+    A file that fails gets an error record and doesn't stop the others.
+
+    Parameters
+    ----------
+    paths: iterable of strings
+    workers: integer
+    user_nodata: string, optional
+        see determine_nodata
+    discovery: Boolean
+        see determine_nodata
+    cache: DiscoveryCache, optional
+        shared by the workers
+    max_memory: integer, optional
+        memory budget in bytes of each worker, of at least 1M. A
+        quarter of it caches GDAL blocks and the rest is the
+        max_memory of determine_nodata.
+    sampler: string
+        see determine_nodata
+
+    Raises
+    ------
+    ValueError
+        before any file is read, if workers, max_memory or sampler is
+        invalid
+
+    Yields
+    ------
+    record: dict
+        one per file, with its "src_path", the "ndv" determine_nodata
+        returns, the "method" that found it, "user", "alpha",
+        "internal", "discovered" or None if none was found, the
+        "confidence" of discovered values, "status"
+        "ok" or "error", the "error" message and the "seconds" it took
+    """
+    if workers < 1:
+        raise ValueError("workers must be positive, not {!r}".format(workers))
+    if sampler not in SAMPLERS:
+        raise ValueError(
+            "sampler must be one of {}, not {!r}".format(", ".join(SAMPLERS), sampler)
+        )
+    if max_memory:
+        # Raises once here rather than failing each file
+        _split_memory(max_memory)
+
+    scan = partial(
+        _scan_file,
+        user_nodata=user_nodata,
+        discovery=discovery,
+        cache=cache,
+        max_memory=max_memory,
+        sampler=sampler,
+    )
+    if workers == 1:
+        for path in paths:
+            yield scan(path)
+        return
+
+    with Pool(workers) as pool:
+        for record in pool.imap_unordered(scan, paths):
+            yield record
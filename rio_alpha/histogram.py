@@ -0,0 +1,149 @@
+"""Packed-pixel colour histograms."""
+
+import numpy as np
+
+
+def pack_pixels(pixels):
+    """Returns one comparable key per pixel
+
+    Integer pixels whose bands fit in 64 bits are packed into a single
+    unsigned integer with the first band in the most significant bits,
+    so key order is the lexicographic order of the colours. Wider or
+    float pixels are keyed by their raw bytes.
+
+    Parameters
+    ----------
+    pixels: ndarray
+        (n x depth) array of pixels
+
+    Returns
+    -------
+    keys: ndarray
+        (n,) array of uint64 or void keys
+    """
+    pixels = np.ascontiguousarray(pixels)
+    n, depth = pixels.shape
+    dtype = pixels.dtype
+
+    if dtype.kind in "ui" and dtype.itemsize * depth <= 8:
+        unsigned = pixels.view(np.dtype("u%d" % dtype.itemsize))
+        bits = 8 * dtype.itemsize
+        keys = np.zeros(n, dtype=np.uint64)
+        for band in range(depth):
+            keys <<= np.uint64(bits)
+            keys |= unsigned[:, band]
+        return keys
+    else:
+        return pixels.view(np.dtype((np.void, dtype.itemsize * depth))).ravel()
+
+
+def _narrow(pixels):
+    """Casts non-negative integer pixels to the smallest unsigned dtype"""
+    if pixels.dtype.kind in "ui" and pixels.size and pixels.min() >= 0:
+        return pixels.astype(np.min_scalar_type(pixels.max()), copy=False)
+    return pixels
+
+
+def _key_bits(pixels):
+    """Returns the width of packed keys, None for byte keys"""
+    dtype = pixels.dtype
+    if dtype.kind in "ui" and dtype.itemsize * pixels.shape[1] <= 8:
+        return 8 * dtype.itemsize * pixels.shape[1]
+    return None
+
+
+def color_histogram(pixels):
+    """Counts the occurrences of each distinct colour in one pass
+
+    A dense ``np.bincount`` table is used when the key space is no
+    larger than the number of pixels (for example 24 bit keys for
+    large uint8 RGB samples), ``np.unique`` otherwise.
+
+    Parameters
+    ----------
+    pixels: ndarray
+        (n x depth) array of pixels
+
+    Returns
+    -------
+    colors: ndarray
+        (m x depth) array of distinct colours in key order
+    counts: ndarray
+        (m,) array of pixel counts per colour
+    """
+    pixels = np.asarray(pixels)
+    dtype = pixels.dtype
+    depth = pixels.shape[1]
+
+    if pixels.shape[0] == 0:
+        return np.empty((0, depth), dtype=dtype), np.empty(0, dtype=np.intp)
+
+    pixels = _narrow(pixels)
+    bits = _key_bits(pixels)
+    keys = pack_pixels(pixels)
+
+    if bits is not None and 2**bits <= max(len(keys), 2**16):
+        table = np.bincount(keys.astype(np.intp), minlength=2**bits)
+        present = np.flatnonzero(table)
+        counts = table[present]
+        band_bits = bits // depth
+        unsigned = np.empty((len(present), depth), dtype="u%d" % (band_bits // 8))
+        for band in range(depth):
+            shift = band_bits * (depth - 1 - band)
+            unsigned[:, band] = (present >> shift) & (2**band_bits - 1)
+        colors = unsigned.view(pixels.dtype)
+    else:
+        _, index, counts = np.unique(keys, return_index=True, return_counts=True)
+        colors = pixels[index]
+
+    return colors.astype(dtype, copy=False), counts
+
+
+def top_colors(pixels, k=1):
+    """Returns the k most frequent colours and their counts
+
+    Ties are broken in favour of the lowest colour, in band order.
+
+    Parameters
+    ----------
+    pixels: ndarray
+        (n x depth) array of pixels
+    k: integer
+        number of candidates to return
+
+    Returns
+    -------
+    colors: ndarray
+        (min(k, m) x depth) array of colours, most frequent first
+    counts: ndarray
+        (min(k, m),) array of pixel counts per colour
+    """
+    colors, counts = color_histogram(pixels)
+    # colors are in key order, so a stable sort keeps the lowest first
+    order = np.argsort(-counts, kind="stable")[:k]
+    return colors[order], counts[order]
+
+
+def count_colors(pixels, colors):
+    """Counts the occurrences of each of the given colours in one pass
+
+    Parameters
+    ----------
+    pixels: ndarray
+        (n x depth) array of pixels
+    colors: (list|tuple|ndarray)
+        sequence of colours of length depth
+
+    Returns
+    -------
+    list of integers, one count per colour
+    """
+    pixels = np.asarray(pixels)
+    colors = np.asarray(colors, dtype=pixels.dtype).reshape(-1, pixels.shape[1])
+
+    keys, counts = np.unique(pack_pixels(pixels), return_counts=True)
+    wanted = pack_pixels(colors)
+
+    index = np.minimum(np.searchsorted(keys, wanted), max(len(keys) - 1, 0))
+    found = (keys[index] == wanted) if len(keys) else np.zeros(len(wanted), bool)
+    return [int(counts[i]) if hit else 0 for i, hit in zip(index, found)]
@@ -1,9 +1,243 @@
 """Evaluate datasets for lossy compression affected nodata masks"""
 
-from rasterio.features import shapes
+import logging
+import math
+
+import numpy as np
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from scipy.ndimage import label
 
 from rio_alpha.alpha_mask import mask_exact
 
+log = logging.getLogger(__name__)
+
+# Bytes per window pixel that counting allocates besides the window
+# read: mask_exact's scratch, the nodata mask and its int64 labels
+REGION_PIXEL_BYTES = 16
+
+
+class RegionCounter(object):
+    """Counts 4-connected nodata regions of a raster, window by window.
+
+    Windows are labeled independently and their labels are merged with
+    a union-find across window edges. Windows must be fed in raster
+    order: the pixels above and to the left of a window are processed
+    before it. Besides one union-find parent per label, only the last
+    labeled row and column are kept, never the whole mask.
+
+    Parameters
+    ----------
+    height: integer
+    width: integer
+    """
+
+    def __init__(self, height, width):
+        """Starts with no region counted"""
+        self.height = height
+        self.width = width
+        self.count = 0
+        # label 0 is the background, and is its own root
+        self._parent = np.zeros(1024, dtype=np.int64)
+        self._next_label = 1
+        # last labeled row of each column and column of each row
+        self._above = np.zeros(width, dtype=np.int64)
+        self._above_row = np.full(width, -1, dtype=np.int64)
+        self._left = np.zeros(height, dtype=np.int64)
+        self._left_col = np.full(height, -1, dtype=np.int64)
+
+    def _find(self, x):
+        parent = self._parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def _roots(self, labels):
+        roots = self._parent[labels]
+        while True:
+            parents = self._parent[roots]
+            if np.array_equal(parents, roots):
+                return roots
+            roots = parents
+
+    def _merge(self, a, b):
+        """Unions the regions of each (a, b) pair of labels"""
+        pairs = np.stack((self._roots(a), self._roots(b)), axis=1)
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        if len(pairs):
+            pairs = np.unique(pairs, axis=0)
+        for x, y in pairs:
+            x, y = self._find(x), self._find(y)
+            if x != y:
+                self._parent[max(x, y)] = min(x, y)
+                self.count -= 1
+
+    def update(self, nodata, window):
+        """Adds a window of the nodata mask
+
+        Parameters
+        ----------
+        nodata: ndarray
+            (rows, cols) boolean array, True where nodata
+        window: Window object
+        """
+        labels, n = label(nodata, output=np.int64)
+        if n:
+            labels[labels > 0] += self._next_label - 1
+        start, self._next_label = self._next_label, self._next_label + n
+        if self._next_label > len(self._parent):
+            self._parent = np.resize(self._parent, 2 * self._next_label)
+        self._parent[start : self._next_label] = np.arange(start, self._next_label)
+        self.count += n
+
+        row, col = int(window.row_off), int(window.col_off)
+        rows, cols = labels.shape
+
+        above = self._above[col : col + cols]
+        edge = labels[0]
+        touching = (self._above_row[col : col + cols] == row - 1) & (above > 0)
+        touching &= edge > 0
+        self._merge(above[touching], edge[touching])
+
+        left = self._left[row : row + rows]
+        edge = labels[:, 0]
+        touching = (self._left_col[row : row + rows] == col - 1) & (left > 0)
+        touching &= edge > 0
+        self._merge(left[touching], edge[touching])
+
+        self._above[col : col + cols] = labels[-1]
+        self._above_row[col : col + cols] = row + rows - 1
+        self._left[row : row + rows] = labels[:, -1]
+        self._left_col[row : row + rows] = col + cols - 1
+
+    @property
+    def closed(self):
+        """The number of regions that no later window can extend"""
+        open_labels = np.concatenate(
+            (
+                self._above[(self._above_row < self.height - 1) & (self._above > 0)],
+                self._left[(self._left_col < self.width - 1) & (self._left > 0)],
+            )
+        )
+        return self.count - len(np.unique(self._roots(open_labels)))
+
+
+def region_windows(src, rows=256, cols=1024):
+    """Returns block aligned windows in raster order
+
+    Blocks are merged into windows of about rows x cols pixels.
+
+    Parameters
+    ----------
+    src: rasterio dataset opened in "r" mode
+    rows: integer
+    cols: integer
+
+    Returns
+    -------
+    list of Window objects
+    """
+    block_rows, block_cols = src.block_shapes[0]
+    rows = block_rows * max(1, rows // block_rows)
+    cols = block_cols * max(1, cols // block_cols)
+    return [
+        Window(col, row, min(cols, src.width - col), min(rows, src.height - row))
+        for row in range(0, src.height, rows)
+        for col in range(0, src.width, cols)
+    ]
+
+
+def _strips(height, width, rows):
+    """Returns full width windows of rows in raster order"""
+    return [
+        Window(0, row, width, min(rows, height - row)) for row in range(0, height, rows)
+    ]
+
+
+def plan_region_windows(src, max_memory=None, rows=256, cols=1024):
+    """Returns the windows and decimation factor counting fits in
+
+    Block aligned windows of about rows x cols pixels are shrunk to fit
+    in max_memory. If a block doesn't fit, windows are full width
+    strips of fewer rows, and if a row of the dataset doesn't fit, the
+    strips are read decimated, which approximates the count. A warning
+    is logged then.
+
+    Parameters
+    ----------
+    src: rasterio dataset opened in "r" mode
+    max_memory: integer, optional
+        memory budget in bytes of the arrays of one window and of the
+        RegionCounter, besides its labels
+    rows: integer
+    cols: integer
+
+    Returns
+    -------
+    list of Window objects, in the grid of the decimated dataset
+    integer
+        decimation factor, 1 to read at full resolution
+    """
+    if max_memory is None:
+        return region_windows(src, rows, cols), 1
+
+    pixel_bytes = src.count * np.dtype(src.dtypes[0]).itemsize + REGION_PIXEL_BYTES
+    factor = 1
+    while True:
+        height = math.ceil(src.height / factor)
+        width = math.ceil(src.width / factor)
+        # RegionCounter keeps two int64 per row and per column
+        max_pixels = (max_memory - 16 * (height + width)) // pixel_bytes
+        if max_pixels >= width:
+            break
+        if factor >= max(src.height, src.width):
+            raise ValueError(
+                "max_memory of {} bytes can't hold a row of {}".format(
+                    max_memory, src.name
+                )
+            )
+        factor += 1
+
+    if factor > 1:
+        log.warning(
+            "Nodata regions of %s counted at 1/%d resolution to fit in %d bytes, "
+            "regions closer than %d pixels may be merged or missed",
+            src.name,
+            factor,
+            max_memory,
+            factor,
+        )
+
+    block_rows, block_cols = src.block_shapes[0]
+    block = block_rows * block_cols
+    if factor > 1 or block > max_pixels:
+        return _strips(height, width, max_pixels // width), factor
+
+    cols = block_cols * max(1, min(cols // block_cols, max_pixels // block))
+    rows = block_rows * max(
+        1, min(rows // block_rows, max_pixels // (block_rows * cols))
+    )
+    return region_windows(src, rows, cols), factor
+
+
+def _read_decimated(src, window, factor):
+    """Reads a window of the dataset decimated by factor"""
+    if factor == 1:
+        return src.read(window=window)
+    col, row = int(window.col_off) * factor, int(window.row_off) * factor
+    source = Window(
+        col,
+        row,
+        min(int(window.width) * factor, src.width - col),
+        min(int(window.height) * factor, src.height - row),
+    )
+    return src.read(
+        window=source,
+        out_shape=(src.count, int(window.height), int(window.width)),
+        resampling=Resampling.nearest,
+    )
+
 
 def count_ndv_regions(img, ndv):
     """Discover unique labels to count ndv regions.
@@ -20,5 +254,39 @@ def count_ndv_regions(img, ndv):
     int
         The number of connected regions
     """
-    img = mask_exact(img, ndv)
-    return len(list(shapes(img, mask=(img != 255))))
+    counter = RegionCounter(*img.shape[1:])
+    counter.update(mask_exact(img, ndv) == 0, Window(0, 0, img.shape[2], img.shape[1]))
+    return counter.count
+
+
+def count_ndv_regions_windowed(src, ndv, threshold=None, windows=None, factor=1):
+    """Count ndv regions of a dataset without reading it whole.
+
+    Parameters
+    ----------
+    src: rasterio dataset opened in "r" mode
+    ndv: list
+        a list of floats whose length = band count
+    threshold: integer, optional
+        Stop reading as soon as this many regions are known to exist
+    windows: list of Window objects, optional
+        Windows in raster order, defaults to region_windows(src)
+    factor: integer
+        Decimation factor of the reads, windows are then in the grid
+        of the decimated dataset, see plan_region_windows
+
+    Returns
+    -------
+    int
+        The number of connected regions, or a count >= threshold if
+        the threshold was reached before the end of the dataset
+    """
+    counter = RegionCounter(
+        math.ceil(src.height / factor), math.ceil(src.width / factor)
+    )
+    for window in windows or region_windows(src):
+        img = _read_decimated(src, window, factor)
+        counter.update(mask_exact(img, ndv) == 0, window)
+        if threshold is not None and counter.closed >= threshold:
+            return counter.closed
+    return counter.count
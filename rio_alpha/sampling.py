@@ -0,0 +1,223 @@
+"""Stratified block sampling for nodata discovery."""
+
+import math
+
+import numpy as np
+from rasterio.windows import Window
+
+from rio_alpha.histogram import color_histogram, pack_pixels
+from rio_alpha.utils import _find_runs
+
+
+def separation(leader, runner_up):
+    """Returns the confidence that a colour is more frequent than another
+
+    The units, tiles or blocks of an image, are the samples: the mean
+    difference of the fractions of their pixels each colour covers is
+    divided by its standard error, and the one sided probability of
+    the normal distribution is returned.
+
+    Parameters
+    ----------
+    leader: sequence of floats
+        fraction of each unit's pixels of the leading colour
+    runner_up: sequence of floats
+        fraction of each unit's pixels of the runner-up
+
+    Returns
+    -------
+    float
+        between 0 and 1, 0.5 if the units can't tell the colours apart
+    """
+    diff = np.asarray(leader, dtype=float) - np.asarray(runner_up, dtype=float)
+    if len(diff) < 2:
+        return 0.5
+    mean = diff.mean()
+    error = diff.std(ddof=1) / math.sqrt(len(diff))
+    if error == 0:
+        return 1.0 if mean > 0 else 0.0 if mean < 0 else 0.5
+    return 0.5 * (1 + math.erf(mean / error / math.sqrt(2)))
+
+
+def tile_separation(rgb, colors, tiles=8):
+    """Returns the separation of two colours over tiles of an image
+
+    Parameters
+    ----------
+    rgb: ndarray
+        (rows, cols, depth) image
+    colors: ndarray
+        (2, depth) leading and runner-up colours, or (1, depth) if the
+        image has a single colour
+    tiles: integer
+        the image is split in up to tiles x tiles tiles
+
+    Returns
+    -------
+    float, see separation
+    """
+    rows, cols, depth = rgb.shape
+    if len(colors) < 2:
+        return 1.0
+    keys = pack_pixels(rgb.reshape(rows * cols, depth)).reshape(rows, cols)
+    wanted = pack_pixels(np.asarray(colors, dtype=rgb.dtype).reshape(-1, depth))
+
+    row_starts = np.unique(np.linspace(0, rows, min(tiles, rows) + 1).astype(int))
+    col_starts = np.unique(np.linspace(0, cols, min(tiles, cols) + 1).astype(int))
+    sizes = np.outer(np.diff(row_starts), np.diff(col_starts)).ravel()
+
+    fractions = []
+    for key in wanted[:2]:
+        counts = np.add.reduceat(keys == key, row_starts[:-1], axis=0)
+        counts = np.add.reduceat(counts, col_starts[:-1], axis=1)
+        fractions.append(counts.ravel() / sizes)
+    return separation(*fractions)
+
+
+def block_windows(src, seed=0, strata=4, border_weight=4):
+    """Returns the blocks of a dataset in stratified random order
+
+    The grid of blocks is split into strata x strata cells. Each round
+    takes one block of every cell, in random order, so any number of
+    first blocks is spread over the image. Blocks along the edges of
+    the dataset, where nodata collars are, are border_weight times as
+    likely to be taken first within their cell.
+
+    Parameters
+    ----------
+    src: rasterio dataset opened in "r" mode
+    seed: integer
+    strata: integer
+    border_weight: number
+
+    Returns
+    -------
+    list of Window objects
+    """
+    block_rows, block_cols = src.block_shapes[0]
+    n_rows = -(-src.height // block_rows)
+    n_cols = -(-src.width // block_cols)
+    rows, cols = np.divmod(np.arange(n_rows * n_cols), n_cols)
+    border = (rows == 0) | (rows == n_rows - 1) | (cols == 0) | (cols == n_cols - 1)
+
+    rng = np.random.RandomState(seed)
+    # Weighted order without replacement within cells, by exponential keys
+    keys = rng.exponential(size=rows.size) / np.where(border, border_weight, 1.0)
+    cells = (rows * min(strata, n_rows) // n_rows) * strata + (
+        cols * min(strata, n_cols) // n_cols
+    )
+    order = np.lexsort((keys, cells))
+    first = np.searchsorted(cells[order], cells[order])
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order)) - first
+    order = np.lexsort((rng.random_sample(rows.size), rank))
+
+    return [
+        Window(
+            col * block_cols,
+            row * block_rows,
+            min(block_cols, src.width - col * block_cols),
+            min(block_rows, src.height - row * block_rows),
+        )
+        for row, col in zip(rows[order], cols[order])
+    ]
+
+
+class _ColorCounts(object):
+    """Counts per colour merged from blocks, in key order"""
+
+    def __init__(self, depth, dtype):
+        self.keys = pack_pixels(np.empty((0, depth), dtype=dtype))
+        self.colors = np.empty((0, depth), dtype=dtype)
+        self.counts = np.empty(0, dtype=np.intp)
+        self.longest = np.empty(0, dtype=np.intp)
+
+    def add(self, colors, counts, longest=None):
+        if longest is None:
+            longest = np.zeros(len(counts), dtype=np.intp)
+        keys = np.concatenate((self.keys, pack_pixels(colors)))
+        colors = np.concatenate((self.colors, colors))
+        counts = np.concatenate((self.counts, counts))
+        longest = np.concatenate((self.longest, longest))
+
+        self.keys, index, inverse = np.unique(
+            keys, return_index=True, return_inverse=True
+        )
+        self.colors = colors[index]
+        self.counts = np.bincount(inverse, weights=counts).astype(np.intp)
+        self.longest = np.zeros(len(index), dtype=np.intp)
+        np.maximum.at(self.longest, inverse, longest)
+
+    def count(self, color):
+        """Returns the count of a colour"""
+        key = pack_pixels(np.asarray([color], dtype=self.colors.dtype))[0]
+        index = np.searchsorted(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            return int(self.counts[index])
+        return 0
+
+
+class BlockSampler(object):
+    """Accumulates the discovery statistics of blocks as they are read
+
+    The colour histogram, the runs of continuous pixels along rows and
+    columns, and the fractions of pixels of each block's most frequent
+    colours, which measure how well the leading colour is separated
+    from the runner-up, are updated with each block.
+
+    Parameters
+    ----------
+    depth: integer
+        number of bands
+    dtype: string or dtype
+    top: integer
+        number of colours kept per block to measure separation. Counts
+        of other colours in a block are taken as 0.
+    """
+
+    def __init__(self, depth, dtype, top=16):
+        """Starts with no block added"""
+        self.histogram = _ColorCounts(depth, dtype)
+        self.row_runs = _ColorCounts(depth, dtype)
+        self.col_runs = _ColorCounts(depth, dtype)
+        self.top = top
+        self.blocks = []
+        self.pixels = 0
+
+    def add(self, rgb):
+        """Adds a (rows, cols, depth) block"""
+        rows, cols, depth = rgb.shape
+        colors, counts = color_histogram(rgb.reshape(rows * cols, depth))
+        self.histogram.add(colors, counts)
+        self.row_runs.add(*_find_runs(rgb, 1))
+        self.col_runs.add(*_find_runs(rgb, 0))
+
+        top = np.argsort(-counts, kind="stable")[: self.top]
+        fractions = counts[top] / float(rows * cols)
+        self.blocks.append(dict(zip(pack_pixels(colors[top]).tolist(), fractions)))
+        self.pixels += rows * cols
+
+    def leaders(self, k=2):
+        """Returns the k most frequent colours, lowest first on ties"""
+        order = np.argsort(-self.histogram.counts, kind="stable")[:k]
+        return self.histogram.colors[order]
+
+    def continuous(self):
+        """Returns the colour with the most continuous pixels along
+        rows, then the longest run, then the lowest, or None"""
+        runs = self.row_runs
+        if not len(runs.counts):
+            return None
+        return runs.colors[np.lexsort((-runs.longest, -runs.counts))[0]]
+
+    @property
+    def confidence(self):
+        """The separation of the leading colour from the runner-up"""
+        colors = self.leaders()
+        if len(colors) < 2:
+            return 1.0 if len(self.blocks) > 1 else 0.5
+        keys = pack_pixels(colors).tolist()
+        return separation(
+            [block.get(keys[0], 0) for block in self.blocks],
+            [block.get(keys[1], 0) for block in self.blocks],
+        )
@@ -1,18 +1,57 @@
-"""rio-alpha command."""
+"""rio-alpha command.
 
+rio imports this module to list its plugins on every run, so the
+modules doing the work, and scipy or rio-mucho with them, are only
+imported by the command that runs.
+"""
+
+from functools import partial
+import json
 import logging
 import click
 
 import rasterio as rio
-from rio_alpha.utils import _parse_ndv
-from rio_alpha.islossy import count_ndv_regions
-from rio_alpha.findnodata import determine_nodata
-from rio_alpha.alpha import add_alpha
 from rasterio.rio.options import creation_options
 
 logger = logging.getLogger("rio_alpha")
 
 
+def _memory_callback(ctx, param, value, split=False):
+    """Parses a --max-memory value into bytes
+
+    With split, the budget must be large enough to be shared between
+    arrays and GDAL's block cache, see utils._split_memory.
+    """
+    if value is None:
+        return None
+    from rio_alpha.utils import _parse_memory, _split_memory
+
+    try:
+        max_memory = _parse_memory(value)
+        if split:
+            _split_memory(max_memory)
+        elif max_memory < 1:
+            raise ValueError("max_memory must be positive, not {!r}".format(value))
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+    return max_memory
+
+
+def _filters_callback(ctx, param, values):
+    """Parses --filter values into (name, size) tuples, None if none"""
+    from rio_alpha.filters import _check_filter
+    from rio_alpha.utils import _parse_filter
+
+    filters = []
+    try:
+        for value in values:
+            filters.append(_parse_filter(value))
+            _check_filter(*filters[-1])
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+    return filters or None
+
+
 @click.command("islossy")
 @click.argument("input", nargs=1, type=click.Path(exists=True))
 @click.option(
@@ -23,24 +62,43 @@ logger = logging.getLogger("rio_alpha")
     "a string representation of a list containing "
     "per-band nodata values (e.g. '[255, 255, 255]').",
 )
-def islossy(input, ndv):
+@click.option(
+    "--max-memory",
+    default=None,
+    callback=partial(_memory_callback, split=True),
+    help="Memory budget, in bytes or with a K, M or G suffix (e.g. '512M'), "
+    "of at least 1M. A quarter of it caches GDAL blocks. Regions are "
+    "counted in smaller windows to fit, and the image is decimated if a row "
+    "doesn't, with a warning.",
+)
+def islossy(input, ndv, max_memory):
     """
     Determine if there are >= 10 nodata regions in an image
     If true, returns the string `--lossy lossy`.
     """
-    with rio.open(input, "r") as src:
-        img = src.read()
+    from rio_alpha.islossy import count_ndv_regions_windowed, plan_region_windows
+    from rio_alpha.utils import _parse_ndv, _split_memory
 
     ndv = _parse_ndv(ndv, 3)
 
-    if count_ndv_regions(img, ndv) >= 10:
+    env = {}
+    if max_memory:
+        max_memory, env["GDAL_CACHEMAX"] = _split_memory(max_memory)
+
+    with rio.Env(**env), rio.open(input, "r") as src:
+        windows, factor = plan_region_windows(src, max_memory)
+        regions = count_ndv_regions_windowed(
+            src, ndv, threshold=10, windows=windows, factor=factor
+        )
+
+    if regions >= 10:
         click.echo("True")
     else:
         click.echo("False")
 
 
 @click.command("findnodata")
-@click.argument("src_path", type=click.Path(exists=True))
+@click.argument("src_path", type=click.Path(exists=True), required=False)
 @click.option(
     "--user_nodata",
     "-u",
@@ -71,15 +129,122 @@ def islossy(input, ndv):
     default=False,
     help="Prints extra information, " "like competing candidate values",
 )
-def findnodata(src_path, user_nodata, discovery, debug, verbose):
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory where discovery results are cached, keyed by the "
+    "content of the dataset (default: ~/.cache/rio-alpha).",
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    default=False,
+    help="Always run discovery, without reading or writing the cache.",
+)
+@click.option(
+    "--max-memory",
+    default=None,
+    callback=partial(_memory_callback, split=True),
+    help="Memory budget, in bytes or with a K, M or G suffix (e.g. '512M'), "
+    "of at least 1M. A quarter of it caches GDAL blocks. The discovery "
+    "sample is decimated further if it doesn't fit, with a warning. With "
+    "--recursive, the budget of each worker.",
+)
+@click.option(
+    "--sampler",
+    type=click.Choice(["grid", "blocks"]),
+    default="grid",
+    help="How discovery samples the dataset: grid reads a decimated image, "
+    "blocks reads blocks in stratified random order, more of them along the "
+    "edges, until the nodata candidate stands out, often after a handful. "
+    "The confidence of the candidate is logged at INFO level.",
+)
+@click.option(
+    "--recursive",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help="Find the nodata value of each raster under this directory instead "
+    "of SRC_PATH, writing a JSON line per file with its value, the method "
+    "that found it and timing as soon as it is done.",
+)
+@click.option(
+    "--workers",
+    "-j",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of processes --recursive runs files in.",
+)
+def findnodata(
+    src_path,
+    user_nodata,
+    discovery,
+    debug,
+    verbose,
+    cache_dir,
+    no_cache,
+    max_memory,
+    sampler,
+    recursive,
+    workers,
+):
     """Print a dataset's nodata value."""
-    ndv = determine_nodata(src_path, user_nodata, discovery, debug, verbose)
+    from rio_alpha.cache import DiscoveryCache
+    from rio_alpha.findnodata import determine_nodata, find_rasters, scan_nodata
+    from rio_alpha.utils import _split_memory
+
+    cache = None if no_cache else DiscoveryCache(cache_dir)
+    if debug and sampler != "grid":
+        raise click.UsageError("--debug requires --sampler grid")
+
+    if recursive:
+        if src_path:
+            raise click.UsageError("SRC_PATH can't be given with --recursive")
+        if debug or verbose:
+            raise click.UsageError(
+                "--debug and --verbose are not supported with --recursive"
+            )
+        failed = total = 0
+        for record in scan_nodata(
+            find_rasters(recursive),
+            workers,
+            user_nodata=user_nodata,
+            discovery=discovery,
+            cache=cache,
+            max_memory=max_memory,
+            sampler=sampler,
+        ):
+            total += 1
+            failed += record["status"] != "ok"
+            click.echo(json.dumps(record))
+        if failed:
+            raise click.ClickException("{0} of {1} files failed".format(failed, total))
+        return
+
+    if not src_path:
+        raise click.UsageError("SRC_PATH is required without --recursive")
+
+    env = {}
+    if max_memory:
+        max_memory, env["GDAL_CACHEMAX"] = _split_memory(max_memory)
+
+    with rio.Env(**env):
+        ndv = determine_nodata(
+            src_path,
+            user_nodata,
+            discovery,
+            debug,
+            verbose,
+            cache,
+            max_memory,
+            sampler,
+        )
     click.echo("%s" % ndv)
 
 
 @click.command("alpha")
-@click.argument("src_path", type=click.Path(exists=True))
-@click.argument("dst_path", type=click.Path(exists=False))
+@click.argument("src_path", type=click.Path(exists=True), required=False)
+@click.argument("dst_path", type=click.Path(exists=False), required=False)
 @click.option(
     "--ndv",
     default=None,
@@ -88,18 +253,234 @@ def findnodata(src_path, user_nodata, discovery, debug, verbose):
     "a string representation of a list containing "
     "per-band nodata values (e.g. '[255, 255, 255]').",
 )
+@click.option(
+    "--tolerance",
+    type=click.FloatRange(min=0),
+    default=None,
+    help="Also mask pixels whose bands are all within this distance of the "
+    "nodata value, like the ones lossy compression leaves around it.",
+)
+@click.option(
+    "--filter",
+    "filters",
+    multiple=True,
+    callback=_filters_callback,
+    help="Clean up the mask with a filter, given as NAME:SIZE, in the order "
+    "given: open:RADIUS removes valid specks and fringes, close:RADIUS fills "
+    "nodata pinholes and sieve:AREA removes regions of fewer pixels. Windows "
+    "are read with the overlap the filters need, so the mask has no seams.",
+)
 @click.option("--workers", "-j", type=int, default=1)
+@click.option(
+    "--mask-mode",
+    type=click.Choice(["band", "internal", "sidecar"]),
+    default="band",
+    help="Write the alpha as a 4th band (default), as a 1-bit internal "
+    "GDAL mask or as a 1-bit GDAL mask in a .msk sidecar file.",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["processes", "threads", "serial", "pipeline"]),
+    default=None,
+    help="Run workers as processes (default) or threads, process "
+    "windows serially, or overlap reading, masking by the workers and "
+    "writing in a pipeline. The output is the same.",
+)
+@click.option(
+    "--in-flight",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Maximum number of windows held in memory at once by the threads, "
+    "pipeline and processes engines. Defaults to 2 per worker plus 1.",
+)
+@click.option(
+    "--max-memory",
+    default=None,
+    callback=_memory_callback,
+    help="Memory budget for the windows held at once, in bytes or with a "
+    "K, M or G suffix (e.g. '512M'). Block aligned windows are merged "
+    "into larger ones up to it.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Print the window plan and its estimated peak memory as JSON, "
+    "without writing the output.",
+)
+@click.option(
+    "--auto",
+    is_flag=True,
+    default=False,
+    help="Discover the nodata value from a decimated sample, then add the "
+    "alpha and count nodata regions in a single pass. Prints the nodata "
+    "value and lossy verdict as JSON and tags the output with them.",
+)
+@click.option(
+    "--batch",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Process the source and destination paths on each line of a "
+    "manifest file with a single pool of workers, instead of SRC_PATH "
+    "and DST_PATH.",
+)
+@click.option(
+    "--report",
+    type=click.File("w"),
+    default="-",
+    help="Where --batch writes a JSON line per file with its status and "
+    "timing (default: stdout).",
+)
+@click.option(
+    "--stats-out",
+    type=click.File("w"),
+    default=None,
+    help="Write the read, mask and write durations and bytes of the "
+    "windows, aggregated per stage and worker, to a JSON file. They are "
+    "also logged at debug level (rio -vv).",
+)
 @click.pass_context
 @creation_options
-def alpha(ctx, src_path, dst_path, ndv, creation_options, workers):
+def alpha(
+    ctx,
+    src_path,
+    dst_path,
+    ndv,
+    tolerance,
+    filters,
+    creation_options,
+    workers,
+    mask_mode,
+    engine,
+    in_flight,
+    max_memory,
+    dry_run,
+    auto,
+    batch,
+    report,
+    stats_out,
+):
     """Adds/replaced an alpha band to your RGB or RGBA image
 
     If you don't supply ndv, the alpha mask will be infered.
     """
+    from rio_alpha.alpha import _min_memory, add_alpha, add_alpha_many, plan_alpha
+    from rio_alpha.auto import auto_alpha
+    from rio_alpha.stats import StageStats
+    from rio_alpha.utils import _parse_manifest, _parse_ndv
+
+    stats = None
+    if stats_out or logging.getLogger("rio_alpha.stats").isEnabledFor(logging.DEBUG):
+        stats = StageStats()
+
+    if tolerance is not None and not ndv and not auto:
+        raise click.UsageError("--tolerance requires --ndv or --auto")
+
+    if batch:
+        if stats_out:
+            raise click.UsageError("--stats-out is not supported with --batch")
+        if auto:
+            raise click.UsageError("--auto is not supported with --batch")
+        if engine:
+            raise click.UsageError("--engine is not supported with --batch")
+        if dry_run:
+            raise click.UsageError("--dry-run is not supported with --batch")
+        if src_path or dst_path:
+            raise click.UsageError("SRC_PATH and DST_PATH can't be given with --batch")
+        with open(batch) as f:
+            jobs = _parse_manifest(f)
+        failed = 0
+        for record in add_alpha_many(
+            jobs,
+            ndv,
+            creation_options,
+            workers,
+            mask_mode=mask_mode,
+            in_flight=in_flight,
+            max_memory=max_memory,
+            tolerance=tolerance,
+            filters=filters,
+        ):
+            failed += record["status"] != "ok"
+            report.write(json.dumps(record) + "\n")
+            report.flush()
+        if failed:
+            raise click.ClickException(
+                "{0} of {1} files failed".format(failed, len(jobs))
+            )
+        return
+
+    if not src_path or not dst_path:
+        raise click.UsageError("SRC_PATH and DST_PATH are required without --batch")
+    engine = engine or "processes"
+
+    if auto and ndv:
+        raise click.UsageError("--auto discovers the nodata value, drop --ndv")
+    if auto and dry_run:
+        raise click.UsageError("--dry-run is not supported with --auto")
+
     with rio.open(src_path) as src:
         band_count = src.count
+        dtype = src.dtypes[0]
+
+    min_memory = _min_memory(dtype, engine, workers, in_flight)
+    if max_memory and max_memory < min_memory:
+        raise click.BadParameter(
+            "{} bytes can't hold a pixel of {}, at least {} are needed".format(
+                max_memory, src_path, min_memory
+            ),
+            param_hint="'--max-memory'",
+        )
 
     if ndv:
         ndv = _parse_ndv(ndv, band_count)
 
-    add_alpha(src_path, dst_path, ndv, creation_options, workers)
+    if dry_run:
+        plan = plan_alpha(
+            src_path,
+            creation_options,
+            workers,
+            mask_mode=mask_mode,
+            engine=engine,
+            in_flight=in_flight,
+            max_memory=max_memory,
+        )
+        click.echo(json.dumps(plan))
+        return
+
+    if auto:
+        try:
+            verdict = auto_alpha(
+                src_path,
+                dst_path,
+                creation_options,
+                workers,
+                mask_mode=mask_mode,
+                engine=engine,
+                in_flight=in_flight,
+                max_memory=max_memory,
+                stats=stats,
+                tolerance=tolerance,
+                filters=filters,
+            )
+        except ValueError as err:
+            raise click.ClickException(str(err))
+        click.echo(json.dumps(verdict))
+    else:
+        add_alpha(
+            src_path,
+            dst_path,
+            ndv,
+            creation_options,
+            workers,
+            mask_mode=mask_mode,
+            engine=engine,
+            in_flight=in_flight,
+            max_memory=max_memory,
+            stats=stats,
+            tolerance=tolerance,
+            filters=filters,
+        )
+
+    if stats_out:
+        json.dump(stats.to_dict(), stats_out, indent=2)
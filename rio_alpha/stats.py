@@ -0,0 +1,142 @@
+"""Per stage timing of alpha runs."""
+
+from bisect import bisect_left
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the duration histogram buckets, 100us
+# doubling up to about 52s, and a last bucket for anything longer
+BUCKETS = [1e-4 * 2**i for i in range(20)]
+
+
+def _worker_id():
+    """Returns "pid/thread name" of the calling worker"""
+    return "%d/%s" % (os.getpid(), threading.current_thread().name)
+
+
+def _timed(timings, stage, nbytes, func, *args):
+    """Calls func(*args), appending its duration to timings if not None
+
+    timings gets a (stage, seconds, nbytes, worker) tuple, where worker
+    is the _worker_id() of the caller.
+    """
+    if timings is None:
+        return func(*args)
+    start = time.perf_counter()
+    result = func(*args)
+    timings.append((stage, time.perf_counter() - start, nbytes, _worker_id()))
+    return result
+
+
+class StageStats(object):
+    """Aggregates the per window durations and bytes of each stage
+
+    Stages are "read", "mask" and "write". Each one keeps its totals, a
+    histogram of durations and totals per worker, never the individual
+    records. Records are also logged at DEBUG level by the
+    rio_alpha.stats logger, with the fields of the record as extra
+    attributes of the log record.
+    """
+
+    def __init__(self):
+        """Starts the wall clock, with no stage recorded"""
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, nbytes, worker, window=None):
+        """Adds one window's duration and bytes for a stage
+
+        Parameters
+        ----------
+        stage: string
+        seconds: float
+        nbytes: integer
+        worker: string
+        window: Window object, optional
+        """
+        with self._lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = {
+                    "count": 0,
+                    "seconds": 0.0,
+                    "bytes": 0,
+                    "min": seconds,
+                    "max": seconds,
+                    "histogram": [0] * (len(BUCKETS) + 1),
+                    "workers": OrderedDict(),
+                }
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            totals["bytes"] += nbytes
+            totals["min"] = min(totals["min"], seconds)
+            totals["max"] = max(totals["max"], seconds)
+            totals["histogram"][bisect_left(BUCKETS, seconds)] += 1
+            count, total = totals["workers"].get(worker, (0, 0.0))
+            totals["workers"][worker] = (count + 1, total + seconds)
+
+        if log.isEnabledFor(logging.DEBUG):
+            fields = {
+                "stage": stage,
+                "seconds": seconds,
+                "bytes": nbytes,
+                "worker": worker,
+                "window": None,
+            }
+            if window is not None:
+                fields["window"] = [
+                    int(window.col_off),
+                    int(window.row_off),
+                    int(window.width),
+                    int(window.height),
+                ]
+            log.debug(
+                "%s of window %s took %.6fs for %d bytes in %s",
+                stage,
+                fields["window"],
+                seconds,
+                nbytes,
+                worker,
+                extra=fields,
+            )
+
+    def record_all(self, timings, window=None):
+        """Adds the (stage, seconds, nbytes, worker) tuples of a window"""
+        for stage, seconds, nbytes, worker in timings:
+            self.record(stage, seconds, nbytes, worker, window)
+
+    def to_dict(self):
+        """Returns the statistics as a JSON serializable dict
+
+        "seconds" is the wall time since the statistics were created,
+        "stages" holds for each stage its "count" of windows, the total
+        "seconds" and "bytes", the "min" and "max" window duration, a
+        "histogram" of durations as "bounds" in seconds and "counts"
+        with one more count for longer durations, and per "workers"
+        their window "count" and "seconds".
+        """
+        with self._lock:
+            stages = OrderedDict()
+            for stage, totals in self.stages.items():
+                stages[stage] = {
+                    "count": totals["count"],
+                    "seconds": totals["seconds"],
+                    "bytes": totals["bytes"],
+                    "min": totals["min"],
+                    "max": totals["max"],
+                    "histogram": {
+                        "bounds": BUCKETS,
+                        "counts": list(totals["histogram"]),
+                    },
+                    "workers": OrderedDict(
+                        (worker, {"count": count, "seconds": seconds})
+                        for worker, (count, seconds) in totals["workers"].items()
+                    ),
+                }
+            return {"seconds": time.perf_counter() - self.start, "stages": stages}
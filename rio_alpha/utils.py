@@ -6,7 +6,10 @@ import math
 import re
 
 import numpy as np
-from scipy.stats import mode
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from rio_alpha.histogram import count_colors, pack_pixels, top_colors
 
 
 def _parse_single(n):
@@ -54,17 +57,148 @@ def _parse_ndv(ndv, bands):
         return [_parse_single(ndv) for i in range(bands)]
 
 
-def _convert_rgb(rgb_orig):
-    # Sample to ~200 in smaller dimension if > 200 for performance
-    if rgb_orig[:, :, 0].shape[0] < rgb_orig[:, :, 0].shape[1]:
-        min_dimension = 0
-    else:
-        min_dimension = 1
+def _parse_memory(value):
+    """Returns a number of bytes
+
+    Parameters
+    ----------
+    value: string, an integer number of bytes, optionally followed by
+        a K, M or G (binary) unit, e.g. '512M'
+
+    Returns
+    -------
+    integer
+    """
+    match = re.match(r"^\s*(\d+)\s*([KMG]?)i?B?\s*$", value, re.IGNORECASE)
+    if not match:
+        raise ValueError("{0} is not a memory size like 512M or 2G".format(value))
+    number, unit = match.groups()
+    return int(number) * 1024 ** "BKMG".index(unit.upper() or "B")
+
+
+def _split_memory(max_memory):
+    """Returns the (arrays, GDAL block cache) shares of a memory budget
+
+    GDAL gets a quarter of it to cache the blocks it decodes, and the
+    arrays the rest.
+
+    Parameters
+    ----------
+    max_memory: integer, at least 1M
+
+    Returns
+    -------
+    (integer, integer) tuple of bytes
+    """
+    if max_memory < 1024**2:
+        raise ValueError("max_memory must be at least 1M, not {!r}".format(max_memory))
+    cache = max_memory // 4
+    return max_memory - cache, cache
+
+
+def _parse_filter(value):
+    """Returns the (name, size) of a mask filter
+
+    Parameters
+    ----------
+    value: string, a filter name and a positive integer size
+        separated by a colon, e.g. 'sieve:16'
+
+    Returns
+    -------
+    (string, integer) tuple
+    """
+    match = re.match(r"^\s*([a-z]+)\s*:\s*(\d+)\s*$", value, re.IGNORECASE)
+    if not match:
+        raise ValueError("{0} is not a filter like open:1 or sieve:16".format(value))
+    name, size = match.groups()
+    return name.lower(), int(size)
+
+
+def _parse_manifest(lines):
+    """Returns the (src_path, dst_path) pairs of a batch manifest
+
+    Each line holds a source and a destination path, separated by a
+    tab, or by whitespace if there is no tab. Blank lines and lines
+    starting with # are skipped.
+
+    Parameters
+    ----------
+    lines: iterable of strings
+
+    Returns
+    -------
+    list of (src_path, dst_path) tuples
+    """
+    jobs = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        paths = line.split("\t") if "\t" in line else line.split()
+        if len(paths) != 2:
+            raise ValueError(
+                "Line {0} of the manifest does not hold a source "
+                "and a destination path: {1}".format(number, line)
+            )
+        jobs.append(tuple(path.strip() for path in paths))
+    return jobs
 
-    if rgb_orig[:, :, 0].shape[min_dimension] < 200:
-        mod = 1
+
+def _sample_factor(rows, cols, size=200):
+    """Returns the decimation factor that samples the smaller
+    dimension of a (rows, cols) image to ~size pixels
+
+    Parameters
+    ----------
+    rows: integer
+    cols: integer
+    size: integer, target length of the smaller dimension
+
+    Returns
+    -------
+    integer, 1 if the smaller dimension is already < size
+
+    """
+    min_dimension = min(rows, cols)
+    if min_dimension < size:
+        return 1
     else:
-        mod = int(math.ceil(rgb_orig[:, :, 0].shape[min_dimension] / 200))
+        return int(math.ceil(min_dimension / size))
+
+
+def _read_sample(src, size=200, factor=None):
+    """Returns a decimated sample of a dataset for nodata discovery
+
+    The sample is read at its target shape, so GDAL serves it from
+    overviews when they exist and never materializes the full
+    resolution raster.
+
+    Parameters
+    ----------
+    src: rasterio dataset opened in "r" mode
+    size: integer, target length of the smaller dimension
+    factor: integer, optional, decimation factor used instead of the
+        one sampling to size
+
+    Returns
+    -------
+    ndarray of shape (rows, cols, depth)
+
+    """
+    mod = factor or _sample_factor(src.height, src.width, size)
+    out_shape = (
+        src.count,
+        int(math.ceil(src.height / mod)),
+        int(math.ceil(src.width / mod)),
+    )
+    data = src.read(out_shape=out_shape, resampling=Resampling.nearest)
+    return np.rollaxis(data, 0, 3)
+
+
+def _convert_rgb(rgb_orig):
+    # Sample to ~200 in smaller dimension if > 200 for performance
+    mod = _sample_factor(rgb_orig.shape[0], rgb_orig.shape[1])
 
     rgb_mod = rgb_orig[::mod, ::mod]
     # Flatten image for full img histogram
@@ -75,49 +209,170 @@ def _convert_rgb(rgb_orig):
     return rgb_mod, rgb_mod_flat
 
 
-# Squish array to only continuous values, return is in list form
+def _continuous_mask(input_array, axis_num):
+    """Returns a (rows, cols) mask of pixels equal to their predecessor
+
+    Parameters
+    ----------
+    input_array: ndarray
+        (rows, cols, depth) array
+    axis_num: integer, 0 to compare along columns, 1 along rows
+
+    Returns
+    -------
+    ndarray of booleans, False for the first pixel of each line
+
+    """
+    rows, cols, depth = input_array.shape
+    keys = pack_pixels(input_array.reshape(rows * cols, depth)).reshape(rows, cols)
+    mask = np.zeros((rows, cols), dtype=bool)
+    if int(axis_num) == 0:
+        np.equal(keys[1:], keys[:-1], out=mask[1:])
+    else:
+        np.equal(keys[:, 1:], keys[:, :-1], out=mask[:, 1:])
+    return mask
+
+
+# Squish array to only continuous pixels, returns (n, depth) array
 def _find_continuous_rgb(input_array, axis_num):
-    diff_array = np.diff(input_array, axis=int(axis_num))
-    diff_array = np.insert(diff_array, 0, [99, 99, 99], axis=int(axis_num))
-    val_list = (input_array[diff_array == [0, 0, 0]]).tolist()
-    return val_list
+    return input_array[_continuous_mask(input_array, axis_num)]
+
+
+def _find_runs(input_array, axis_num):
+    """Returns run-length statistics of continuous pixels
+
+    A run is a line of two or more equal pixels along the axis.
+
+    Parameters
+    ----------
+    input_array: ndarray
+        (rows, cols, depth) array
+    axis_num: integer, 0 to find runs along columns, 1 along rows
+
+    Returns
+    -------
+    colors: ndarray
+        (m, depth) array of the colors having at least one run
+    counts: ndarray
+        (m,) number of continuous pixels of each color
+    longest: ndarray
+        (m,) length of the longest run of each color
+
+    """
+    # Lay lines out along the last axis so runs are contiguous in memory
+    lines = np.moveaxis(input_array, int(axis_num), 1)
+    n_lines, length, depth = lines.shape
+    pixels = lines.reshape(n_lines * length, depth)
+    keys = pack_pixels(pixels).reshape(n_lines, length)
+
+    starts = np.ones((n_lines, length), dtype=bool)
+    np.not_equal(keys[:, 1:], keys[:, :-1], out=starts[:, 1:])
+    starts = starts.ravel()
+
+    run_lengths = np.diff(np.append(np.flatnonzero(starts), starts.size))
+    runs = run_lengths > 1
+    run_lengths = run_lengths[runs]
+    run_keys = keys.ravel()[starts][runs]
+
+    _, first, inverse = np.unique(run_keys, return_index=True, return_inverse=True)
+    colors = pixels[np.flatnonzero(starts)[runs][first]]
+    counts = np.bincount(inverse, weights=run_lengths - 1).astype(np.intp)
+    longest = np.zeros(len(first), dtype=np.intp)
+    np.maximum.at(longest, inverse, run_lengths)
+
+    return colors, counts, longest
 
 
 # Find modal RGB value of continuous values array
 # (val_list), takes list, returns [R,G,B]
 def _group(lst, n, continuous):
-    arr = np.asarray(list(zip(*[lst[i::n] for i in range(n)])))
-    mode_vals = mode(arr)
-    continuous = [int((mode_vals[0])[0, i]) for i in range(3)]
+    arr = np.asarray(list(zip(*[lst[i::n] for i in range(n)]))).reshape(-1, n)
+    colors, _ = top_colors(arr)
+    continuous = [int(v) for v in colors[0][:3]]
     return continuous, arr
 
 
 def _compute_continuous(rgb_mod, loc):
-    cont_lst = []
-    return _group(_find_continuous_rgb(rgb_mod, loc), 3, cont_lst)
+    colors, counts, longest = _find_runs(rgb_mod, loc)
+    # Most continuous pixels first, then longest run, then lowest color
+    best = np.lexsort((-longest, -counts))[0]
+    continuous = [int(v) for v in colors[best][:3]]
+    return continuous, _find_continuous_rgb(rgb_mod, loc)
+
+
+def _read_edges(src, factor=1):
+    """Returns the pixels of the first and last rows and columns of a
+    dataset, read at full resolution
 
+    Only the blocks along the edges are read. The columns of a dataset
+    stored in full width strips are read every factor rows, so that
+    only the strips the discovery sample is read from are decoded.
+
+    Parameters
+    ----------
+    src: rasterio dataset opened in "r" mode
+    factor: integer, decimation factor of the discovery sample
 
-def _search_image_edge(rgb_mod, candidate_original, candidate_continuous):
-    # Make array of image edge
-    top_row = rgb_mod[0, :, :]
-    bottom_row = rgb_mod[-1, :, :]
-    first_col = rgb_mod[:, 0, :]
-    last_col = rgb_mod[:, -1, :]
-    img_edge = np.concatenate((top_row, last_col, bottom_row, first_col), axis=0)
+    Returns
+    -------
+    ndarray of shape (pixels, depth), in the order _search_image_edge
+    concatenates the edges of an image
+    """
+    height, width = src.height, src.width
+    rows = height
+    if src.block_shapes[0][1] >= width:
+        rows = int(math.ceil(height / factor))
+
+    def read(window, out_rows, out_cols):
+        data = src.read(
+            window=window,
+            out_shape=(src.count, out_rows, out_cols),
+            resampling=Resampling.nearest,
+        )
+        return data.reshape(src.count, -1).T
+
+    return np.concatenate(
+        (
+            read(Window(0, 0, width, 1), 1, width),
+            read(Window(width - 1, 0, 1, height), rows, 1),
+            read(Window(0, height - 1, width, 1), 1, width),
+            read(Window(0, 0, 1, height), rows, 1),
+        ),
+        axis=0,
+    )
+
+
+def _search_image_edge(rgb_mod, candidate_original, candidate_continuous, edges=None):
+    """Counts the candidates along the image edge and in continuous pixels
+
+    Parameters
+    ----------
+    rgb_mod: ndarray
+        (rows, cols, depth) sample of the image
+    candidate_original: list
+    candidate_continuous: list
+    edges: ndarray, optional
+        (pixels, depth) edge pixels counted instead of the sample's,
+        see _read_edges
+
+    Returns
+    -------
+    counts of each candidate in the edge and in continuous pixels
+    """
+    if edges is None:
+        top_row = rgb_mod[0, :, :]
+        bottom_row = rgb_mod[-1, :, :]
+        first_col = rgb_mod[:, 0, :]
+        last_col = rgb_mod[:, -1, :]
+        edges = np.concatenate((top_row, last_col, bottom_row, first_col), axis=0)
 
     # Squish image edge down to just continuous values
     edge_mode_continuous, arr = _compute_continuous(rgb_mod, 0)
 
     # Count nodata value frequency in full image edge & squished image edge
-    count_img_edge_full = [
-        len(np.transpose(np.where((img_edge == candidate).all(axis=1))))
-        for candidate in (candidate_original, candidate_continuous)
-    ]
-
-    count_img_edge_continuous = [
-        len(np.transpose(np.where((arr == candidate).all(axis=1))))
-        for candidate in (candidate_original, candidate_continuous)
-    ]
+    candidates = (candidate_original, candidate_continuous)
+    count_img_edge_full = count_colors(edges, candidates)
+    count_img_edge_continuous = count_colors(arr, candidates)
 
     return count_img_edge_full, count_img_edge_continuous
 
@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmpdir, monkeypatch):
+    """Keeps the discovery cache of tests out of the user's home"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir.join("cache")))
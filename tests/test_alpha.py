@@ -1,10 +1,26 @@
+import os
+
 from affine import Affine
 import click
 import pytest
 import numpy as np
 import rasterio as rio
 from rasterio.warp import reproject, Resampling
-from rio_alpha.alpha import add_alpha
+from rasterio.windows import Window
+from rio_alpha.alpha import (
+    BATCH_MEMORY,
+    _in_order,
+    _run_windows,
+    add_alpha,
+    add_alpha_many,
+    alpha_worker,
+    estimate_memory,
+    plan_alpha,
+    plan_windows,
+)
+from rio_alpha.alpha_mask import mask_exact, mask_fuzzy
+from rio_alpha.filters import apply_filters, filter_halo
+from rio_alpha.stats import StageStats
 
 
 def affaux(up):
@@ -85,3 +101,452 @@ def test_add_alpha_no_photometric(test_var, capfd):
         with rio.open(expected_path) as expected:
             assert flex_compare(created.read(), expected.read())
             assert expected.profile.get("photometric") is None
+
+
+def test_add_alpha_internal_mask(test_var, tmpdir):
+    dst_path = str(tmpdir.join("alpha_internal_mask.tif"))
+    expected_path = "tests/expected/expected_alpha/" "320_ECW_UTM32-EUREF89.tiny.tif"
+
+    add_alpha(test_var[0], dst_path, [255, 255, 255], {}, 1, mask_mode="internal")
+
+    with rio.open(dst_path) as created:
+        with rio.open(expected_path) as expected:
+            assert created.count == 3
+            assert flex_compare(created.read(), expected.read(indexes=[1, 2, 3]))
+            assert flex_compare(created.dataset_mask(), expected.read(4))
+
+
+def test_add_alpha_mask_mode_invalid(test_var, tmpdir):
+    with pytest.raises(ValueError):
+        add_alpha(test_var[0], str(tmpdir.join("x.tif")), None, {}, 1, mask_mode="x")
+
+
+@pytest.mark.parametrize(
+    "src_path,ndv",
+    [
+        ("tests/fixtures/dk_all/320_ECW_UTM32-EUREF89.tiny.tif", [18, 51, 62]),
+        ("tests/fixtures/masks/internal_mask.tif", None),
+        ("tests/fixtures/landsat/LC80460272013104LGN01_l8sr.tif", [0, 0, 0, 0]),
+    ],
+)
+def test_alpha_worker_reuses_buffers(src_path, ndv):
+    window = Window(0, 0, 32, 16)
+    with rio.open(src_path) as src:
+        arr = src.read(window=window)
+        if ndv:
+            alpha = np.any(np.rollaxis(arr, 0, 3) != ndv, axis=2) * 255
+        else:
+            alpha = src.dataset_mask(window=window)
+
+        rgba = alpha_worker([src], window, None, {"ndv": ndv})
+        assert rgba.shape == (4, 16, 32)
+        # Planar, so that rasterio writes it without a copy
+        assert rgba.flags.c_contiguous
+        assert np.array_equal(rgba[:3], arr[:3])
+        assert np.array_equal(rgba[3], alpha)
+
+        again = alpha_worker([src], window, None, {"ndv": ndv})
+        assert np.shares_memory(rgba, again)
+        assert np.array_equal(again[3], alpha)
+
+        rgb, mask = alpha_worker(
+            [src], window, None, {"ndv": ndv, "mask_mode": "internal"}
+        )
+        assert np.array_equal(rgb, arr[:3])
+        assert mask.dtype == np.uint8
+        assert np.array_equal(mask, alpha)
+
+
+@pytest.mark.parametrize(
+    "src_path,ndv,mask_mode",
+    [
+        ("tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif", [0, 0, 0], "band"),
+        ("tests/fixtures/ca_chilliwack/2012_30cm_594_5450.tiny.tif", None, "band"),
+        ("tests/fixtures/masks/internal_mask.tif", None, "internal"),
+    ],
+)
+def test_add_alpha_engines_identical(src_path, ndv, mask_mode, tmpdir):
+    outputs = []
+    for engine, workers, in_flight in [
+        ("serial", 1, None),
+        ("processes", 2, None),
+        ("threads", 3, None),
+        ("pipeline", 1, None),
+        ("pipeline", 2, 1),
+    ]:
+        dst_path = str(tmpdir.join("{}_{}.tif".format(engine, workers)))
+        add_alpha(
+            src_path,
+            dst_path,
+            ndv,
+            {"compress": "deflate"},
+            workers,
+            mask_mode=mask_mode,
+            engine=engine,
+            in_flight=in_flight,
+        )
+        with open(dst_path, "rb") as f:
+            outputs.append(f.read())
+
+    assert all(output == outputs[0] for output in outputs[1:])
+
+
+def test_add_alpha_engine_invalid(test_var, tmpdir):
+    with pytest.raises(ValueError):
+        add_alpha(test_var[0], str(tmpdir.join("x.tif")), None, {}, 1, engine="x")
+
+
+@pytest.mark.parametrize("engine", ["threads", "pipeline"])
+def test_add_alpha_engine_must_be_3or4band(engine, tmpdir):
+    with pytest.raises(ValueError):
+        add_alpha(
+            "tests/fixtures/landsat/two_bands.tif",
+            str(tmpdir.join("x.tif")),
+            None,
+            {},
+            2,
+            engine=engine,
+        )
+
+
+def test_add_alpha_in_flight_invalid(test_var, tmpdir):
+    with pytest.raises(ValueError):
+        add_alpha(test_var[0], str(tmpdir.join("x.tif")), None, {}, 1, in_flight=0)
+
+
+def test_pipeline_compute_error(test_var, tmpdir, monkeypatch):
+    def fail(g_args, arr, alpha, halo=None):
+        raise RuntimeError("compute failed")
+
+    monkeypatch.setattr("rio_alpha.alpha._mask_bands", fail)
+    with pytest.raises(RuntimeError, match="compute failed"):
+        add_alpha(
+            test_var[1], str(tmpdir.join("x.tif")), [0, 0, 0], {}, 2, engine="pipeline"
+        )
+
+
+def test_pipeline_write_error(test_var):
+    with rio.open(test_var[1]) as src:
+        windows = [window for _, window in src.block_windows()]
+    written = []
+
+    def write(result, window):
+        written.append(window)
+        if len(written) == 3:
+            raise IOError("write failed")
+
+    with pytest.raises(IOError, match="write failed"):
+        _run_windows(test_var[1], {"ndv": [0, 0, 0]}, 2, windows, write, "pipeline", 2)
+    assert written == windows[:3]
+
+
+def test_in_order_limits_pending():
+    submitted = []
+
+    def submit(window):
+        submitted.append(window)
+        return window * 10
+
+    consumed = []
+    for window, result in _in_order(submit, range(10), 3):
+        assert len(submitted) - len(consumed) <= 3
+        assert result == window * 10
+        consumed.append(window)
+
+    assert consumed == list(range(10))
+
+
+@pytest.mark.parametrize("mask_mode", ["band", "internal"])
+def test_add_alpha_ring_uint16(mask_mode, tmpdir):
+    src_path = str(tmpdir.join("uint16.tif"))
+    data = np.random.RandomState(0).randint(0, 3, (4, 100, 120)).astype(np.uint16)
+    profile = dict(
+        driver="GTiff",
+        count=4,
+        dtype="uint16",
+        width=120,
+        height=100,
+        tiled=True,
+        blockxsize=32,
+        blockysize=32,
+    )
+    with rio.open(src_path, "w", **profile) as dst:
+        dst.write(data)
+
+    outputs = []
+    for engine, workers in [("serial", 1), ("processes", 3)]:
+        dst_path = str(tmpdir.join("{}.tif".format(engine)))
+        add_alpha(
+            src_path,
+            dst_path,
+            [0, 0, 0, 0],
+            {},
+            workers,
+            mask_mode=mask_mode,
+            engine=engine,
+        )
+        with open(dst_path, "rb") as f:
+            outputs.append(f.read())
+
+    assert outputs[0] == outputs[1]
+    with rio.open(dst_path) as created:
+        valid = np.any(data != 0, axis=0)
+        if mask_mode == "band":
+            assert np.array_equal(created.read(4) == 65535, valid)
+        else:
+            assert np.array_equal(created.dataset_mask() == 255, valid)
+
+
+def assert_covers(windows, height, width):
+    covered = np.zeros((height, width), dtype=np.uint8)
+    for w in windows:
+        covered[w.row_off : w.row_off + w.height, w.col_off : w.col_off + w.width] += 1
+    assert (covered == 1).all()
+
+
+@pytest.mark.parametrize(
+    "dst_block_shape,max_memory,shape",
+    [
+        (None, None, (256, 256)),
+        ((512, 512), None, (512, 512)),
+        ((1, 1958), None, (256, 1958)),
+        (None, 2**20, (256, 256)),
+        (None, 2**24, (768, 1958)),
+        ((512, 512), 2**16, (3, 1958)),
+    ],
+)
+def test_plan_windows(dst_block_shape, max_memory, shape, test_var):
+    with rio.open(test_var[1]) as src:
+        windows = plan_windows(src, dst_block_shape, max_memory)
+        assert_covers(windows, src.height, src.width)
+
+    assert (windows[0].height, windows[0].width) == shape
+    if max_memory:
+        assert estimate_memory(windows, "uint8") <= max_memory
+
+
+def test_plan_windows_block_order():
+    # windows smaller than a source block are grouped by block
+    class Striped(object):
+        height, width = 4, 8
+        block_shapes = [(4, 4)]
+        dtypes = ["uint8"]
+
+    windows = plan_windows(Striped(), (1, 1), max_memory=2 * 11)
+    assert_covers(windows, 4, 8)
+    assert [(w.col_off, w.row_off) for w in windows[:4]] == [
+        (0, 0),
+        (2, 0),
+        (0, 1),
+        (2, 1),
+    ]
+
+
+def test_plan_windows_large_unit():
+    # 7 row strips and 256 x 256 tiles are only aligned every 1792 rows
+    class Striped(object):
+        height, width = 2000, 40000
+        block_shapes = [(7, 40000)]
+        dtypes = ["uint8"]
+
+    windows = plan_windows(Striped(), (256, 256))
+    assert_covers(windows, 2000, 40000)
+    assert (windows[0].height, windows[0].width) == (7, 40000)
+    assert estimate_memory(windows, "uint8") <= BATCH_MEMORY
+
+    windows = plan_windows(Striped(), (7, 2048))
+    assert (windows[0].height, windows[0].width) == (7, 40000)
+
+
+def test_plan_windows_tiny_budget():
+    class Tiny(object):
+        height, width = 4, 8
+        block_shapes = [(4, 4)]
+        dtypes = ["uint8"]
+
+    with pytest.raises(ValueError):
+        plan_windows(Tiny(), max_memory=10)
+
+
+def test_plan_alpha(test_var):
+    plan = plan_alpha(
+        test_var[1],
+        {"tiled": True, "blockxsize": 512, "blockysize": 512},
+        2,
+        engine="threads",
+        max_memory=2**26,
+    )
+    assert plan["src_block_shape"] == [256, 256]
+    assert plan["dst_block_shape"] == [512, 512]
+    assert plan["held"] == 5
+    assert plan["windows"][0] == [0, 0, 1958, 512]
+    assert plan["peak_memory"] <= 2**26
+
+
+def test_add_alpha_max_memory(test_var, tmpdir):
+    default = str(tmpdir.join("default.tif"))
+    budget = str(tmpdir.join("budget.tif"))
+    add_alpha(test_var[1], default, [0, 0, 0], {}, 1)
+    add_alpha(test_var[1], budget, [0, 0, 0], {}, 1, max_memory=2**16)
+
+    with rio.open(default) as src1, rio.open(budget) as src2:
+        assert np.array_equal(src1.read(), src2.read())
+
+
+@pytest.mark.parametrize(
+    "engine,workers",
+    [
+        ("serial", 1),
+        ("processes", 1),
+        ("processes", 2),
+        ("threads", 2),
+        ("pipeline", 2),
+    ],
+)
+def test_add_alpha_stats(engine, workers, test_var, tmpdir):
+    default = str(tmpdir.join("default.tif"))
+    timed = str(tmpdir.join("timed.tif"))
+    stats = StageStats()
+    add_alpha(test_var[1], default, [0, 0, 0], {}, workers, engine=engine)
+    add_alpha(test_var[1], timed, [0, 0, 0], {}, workers, engine=engine, stats=stats)
+
+    with open(default, "rb") as f1, open(timed, "rb") as f2:
+        assert f1.read() == f2.read()
+
+    with rio.open(test_var[1]) as src:
+        windows = len(plan_windows(src))
+    stages = stats.to_dict()["stages"]
+    assert list(stages) == ["read", "mask", "write"]
+    assert all(stage["count"] == windows for stage in stages.values())
+    assert stages["read"]["bytes"] == 1958 * 1958 * 3
+    assert stages["write"]["bytes"] == 1958 * 1958 * 4
+    assert sum(w["count"] for w in stages["mask"]["workers"].values()) == windows
+
+
+@pytest.mark.parametrize("engine", ["serial", "pipeline"])
+def test_add_alpha_tolerance(engine, test_var, tmpdir):
+    dst_path = str(tmpdir.join("tolerance.tif"))
+    add_alpha(
+        test_var[1],
+        dst_path,
+        [0, 0, 0],
+        {"compress": "deflate"},
+        1,
+        engine=engine,
+        tolerance=20,
+    )
+
+    with rio.open(test_var[1]) as src, rio.open(dst_path) as dst:
+        expected = mask_fuzzy(src.read(), [0, 0, 0], 20)
+        assert np.array_equal(dst.read(4), expected)
+        assert np.count_nonzero(expected == 0) > np.count_nonzero(dst.read(1) == 0)
+
+
+def test_add_alpha_tolerance_invalid(test_var, tmpdir):
+    with pytest.raises(ValueError):
+        add_alpha(
+            test_var[0], str(tmpdir.join("x.tif")), [0, 0, 0], {}, 1, tolerance=-1
+        )
+
+
+@pytest.fixture
+def speckled(tmpdir):
+    """A 3 band source with a collar, nodata pinholes and valid specks"""
+    src_path = str(tmpdir.join("speckled.tif"))
+    rng = np.random.RandomState(0)
+    data = rng.randint(1, 255, (3, 150, 170)).astype(np.uint8)
+    data[:, :, :30] = 0
+    data[:, rng.randint(0, 150, 80), rng.randint(30, 170, 80)] = 0
+    data[:, rng.randint(0, 150, 40), rng.randint(0, 30, 40)] = 7
+    profile = dict(
+        driver="GTiff",
+        count=3,
+        dtype="uint8",
+        width=170,
+        height=150,
+        tiled=True,
+        blockxsize=32,
+        blockysize=32,
+    )
+    with rio.open(src_path, "w", **profile) as dst:
+        dst.write(data)
+    return src_path
+
+
+@pytest.mark.parametrize(
+    "engine,workers,max_memory",
+    [
+        ("serial", 1, None),
+        ("serial", 1, 2**14),
+        ("processes", 2, 2**15),
+        ("threads", 2, 2**15),
+        ("pipeline", 2, 2**15),
+    ],
+)
+def test_add_alpha_filters(engine, workers, max_memory, speckled, tmpdir):
+    filters = [("close", 1), ("sieve", 8), ("open", 1)]
+    dst_path = str(tmpdir.join("filtered.tif"))
+    add_alpha(
+        speckled,
+        dst_path,
+        [0, 0, 0],
+        {},
+        workers,
+        engine=engine,
+        max_memory=max_memory,
+        filters=filters,
+    )
+
+    halo = filter_halo(filters)
+    with rio.open(speckled) as src, rio.open(dst_path) as dst:
+        valid = mask_exact(src.read(), [0, 0, 0]) != 0
+        padded = np.pad(valid, halo, mode="edge")
+        expected = apply_filters(padded, filters)[halo:-halo, halo:-halo]
+        assert np.array_equal(dst.read(4), expected * 255)
+        assert np.array_equal(dst.read(1), src.read(1))
+        assert not expected[:, :30].any()
+        assert expected[:, 30:].all()
+
+
+def test_add_alpha_filters_invalid(test_var, tmpdir):
+    with pytest.raises(ValueError):
+        add_alpha(
+            test_var[0], str(tmpdir.join("x.tif")), None, {}, 1, filters=[("x", 1)]
+        )
+    with pytest.raises(ValueError):
+        add_alpha(
+            test_var[0], str(tmpdir.join("x.tif")), None, {}, 1, filters=[("open", 0)]
+        )
+
+
+@pytest.mark.parametrize("max_memory", [None, 2**20])
+def test_add_alpha_many(max_memory, tmpdir):
+    srcs = [
+        "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif",
+        "tests/fixtures/landsat/two_bands.tif",
+        "tests/fixtures/ca_chilliwack/2012_30cm_594_5450.tiled.tiny.tif",
+        "tests/fixtures/landsat/LC80460272013104LGN01_l8sr.tif",
+    ]
+    jobs = [(src, str(tmpdir.join("{}.tif".format(i)))) for i, src in enumerate(srcs)]
+
+    reports = list(
+        add_alpha_many(jobs, "0", {}, 2, mask_mode="internal", max_memory=max_memory)
+    )
+    assert sorted(r["src_path"] for r in reports) == sorted(srcs)
+
+    for report in reports:
+        if report["src_path"] == srcs[1]:
+            assert report["status"] == "error"
+            assert "3 or 4 bands" in report["error"]
+            assert not os.path.exists(report["dst_path"])
+            continue
+
+        assert report["status"] == "ok"
+        assert report["windows"] >= 1
+        expected = str(tmpdir.join("expected.tif"))
+        with rio.open(report["src_path"]) as src:
+            ndv = [0] * src.count
+        add_alpha(report["src_path"], expected, ndv, {}, 1, mask_mode="internal")
+        with rio.open(report["dst_path"]) as created, rio.open(expected) as src:
+            assert np.array_equal(created.read(), src.read())
+            assert np.array_equal(created.dataset_mask(), src.dataset_mask())
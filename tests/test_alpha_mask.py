@@ -4,7 +4,12 @@ from hypothesis import given
 from hypothesis.extra.numpy import arrays
 import numpy as np
 import pytest
-from rio_alpha.alpha_mask import mask_exact
+from rio_alpha.alpha_mask import (
+    mask_exact,
+    mask_exact_packed,
+    mask_fuzzy,
+    _packed_pixels,
+)
 
 
 @pytest.fixture
@@ -78,3 +83,153 @@ def test_mask_exact4():
         np.any(np.rollaxis(arr2, 0, 3) != ndv, axis=2),
         mask_exact(arr2, ndv) / np.iinfo(arr2.dtype).max,
     )
+
+
+def test_mask_exact_out():
+    img = np.random.randint(0, 3, (3, 20, 30)).astype(np.uint16)
+    out = np.full((20, 30), 7, dtype=np.uint16)
+    alpha = mask_exact(img, (0, 0, 0), out=out)
+
+    assert alpha is out
+    assert np.array_equal(
+        out, np.any(np.rollaxis(img, 0, 3) != 0, axis=2) * np.iinfo(np.uint16).max
+    )
+
+
+def test_mask_exact_out_shape():
+    img = np.zeros((3, 20, 30), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        mask_exact(img, (0, 0, 0), out=np.empty((30, 20), dtype=np.uint8))
+
+
+def test_mask_exact_int16():
+    img = np.array([[[-1, 2, -1]], [[-1, -1, -1]], [[-1, -1, 0]]], dtype=np.int16)
+    alpha = mask_exact(img, (-1, -1, -1))
+    assert alpha.tolist() == [[0, 32767, 32767]]
+
+
+def test_mask_exact_float32_nan():
+    img = np.array(
+        [[[np.nan, 1.0, np.nan]], [[np.nan, np.nan, 2.0]], [[np.nan, 0.0, np.nan]]],
+        dtype=np.float32,
+    )
+    alpha = mask_exact(img, (np.nan, np.nan, np.nan))
+    assert alpha.dtype == np.float32
+    assert alpha.tolist() == [[0.0, 255.0, 255.0]]
+
+
+def test_mask_exact_float32_value():
+    img = np.array([[[0.5, 1.0]], [[0.5, 0.5]], [[0.5, 0.5]]], dtype=np.float32)
+    assert mask_exact(img, (0.5, 0.5, 0.5)).tolist() == [[0.0, 255.0]]
+
+
+def test_mask_exact_unrepresentable_ndv():
+    img = np.zeros((3, 2, 2), dtype=np.uint8)
+    assert np.all(mask_exact(img, (0, 0, 256)) == 255)
+    assert np.all(mask_exact(img, (0, 0, 0.5)) == 255)
+
+
+interleaved = arrays(
+    np.uint8, (9, 11, 4), elements=st.integers(min_value=0, max_value=2)
+)
+
+
+@given(interleaved, st.integers(min_value=3, max_value=4))
+def test_mask_exact_packed(buf, bands):
+    img = buf.transpose(2, 0, 1)[:bands]
+    ndv = [1] * bands
+
+    assert _packed_pixels(img) is not None
+    expected = mask_exact(np.ascontiguousarray(img), ndv)
+    assert np.array_equal(mask_exact_packed(img, ndv), expected)
+    assert np.array_equal(mask_exact(img, ndv, kernel="bands"), expected)
+    assert np.array_equal(mask_exact(img, ndv), expected)
+
+
+@given(interleaved)
+def test_mask_exact_packed_into_alpha_plane(buf):
+    rgb = buf.transpose(2, 0, 1)[:3]
+    expected = mask_exact(np.ascontiguousarray(rgb), (0, 0, 0))
+    alpha = mask_exact(rgb, (0, 0, 0), out=buf[:, :, 3])
+
+    assert np.shares_memory(alpha, buf)
+    assert np.array_equal(buf[:, :, 3], expected)
+
+
+@pytest.mark.parametrize("bands, packed", [(3, False), (4, True)])
+def test_mask_exact_auto_kernel(bands, packed, monkeypatch):
+    calls = []
+
+    def record(img, ndv, out=None):
+        calls.append(img.shape[0])
+        return mask_exact(img, ndv, out, kernel="bands")
+
+    monkeypatch.setattr("rio_alpha.alpha_mask.mask_exact_packed", record)
+    img = np.zeros((5, 6, 4), np.uint8).transpose(2, 0, 1)[:bands]
+    mask_exact(img, [0] * bands)
+    assert calls == ([bands] if packed else [])
+
+
+def test_packed_pixels_layouts():
+    assert _packed_pixels(np.zeros((3, 4, 5), np.uint8)) is None
+    assert _packed_pixels(np.zeros((4, 5, 4), np.uint16).transpose(2, 0, 1)) is None
+    # RGB interleaved on 3 bytes has no 4th byte to spare
+    assert _packed_pixels(np.zeros((4, 5, 3), np.uint8).transpose(2, 0, 1)) is None
+
+
+def test_mask_exact_packed_requires_interleaved():
+    with pytest.raises(ValueError):
+        mask_exact_packed(np.zeros((3, 4, 5), np.uint8), (0, 0, 0))
+    with pytest.raises(ValueError):
+        mask_exact(np.zeros((3, 4, 5), np.uint8), (0, 0, 0), kernel="packed")
+
+
+def test_mask_exact_packed_unrepresentable_ndv():
+    img = np.zeros((5, 5, 4), np.uint8).transpose(2, 0, 1)
+    assert np.all(mask_exact_packed(img, (0, 0, 0, 256)) == 255)
+
+
+@given(
+    arrays(np.uint16, (3, 6, 7), elements=st.integers(0, 65535)),
+    st.lists(st.integers(0, 65535), min_size=3, max_size=3),
+    st.integers(0, 70000),
+)
+def test_mask_fuzzy(img, ndv, tolerance):
+    distance = np.abs(img.astype(np.int64) - np.array(ndv)[:, None, None])
+    expected = (distance.max(axis=0) > tolerance) * 65535
+
+    alpha = mask_fuzzy(img, ndv, tolerance)
+    assert alpha.dtype == np.uint16
+    assert np.array_equal(alpha, expected)
+
+
+def test_mask_fuzzy_zero_tolerance():
+    img = np.random.randint(0, 4, (3, 20, 30)).astype(np.uint8)
+    assert np.array_equal(mask_fuzzy(img, (1, 2, 3), 0), mask_exact(img, (1, 2, 3)))
+
+
+def test_mask_fuzzy_no_wraparound():
+    img = np.array([[[0, 3, 255, 254]]] * 3, dtype=np.uint8)
+    assert mask_fuzzy(img, (1, 1, 1), 2).tolist() == [[0, 0, 255, 255]]
+    assert mask_fuzzy(img, (255, 255, 255), 1).tolist() == [[255, 255, 0, 0]]
+
+
+def test_mask_fuzzy_per_band_tolerance():
+    img = np.array([[[3, 3]], [[0, 1]], [[0, 0]]], dtype=np.uint8)
+    out = np.empty((1, 2), dtype=np.uint8)
+    assert mask_fuzzy(img, (0, 0, 0), (3, 0, 0), out=out) is out
+    assert out.tolist() == [[0, 255]]
+
+
+def test_mask_fuzzy_float32():
+    img = np.array(
+        [[[np.nan, 1.0, 0.25]], [[np.nan, np.nan, 0.0]], [[np.nan, 0.0, 0.0]]],
+        dtype=np.float32,
+    )
+    assert mask_fuzzy(img, (np.nan,) * 3, 1).tolist() == [[0.0, 255.0, 255.0]]
+    assert mask_fuzzy(img, (0, 0, 0), 0.5).tolist() == [[255.0, 255.0, 0.0]]
+
+
+def test_mask_fuzzy_negative_tolerance():
+    with pytest.raises(ValueError):
+        mask_fuzzy(np.zeros((3, 2, 2), dtype=np.uint8), (0, 0, 0), -1)
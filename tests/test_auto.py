@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import rasterio as rio
+
+from rio_alpha.auto import auto_alpha
+from rio_alpha.islossy import count_ndv_regions
+
+
+@pytest.mark.parametrize("max_memory", [None, 2**16])
+def test_auto_alpha_lossy(max_memory, tmpdir):
+    src_path = "tests/fixtures/ca_chilliwack/2012_30cm_594_5450.tiled.tiny.tif"
+    dst_path = str(tmpdir.join("auto.tif"))
+
+    verdict = auto_alpha(src_path, dst_path, {}, 1, max_memory=max_memory)
+
+    with rio.open(src_path) as src:
+        img = src.read()
+    assert verdict == {
+        "nodata": "[255, 255, 255]",
+        "regions": count_ndv_regions(img, [255, 255, 255]),
+        "lossy": True,
+    }
+
+    with rio.open(dst_path) as dst:
+        assert dst.tags()["RIO_ALPHA_NODATA"] == "[255, 255, 255]"
+        assert dst.tags()["RIO_ALPHA_REGIONS"] == str(verdict["regions"])
+        assert dst.tags()["RIO_ALPHA_LOSSY"] == "True"
+        alpha = np.any(np.rollaxis(img, 0, 3) != 255, axis=2) * 255
+        assert np.array_equal(dst.read(4), alpha)
+
+
+@pytest.mark.parametrize("mask_mode", ["band", "internal"])
+def test_auto_alpha_filtered(mask_mode, tmpdir):
+    src_path = "tests/fixtures/ca_chilliwack/2012_30cm_594_5450.tiled.tiny.tif"
+    dst_path = str(tmpdir.join("auto.tif"))
+
+    verdict = auto_alpha(
+        src_path,
+        dst_path,
+        {},
+        1,
+        mask_mode=mask_mode,
+        tolerance=2,
+        filters=[("close", 1), ("sieve", 64)],
+    )
+
+    with rio.open(src_path) as src:
+        img = src.read()
+    regions = count_ndv_regions(img, [255, 255, 255])
+    # The filters removed regions, which are still counted
+    with rio.open(dst_path) as dst:
+        written = count_ndv_regions(dst.dataset_mask()[np.newaxis], [0])
+    assert written < regions
+    assert verdict["regions"] == regions
+    assert verdict["lossy"]
+
+
+def test_auto_alpha_no_nodata(tmpdir):
+    dst_path = str(tmpdir.join("auto.tif"))
+    verdict = auto_alpha(
+        "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif",
+        dst_path,
+        {},
+        2,
+        engine="threads",
+        mask_mode="internal",
+    )
+    assert verdict == {"nodata": "", "regions": 0, "lossy": False}
+
+    with rio.open(dst_path) as dst:
+        assert dst.tags()["RIO_ALPHA_NODATA"] == "none"
+        assert dst.tags()["RIO_ALPHA_LOSSY"] == "False"
+        assert (dst.dataset_mask() == 255).all()
+
+
+def test_auto_alpha_tolerance_without_nodata(tmpdir):
+    dst_path = str(tmpdir.join("auto.tif"))
+    with pytest.raises(ValueError, match="tolerance requires a nodata value"):
+        auto_alpha(
+            "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif",
+            dst_path,
+            {},
+            1,
+            tolerance=2,
+        )
+    assert not tmpdir.join("auto.tif").exists()
+
+
+def test_auto_alpha_alpha_band(tmpdir):
+    src_path = "tests/fixtures/landsat/LC80460272013104LGN01_l8sr.tif"
+    dst_path = str(tmpdir.join("auto.tif"))
+    verdict = auto_alpha(
+        src_path, dst_path, {"compress": "deflate"}, 1, threshold=10**6
+    )
+    assert verdict["nodata"] == "alpha"
+    assert not verdict["lossy"]
+
+    with rio.open(src_path) as src, rio.open(dst_path) as dst:
+        assert np.array_equal(dst.read(4), src.dataset_mask())
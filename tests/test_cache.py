@@ -0,0 +1,118 @@
+import logging
+import os
+import shutil
+
+import pytest
+
+from rio_alpha.cache import DiscoveryCache, default_cache_dir, fingerprint
+from rio_alpha.findnodata import determine_nodata
+
+
+def test_default_cache_dir(tmpdir):
+    assert default_cache_dir() == os.path.join(str(tmpdir.join("cache")), "rio-alpha")
+
+
+def test_fingerprint(tmpdir):
+    path = str(tmpdir.join("data.bin"))
+    with open(path, "wb") as f:
+        f.write(b"\0" * 10**6)
+    os.utime(path, (1, 1))
+    first = fingerprint(path)
+    assert fingerprint(path) == first
+
+    # same size and mtime, different content in a sampled block
+    with open(path, "r+b") as f:
+        f.seek(10**6 // 2)
+        f.write(b"\1")
+    os.utime(path, (1, 1))
+    assert fingerprint(path) != first
+
+    copy = str(tmpdir.join("copy.bin"))
+    shutil.copy(path, copy)
+    os.utime(copy, (1, 1))
+    assert fingerprint(copy) == fingerprint(path)
+
+    os.utime(copy, (2, 2))
+    assert fingerprint(copy) != fingerprint(path)
+
+
+def test_cache_roundtrip(tmpdir):
+    cache = DiscoveryCache(str(tmpdir.join("store")))
+    assert cache.get("missing") is None
+    cache.put("key", {"original": [1, 2, 3]})
+    assert cache.get("key") == {"original": [1, 2, 3]}
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    cache = DiscoveryCache(str(tmpdir.join("store")), max_bytes=300)
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, {"pad": "x" * 80})
+        os.utime(cache._entry(key), (i, i))
+
+    assert cache.get("a") is not None  # now the most recently used
+    cache.put("d", {"pad": "x" * 80})
+
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in ["a", "c", "d"])
+
+
+def test_put_unwritable(tmpdir):
+    tmpdir.join("file").write("")
+    with pytest.raises(OSError):
+        DiscoveryCache(str(tmpdir.join("file", "store"))).put("a", {})
+
+
+def test_put_removes_temporary_file(tmpdir):
+    cache = DiscoveryCache(str(tmpdir))
+    with pytest.raises(TypeError):
+        cache.put("a", {"value": object()})
+    assert os.listdir(str(tmpdir)) == []
+
+
+@pytest.mark.parametrize("verbose", [True, False])
+def test_determine_nodata_cache(verbose, tmpdir, monkeypatch, capsys, caplog):
+    caplog.set_level(logging.INFO, logger="rio_alpha.findnodata")
+    src_path = str(tmpdir.join("src.tif"))
+    shutil.copy("tests/fixtures/fi_all/W4441A.tiny.tif", src_path)
+    cache = DiscoveryCache(str(tmpdir.join("store")))
+
+    expected = determine_nodata(src_path, None, True, False, verbose)
+    out = capsys.readouterr().out
+    assert determine_nodata(src_path, None, True, False, verbose, cache) == expected
+    captured = capsys.readouterr()
+    assert captured.out == out
+    assert ("Discovery cache miss" in captured.err) == verbose
+    assert "Discovery cache miss: {}".format(src_path) in caplog.messages
+    caplog.clear()
+
+    def fail(src, size=200, factor=None):
+        raise AssertionError("the raster was read")
+
+    monkeypatch.setattr("rio_alpha.findnodata._read_sample", fail)
+    assert determine_nodata(src_path, None, True, False, verbose, cache) == expected
+    captured = capsys.readouterr()
+    assert captured.out == out
+    assert ("Discovery cache hit" in captured.err) == verbose
+    assert "Discovery cache hit: {}".format(src_path) in caplog.messages
+    assert "Discovery cache miss" not in caplog.text
+
+
+def test_determine_nodata_cache_unwritable(tmpdir, caplog):
+    tmpdir.join("file").write("")
+    cache = DiscoveryCache(str(tmpdir.join("file", "store")))
+    src_path = "tests/fixtures/fi_all/W4441A.tiny.tif"
+    assert determine_nodata(src_path, None, True, False, False, cache) == (
+        "[255, 255, 255]"
+    )
+    assert "not cached" in caplog.text
+
+
+def test_determine_nodata_cache_max_memory(tmpdir):
+    src_path = str(tmpdir.join("src.tif"))
+    shutil.copy("tests/fixtures/fi_all/W4441A.tiny.tif", src_path)
+    cache = DiscoveryCache(str(tmpdir.join("store")))
+
+    determine_nodata(src_path, None, True, False, False, cache)
+    determine_nodata(src_path, None, True, False, False, cache, max_memory=10**6)
+    # The decimated sample's evidence doesn't replace the default one
+    assert len(os.listdir(cache.path)) == 2
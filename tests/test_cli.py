@@ -1,7 +1,13 @@
+import json
+import logging
 import os
+import shutil
+import subprocess
+import sys
 
 import rasterio
 import numpy as np
+import pytest
 from click.testing import CliRunner
 import warnings
 from rasterio.enums import Compression
@@ -9,6 +15,16 @@ from rasterio.enums import Compression
 from rio_alpha.scripts.cli import alpha, islossy, findnodata
 
 
+def test_cli_import_is_light():
+    """Listing the rio commands doesn't load the modules doing the work"""
+    heavy = ("scipy", "riomucho", "rio_alpha.alpha", "rio_alpha.findnodata")
+    code = (
+        "import sys, rio_alpha.scripts.cli; print([m for m in %r if m in sys.modules])"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code % (heavy,)])
+    assert output.decode().strip() == "[]"
+
+
 def test_cli_missing_input():
     result = CliRunner().invoke(islossy, ["tests/fixtures/dne.tif"])
     assert result.exit_code == 2
@@ -27,6 +43,34 @@ def test_cli_lossy_single_value_ndv():
     assert result.output.strip("\n") == "True"
 
 
+def test_cli_lossy_max_memory():
+    result = CliRunner().invoke(
+        islossy,
+        [
+            "tests/fixtures/ca_chilliwack/2012_30cm_594_5450.tiny.tif",
+            "--ndv",
+            "255",
+            "--max-memory",
+            "1M",
+        ],
+    )
+    assert result.exit_code == 0
+    assert result.output.strip("\n") == "True"
+
+
+def test_cli_lossy_max_memory_invalid():
+    result = CliRunner().invoke(
+        islossy,
+        [
+            "tests/fixtures/ca_chilliwack/2012_30cm_594_5450.tiny.tif",
+            "--max-memory",
+            "512K",
+        ],
+    )
+    assert result.exit_code == 2
+    assert "at least 1M" in result.output
+
+
 def test_cli_lossy_single_value_ndv_fail():
     runner = CliRunner()
     result = runner.invoke(
@@ -160,6 +204,108 @@ def test_cli_findnodata_discovery_success():
     assert result.output.strip("\n") == "[18, 51, 62]"
 
 
+def test_cli_findnodata_max_memory():
+    runner = CliRunner()
+    result = runner.invoke(
+        findnodata,
+        [
+            "tests/fixtures/fi_all/W4441A.tiny.tif",
+            "--discovery",
+            "--no-cache",
+            "--max-memory",
+            "1M",
+        ],
+    )
+    assert result.exit_code == 0
+    assert result.output.strip("\n") == "[255, 255, 255]"
+
+
+def test_cli_findnodata_recursive(tmpdir):
+    shutil.copy("tests/fixtures/fi_all/W4441A.tiny.tif", str(tmpdir.join("a.tif")))
+    shutil.copy(
+        "tests/fixtures/dg_everest/everest_0430_R1C1.tiny.tif",
+        str(tmpdir.mkdir("b").join("b.tif")),
+    )
+    result = CliRunner().invoke(
+        findnodata,
+        ["--recursive", str(tmpdir), "--discovery", "--no-cache", "-j", "2"],
+    )
+    assert result.exit_code == 0
+    records = sorted(
+        (json.loads(line) for line in result.output.splitlines()),
+        key=lambda record: record["src_path"],
+    )
+    assert [(r["ndv"], r["method"], r["status"]) for r in records] == [
+        ("[255, 255, 255]", "discovered", "ok"),
+        ("0", "internal", "ok"),
+    ]
+
+
+def test_cli_findnodata_recursive_failure(tmpdir):
+    shutil.copy("tests/fixtures/fi_all/W4441A.tiny.tif", str(tmpdir.join("a.tif")))
+    tmpdir.join("broken.tif").write("not a raster")
+    result = CliRunner().invoke(
+        findnodata, ["--recursive", str(tmpdir), "--discovery", "--no-cache"]
+    )
+    assert result.exit_code == 1
+    statuses = [json.loads(line)["status"] for line in result.output.splitlines()[:2]]
+    assert statuses == ["ok", "error"]
+    assert "1 of 2 files failed" in result.output
+
+
+@pytest.mark.parametrize(
+    "args, message",
+    [
+        ([], "SRC_PATH is required without --recursive"),
+        (
+            ["tests/fixtures/fi_all/W4441A.tiny.tif", "--recursive", "tests"],
+            "SRC_PATH can't be given with --recursive",
+        ),
+        (["--recursive", "tests", "-v"], "not supported with --recursive"),
+        (["--recursive", "tests", "--max-memory", "512K"], "at least 1M"),
+        (["--recursive", "tests", "-j", "0"], "--workers"),
+    ],
+)
+def test_cli_findnodata_recursive_usage(args, message):
+    result = CliRunner().invoke(findnodata, args)
+    assert result.exit_code == 2
+    assert message in result.output
+
+
+def test_cli_findnodata_sampler_blocks(caplog):
+    caplog.set_level(logging.INFO, logger="rio_alpha.findnodata")
+    result = CliRunner().invoke(
+        findnodata,
+        [
+            "tests/fixtures/fi_all/W4441A.tiny.tif",
+            "--discovery",
+            "--no-cache",
+            "--sampler",
+            "blocks",
+            "-v",
+        ],
+    )
+    assert result.exit_code == 0
+    assert result.output.strip("\n") == "[255, 255, 255]"
+    (message,) = [m for m in caplog.messages if m.startswith("Discovery confidence")]
+    assert float(message.split(": ")[1]) > 0.99
+
+
+def test_cli_findnodata_sampler_blocks_debug():
+    result = CliRunner().invoke(
+        findnodata,
+        [
+            "tests/fixtures/fi_all/W4441A.tiny.tif",
+            "--discovery",
+            "--sampler",
+            "blocks",
+            "--debug",
+        ],
+    )
+    assert result.exit_code == 2
+    assert "--debug requires --sampler grid" in result.output
+
+
 def test_cli_findnodata_nodiscovery_success():
     runner = CliRunner()
     result = runner.invoke(
@@ -190,7 +336,7 @@ def test_cli_findnodata_verbose_success():
         ["tests/fixtures/fi_all/W4441A.tiny.tif", "--discovery", "--verbose"],
     )
     assert result.exit_code == 0
-    assert result.output.strip("\n") == "[255, 255, 255]"
+    assert result.stdout.strip("\n") == "[255, 255, 255]"
 
 
 def test_cli_findnodata_debug_success():
@@ -321,9 +467,411 @@ def test_cli_equivalent_masks(tmpdir):
         assert np.array_equal(src1.read(4), src2.read(4))
 
 
+def test_cli_alpha_internal_mask(tmpdir):
+    band = str(tmpdir.join("band.tif"))
+    internal = str(tmpdir.join("internal.tif"))
+    src_path = "tests/fixtures/dk_all/320_ECW_UTM32-EUREF89.tiny.tif"
+    runner = CliRunner()
+    result = runner.invoke(alpha, [src_path, band, "--ndv", "[18, 51, 62]"])
+    assert result.exit_code == 0
+    result = runner.invoke(
+        alpha,
+        [src_path, internal, "--ndv", "[18, 51, 62]", "--mask-mode", "internal"],
+    )
+    assert result.exit_code == 0
+    assert not os.path.exists(internal + ".msk")
+
+    with rasterio.open(band) as src1, rasterio.open(internal) as src2:
+        assert src2.count == 3
+        assert src2.mask_flag_enums[0] == [rasterio.enums.MaskFlags.per_dataset]
+        assert np.array_equal(src1.read(indexes=[1, 2, 3]), src2.read())
+        assert np.array_equal(src1.read(4), src2.dataset_mask())
+
+
+def test_cli_alpha_sidecar_mask(tmpdir):
+    output = str(tmpdir.join("sidecar.tif"))
+    runner = CliRunner()
+    result = runner.invoke(
+        alpha,
+        [
+            "tests/fixtures/masks/internal_mask.tif",
+            output,
+            "--mask-mode",
+            "sidecar",
+        ],
+    )
+    assert result.exit_code == 0
+    assert os.path.exists(output + ".msk")
+
+    with rasterio.open(output) as out:
+        with rasterio.open("tests/fixtures/masks/internal_mask.tif") as src:
+            assert out.count == 3
+            assert np.array_equal(out.dataset_mask(), src.dataset_mask())
+
+
 def test_cli_must_be_3or4band(tmpdir):
     output = str(tmpdir.join("test_out.tif"))
     runner = CliRunner()
     result = runner.invoke(alpha, ["tests/fixtures/landsat/two_bands.tif", output])
     assert result.exit_code != 0
     assert "Array must have 3 or 4 bands (RGB or RGBA)" in str(result.exception)
+
+
+def test_cli_alpha_engine_threads(tmpdir):
+    processes = str(tmpdir.join("processes.tif"))
+    threads = str(tmpdir.join("threads.tif"))
+    src_path = "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif"
+    runner = CliRunner()
+    result = runner.invoke(alpha, [src_path, processes, "-j", "2"])
+    assert result.exit_code == 0
+    result = runner.invoke(alpha, [src_path, threads, "-j", "2", "--engine", "threads"])
+    assert result.exit_code == 0
+
+    with open(processes, "rb") as f1, open(threads, "rb") as f2:
+        assert f1.read() == f2.read()
+
+
+def test_cli_alpha_dry_run(tmpdir):
+    output = str(tmpdir.join("test_out.tif"))
+    runner = CliRunner()
+    result = runner.invoke(
+        alpha,
+        [
+            "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif",
+            output,
+            "--max-memory",
+            "4M",
+            "--dry-run",
+        ],
+    )
+    assert result.exit_code == 0
+    assert not os.path.exists(output)
+
+    plan = json.loads(result.output)
+    assert plan["src_block_shape"] == [256, 256]
+    assert plan["peak_memory"] <= 4 * 2**20
+    assert sum(w[2] * w[3] for w in plan["windows"]) == 1958 * 1958
+
+
+def test_cli_alpha_max_memory_invalid(tmpdir):
+    output = str(tmpdir.join("test_out.tif"))
+    result = CliRunner().invoke(
+        alpha,
+        [
+            "tests/fixtures/dk_all/320_ECW_UTM32-EUREF89.tiny.tif",
+            output,
+            "--max-memory",
+            "lots",
+        ],
+    )
+    assert result.exit_code == 2
+    assert "not a memory size" in result.output
+
+
+@pytest.mark.parametrize(
+    "args, message",
+    [
+        (["--max-memory", "10", "-j", "2"], "can't hold a pixel"),
+        (["--max-memory", "0"], "must be positive"),
+    ],
+)
+def test_cli_alpha_max_memory_too_small(tmpdir, args, message):
+    output = str(tmpdir.join("test_out.tif"))
+    result = CliRunner().invoke(
+        alpha, ["tests/fixtures/dk_all/320_ECW_UTM32-EUREF89.tiny.tif", output] + args
+    )
+    assert result.exit_code == 2
+    assert message in result.output
+    assert not os.path.exists(output)
+
+
+def test_cli_findnodata_max_memory_invalid():
+    result = CliRunner().invoke(
+        findnodata,
+        ["tests/fixtures/fi_all/W4441A.tiny.tif", "--discovery", "--max-memory", "x"],
+    )
+    assert result.exit_code == 2
+    assert "not a memory size" in result.output
+
+
+def test_cli_alpha_batch(tmpdir):
+    manifest = str(tmpdir.join("manifest.txt"))
+    report = str(tmpdir.join("report.jsonl"))
+    outputs = [str(tmpdir.join("out1.tif")), str(tmpdir.join("out2.tif"))]
+    with open(manifest, "w") as f:
+        f.write(
+            "tests/fixtures/dk_all/320_ECW_UTM32-EUREF89.tiny.tif {}\n".format(
+                outputs[0]
+            )
+        )
+        f.write("tests/fixtures/masks/internal_mask.tif {}\n".format(outputs[1]))
+
+    result = CliRunner().invoke(
+        alpha, ["--batch", manifest, "--report", report, "-j", "2", "--ndv", "255"]
+    )
+    assert result.exit_code == 0
+    with open(report) as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(r["dst_path"] for r in records) == outputs
+    assert all(r["status"] == "ok" for r in records)
+    for output in outputs:
+        with rasterio.open(output) as out:
+            assert out.count == 4
+
+
+def test_cli_alpha_batch_failure(tmpdir):
+    manifest = str(tmpdir.join("manifest.txt"))
+    with open(manifest, "w") as f:
+        f.write(
+            "tests/fixtures/landsat/two_bands.tif {}\n".format(tmpdir.join("x.tif"))
+        )
+
+    result = CliRunner().invoke(alpha, ["--batch", manifest])
+    assert result.exit_code == 1
+    assert json.loads(result.output.splitlines()[0])["status"] == "error"
+    assert "1 of 1 files failed" in result.output
+
+
+@pytest.mark.parametrize(
+    "args, message",
+    [
+        (["--auto"], "--auto is not supported with --batch"),
+        (["--auto", "--tolerance", "2"], "--auto is not supported with --batch"),
+        (["--engine", "threads"], "--engine is not supported with --batch"),
+        (["--dry-run"], "--dry-run is not supported with --batch"),
+        (
+            ["tests/fixtures/fi_all/W4441A.tiny.tif"],
+            "SRC_PATH and DST_PATH can't be given with --batch",
+        ),
+    ],
+)
+def test_cli_alpha_batch_usage(tmpdir, args, message):
+    manifest = str(tmpdir.join("manifest.txt"))
+    with open(manifest, "w") as f:
+        f.write(
+            "tests/fixtures/fi_all/W4441A.tiny.tif {}\n".format(tmpdir.join("x.tif"))
+        )
+
+    result = CliRunner().invoke(alpha, ["--batch", manifest] + args)
+    assert result.exit_code == 2
+    assert message in result.output
+    assert not tmpdir.join("x.tif").exists()
+
+
+def test_cli_alpha_stats_out(tmpdir):
+    output = str(tmpdir.join("test_out.tif"))
+    stats_out = str(tmpdir.join("stats.json"))
+    result = CliRunner().invoke(
+        alpha,
+        [
+            "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif",
+            output,
+            "--ndv",
+            "0",
+            "--stats-out",
+            stats_out,
+        ],
+    )
+    assert result.exit_code == 0
+    with open(stats_out) as f:
+        stats = json.load(f)
+    assert list(stats["stages"]) == ["read", "mask", "write"]
+    assert stats["stages"]["write"]["bytes"] == 1958 * 1958 * 4
+
+
+def test_cli_alpha_tolerance(tmpdir):
+    exact = str(tmpdir.join("exact.tif"))
+    fuzzy = str(tmpdir.join("fuzzy.tif"))
+    src_path = "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif"
+    runner = CliRunner()
+    result = runner.invoke(
+        alpha, [src_path, exact, "--ndv", "0", "--co", "compress=deflate"]
+    )
+    assert result.exit_code == 0
+    result = runner.invoke(
+        alpha,
+        [
+            src_path,
+            fuzzy,
+            "--ndv",
+            "0",
+            "--tolerance",
+            "20",
+            "--co",
+            "compress=deflate",
+        ],
+    )
+    assert result.exit_code == 0
+
+    with rasterio.open(exact) as out1, rasterio.open(fuzzy) as out2:
+        assert np.count_nonzero(out2.read(4) == 0) > np.count_nonzero(out1.read(4) == 0)
+
+
+def test_cli_alpha_tolerance_requires_ndv(tmpdir):
+    result = CliRunner().invoke(
+        alpha,
+        [
+            "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif",
+            str(tmpdir.join("x.tif")),
+            "--tolerance",
+            "5",
+        ],
+    )
+    assert result.exit_code == 2
+    assert "--tolerance requires --ndv or --auto" in result.output
+
+
+def test_cli_alpha_filter(tmpdir):
+    output = str(tmpdir.join("test_out.tif"))
+    result = CliRunner().invoke(
+        alpha,
+        [
+            "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif",
+            output,
+            "--ndv",
+            "0",
+            "--filter",
+            "close:1",
+            "--filter",
+            "sieve:8",
+            "--co",
+            "compress=deflate",
+        ],
+    )
+    assert result.exit_code == 0
+    with rasterio.open(output) as out:
+        assert set(np.unique(out.read(4))) <= {0, 255}
+
+
+@pytest.mark.parametrize(
+    "value, message",
+    [
+        ("sieve", "is not a filter"),
+        ("open:x", "is not a filter"),
+        ("blur:2", "filters must be one of"),
+        ("close:0", "size must be at least 1"),
+    ],
+)
+def test_cli_alpha_filter_invalid(tmpdir, value, message):
+    result = CliRunner().invoke(
+        alpha,
+        [
+            "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif",
+            str(tmpdir.join("x.tif")),
+            "--filter",
+            value,
+        ],
+    )
+    assert result.exit_code == 2
+    assert message in result.output
+    assert not tmpdir.join("x.tif").exists()
+
+
+def test_cli_alpha_missing_paths():
+    result = CliRunner().invoke(alpha, [])
+    assert result.exit_code == 2
+    assert "SRC_PATH and DST_PATH are required" in result.output
+
+
+def test_cli_alpha_auto(tmpdir):
+    output = str(tmpdir.join("test_out.tif"))
+    result = CliRunner().invoke(
+        alpha,
+        [
+            "tests/fixtures/ca_chilliwack/2012_30cm_594_5450.tiled.tiny.tif",
+            output,
+            "--auto",
+        ],
+    )
+    assert result.exit_code == 0
+    verdict = json.loads(result.output)
+    assert verdict["nodata"] == "[255, 255, 255]"
+    assert verdict["lossy"]
+
+    with rasterio.open(output) as out:
+        assert out.tags()["RIO_ALPHA_LOSSY"] == "True"
+
+
+def test_cli_alpha_auto_ndv(tmpdir):
+    result = CliRunner().invoke(
+        alpha,
+        [
+            "tests/fixtures/dk_all/320_ECW_UTM32-EUREF89.tiny.tif",
+            str(tmpdir.join("test_out.tif")),
+            "--auto",
+            "--ndv",
+            "255",
+        ],
+    )
+    assert result.exit_code == 2
+    assert "drop --ndv" in result.output
+
+
+def test_cli_alpha_auto_dry_run(tmpdir):
+    output = str(tmpdir.join("test_out.tif"))
+    result = CliRunner().invoke(
+        alpha,
+        ["tests/fixtures/dk_all/320_ECW_UTM32-EUREF89.tiny.tif", output]
+        + ["--auto", "--dry-run"],
+    )
+    assert result.exit_code == 2
+    assert "--dry-run is not supported with --auto" in result.output
+    assert not os.path.exists(output)
+
+
+def test_cli_alpha_auto_tolerance_without_nodata(tmpdir):
+    output = str(tmpdir.join("test_out.tif"))
+    result = CliRunner().invoke(
+        alpha,
+        ["tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif", output]
+        + ["--auto", "--tolerance", "2"],
+    )
+    assert result.exit_code == 1
+    assert "tolerance requires a nodata value" in result.output
+    assert not os.path.exists(output)
+
+
+def test_cli_findnodata_cache(tmpdir, caplog):
+    caplog.set_level(logging.INFO, logger="rio_alpha.findnodata")
+    cache_dir = str(tmpdir.join("store"))
+    args = [
+        "tests/fixtures/fi_all/W4441A.tiny.tif",
+        "--discovery",
+        "-v",
+        "--cache-dir",
+        cache_dir,
+    ]
+    runner = CliRunner()
+    first = runner.invoke(findnodata, args)
+    assert first.exit_code == 0
+    assert "Discovery cache miss" in caplog.text
+    assert "Discovery cache miss" in first.stderr
+    assert os.listdir(cache_dir)
+    caplog.clear()
+
+    second = runner.invoke(findnodata, args)
+    assert second.exit_code == 0
+    assert "Discovery cache hit" in caplog.text
+    assert "Discovery cache hit" in second.stderr
+    assert second.stdout == first.stdout
+    caplog.clear()
+
+    third = runner.invoke(findnodata, args + ["--no-cache"])
+    assert "Discovery cache" not in caplog.text
+    assert "Discovery cache" not in third.stderr
+    assert third.stdout == first.stdout
+
+    quiet = runner.invoke(findnodata, args[:2] + args[3:])
+    assert "Discovery cache hit" in caplog.text
+    assert quiet.stderr == ""
+    assert quiet.stdout == first.stdout
+
+
+def test_cli_findnodata_cache_unwritable(tmpdir, monkeypatch):
+    tmpdir.join("file").write("")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir.join("file", "cache")))
+    result = CliRunner().invoke(
+        findnodata, ["tests/fixtures/fi_all/W4441A.tiny.tif", "--discovery"]
+    )
+    assert result.exit_code == 0
+    assert result.output.splitlines()[-1] == "[255, 255, 255]"
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from rio_alpha.filters import (
+    apply_filters,
+    filter_halo,
+    mask_close,
+    mask_open,
+    sieve,
+)
+
+
+def test_mask_open():
+    valid = np.zeros((9, 9), dtype=bool)
+    valid[1, 1] = True
+    valid[4:8, 4:8] = True
+    opened = mask_open(valid, 1)
+    assert not opened[1, 1]
+    assert opened[4:8, 4:8].all()
+
+
+def test_mask_close():
+    valid = np.ones((9, 9), dtype=bool)
+    valid[4, 4] = False
+    valid[0:2, 0:9] = False
+    closed = mask_close(valid, 1)
+    assert closed[4, 4]
+    assert not closed[0:2].any()
+
+
+def test_sieve():
+    valid = np.ones((12, 12), dtype=bool)
+    # a small hole holding a smaller speck, a large hole and an edge hole
+    valid[2:5, 2:5] = False
+    valid[3, 3] = True
+    valid[6:10, 6:10] = False
+    valid[0, 9] = False
+    sieved = sieve(valid, 10)
+    assert sieved[2:5, 2:5].all()
+    assert not sieved[6:10, 6:10].any()
+    assert not sieved[0, 9]
+
+    valid = ~valid
+    sieved = sieve(valid, 10)
+    assert not sieved[2:5, 2:5].any()
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        [("open", 1)],
+        [("close", 2)],
+        [("sieve", 5)],
+        [("close", 1), ("sieve", 4), ("open", 1)],
+    ],
+)
+def test_filters_windowed(filters):
+    """Filtering windows with their halo gives the whole mask's result"""
+    rng = np.random.RandomState(0)
+    valid = rng.rand(45, 61) > 0.4
+    halo = filter_halo(filters)
+
+    expected = apply_filters(np.pad(valid, halo, mode="edge"), filters)[
+        halo:-halo, halo:-halo
+    ]
+
+    result = np.empty_like(valid)
+    height, width = valid.shape
+    for row in range(0, height, 8):
+        for col in range(0, width, 13):
+            bottom, right = min(row + 8, height), min(col + 13, width)
+            top, left = max(row - halo, 0), max(col - halo, 0)
+            low, far = min(bottom + halo, height), min(right + halo, width)
+            pad = (
+                (halo - (row - top), halo - (low - bottom)),
+                (halo - (col - left), halo - (far - right)),
+            )
+            padded = np.pad(valid[top:low, left:far], pad, mode="edge")
+            result[row:bottom, col:right] = apply_filters(padded, filters)[
+                halo : halo + bottom - row, halo : halo + right - col
+            ]
+
+    assert np.array_equal(result, expected)
+
+
+def test_filter_halo():
+    assert filter_halo([]) == 0
+    assert filter_halo([("open", 1), ("close", 2), ("sieve", 5)]) == 16
@@ -1,10 +1,18 @@
+import os
+import shutil
+
 import rasterio as rio
 import hypothesis.strategies as st
 from hypothesis import given
 from hypothesis.extra.numpy import arrays
 import numpy as np
 import pytest
-from rio_alpha.findnodata import discover_ndv, determine_nodata
+from rio_alpha.findnodata import (
+    discover_ndv,
+    determine_nodata,
+    find_rasters,
+    scan_nodata,
+)
 
 from rio_alpha.utils import _convert_rgb, _compute_continuous
 
@@ -44,6 +52,112 @@ def test_determine_nodata_return_alpha(test_fixture_4_band):
     assert output == "alpha"
 
 
+def test_determine_nodata_max_memory(caplog):
+    src_path = "tests/fixtures/fi_all/W4441A.tiny.tif"
+    output = determine_nodata(src_path, None, True, False, False, max_memory=2**24)
+    assert output == "[255, 255, 255]"
+    assert not caplog.records
+
+    output = determine_nodata(src_path, None, True, False, False, max_memory=10**6)
+    assert output == "[255, 255, 255]"
+    assert "at 1/5 resolution instead of 1/3" in caplog.text
+
+
+@pytest.fixture
+def archive(tmpdir):
+    """A directory of rasters and other files, in nested directories"""
+    nested = tmpdir.mkdir("b").mkdir("c")
+    shutil.copy("tests/fixtures/fi_all/W4441A.tiny.tif", str(tmpdir.join("a.tif")))
+    shutil.copy(
+        "tests/fixtures/ca_chilliwack/13-1326-2805-test-2015-2012_30cm_592_5450.tif",
+        str(nested.join("rgba.TIF")),
+    )
+    shutil.copy(
+        "tests/fixtures/dg_everest/everest_0430_R1C1.tiny.tif",
+        str(tmpdir.join("b", "everest.tif")),
+    )
+    tmpdir.join("b", "broken.tif").write("not a raster")
+    tmpdir.join("b", "everest.tif.msk").write("")
+    tmpdir.join("notes.txt").write("")
+    return str(tmpdir)
+
+
+def test_find_rasters(archive):
+    assert list(find_rasters(archive)) == [
+        os.path.join(archive, "a.tif"),
+        os.path.join(archive, "b", "broken.tif"),
+        os.path.join(archive, "b", "everest.tif"),
+        os.path.join(archive, "b", "c", "rgba.TIF"),
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_scan_nodata(archive, workers):
+    records = list(scan_nodata(find_rasters(archive), workers, discovery=True))
+    records = {os.path.relpath(r.pop("src_path"), archive): r for r in records}
+    for record in records.values():
+        assert record.pop("seconds") >= 0
+    confidence = {path: r.pop("confidence") for path, r in records.items()}
+
+    assert records == {
+        "a.tif": {
+            "ndv": "[255, 255, 255]",
+            "method": "discovered",
+            "status": "ok",
+            "error": None,
+        },
+        os.path.join("b", "broken.tif"): {
+            "ndv": None,
+            "method": None,
+            "status": "error",
+            "error": records[os.path.join("b", "broken.tif")]["error"],
+        },
+        os.path.join("b", "everest.tif"): {
+            "ndv": "0",
+            "method": "internal",
+            "status": "ok",
+            "error": None,
+        },
+        os.path.join("b", "c", "rgba.TIF"): {
+            "ndv": "alpha",
+            "method": "alpha",
+            "status": "ok",
+            "error": None,
+        },
+    }
+    assert "RasterioIOError" in records[os.path.join("b", "broken.tif")]["error"]
+    assert confidence.pop("a.tif") > 0.99
+    assert set(confidence.values()) == {None}
+
+
+def test_scan_nodata_user_nodata(archive):
+    records = list(scan_nodata([os.path.join(archive, "a.tif")], user_nodata="0"))
+    assert records[0]["ndv"] == "0"
+    assert records[0]["method"] == "user"
+
+
+def test_scan_nodata_invalid_workers():
+    with pytest.raises(ValueError):
+        list(scan_nodata([], 0))
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"max_memory": 512 * 1024},
+        {"sampler": "random"},
+        {"workers": 2, "max_memory": 1},
+    ],
+)
+def test_scan_nodata_invalid_options(kwargs):
+    def paths():
+        raise AssertionError("a file was scanned")
+        yield
+
+    with pytest.raises(ValueError):
+        list(scan_nodata(paths(), **kwargs))
+
+
 def test_determine_nodata_return_none(test_fixtures):
     src_path1, src_path2 = test_fixtures
     output1 = determine_nodata(src_path1, None, False, False, False)
@@ -62,18 +176,62 @@ def test_discover_ndv_list_three(arr_str2):
     assert candidates == [1, 1, 1]
 
 
+def test_discover_ndv_reads_edges_if_searched():
+    reads = []
+
+    def read_edges():
+        reads.append(True)
+        return np.ones((32, 3), dtype="uint8")
+
+    img = np.ones((8, 8, 3), dtype="uint8")
+    assert discover_ndv(img, False, False, read_edges) == [1, 1, 1]
+    assert not reads
+
+    # Alternating 2s are the modal color, 1s the continuous one
+    img[:6] = 3
+    img[:6, ::2] = 2
+    img[7, ::2] = 2
+    discover_ndv(img, False, False, read_edges)
+    assert reads == [True]
+
+
+def test_discover_ndv_confidence():
+    img = np.ones((64, 64, 3), dtype="uint8")
+    assert discover_ndv(img, False, False, confidence=True) == ([1, 1, 1], 1.0)
+
+    img[:, 40:] = 2
+    img[:, 60:] = 3
+    candidates, confidence = discover_ndv(img, False, False, confidence=True)
+    assert candidates == [1, 1, 1]
+    assert confidence > 0.99
+
+
+def test_determine_nodata_blocks():
+    src_path = "tests/fixtures/fi_all/W4441A.tiny.tif"
+    ndv = determine_nodata(src_path, None, True, False, False, sampler="blocks")
+    assert ndv == "[255, 255, 255]"
+
+
+def test_determine_nodata_invalid_sampler():
+    src_path = "tests/fixtures/fi_all/W4441A.tiny.tif"
+    with pytest.raises(ValueError):
+        determine_nodata(src_path, None, True, False, False, sampler="random")
+    with pytest.raises(ValueError):
+        determine_nodata(src_path, None, True, True, False, sampler="blocks")
+
+
 @given(arr_str2)
 def test_discover_ndv_list_less_three(arr_str2):
     cons_arr = np.array(
         [
-            [1, 1, 1],
-            [1, 1, 1],
-            [1, 2, 1],
-            [1, 2, 1],
             [1, 2, 1],
             [1, 2, 1],
             [1, 1, 1],
-            [1, 2, 1],
+            [2, 1, 1],
+            [1, 1, 1],
+            [2, 1, 1],
+            [1, 1, 1],
+            [2, 1, 1],
         ]
     )
 
@@ -101,14 +259,14 @@ def test_discover_ndv_list_less_three(arr_str2):
 def test_discover_ndv_list_less_three2(arr_str2):
     cons_arr = np.array(
         [
-            [1, 1, 1],
-            [1, 1, 1],
-            [1, 2, 1],
-            [1, 2, 1],
             [1, 2, 1],
             [1, 2, 1],
             [1, 1, 1],
-            [1, 2, 1],
+            [2, 1, 1],
+            [1, 1, 1],
+            [2, 1, 1],
+            [1, 1, 1],
+            [2, 1, 1],
         ]
     )
 
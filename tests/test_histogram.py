@@ -0,0 +1,72 @@
+import hypothesis.strategies as st
+from hypothesis import given
+from hypothesis.extra.numpy import arrays
+import numpy as np
+import pytest
+
+from rio_alpha.histogram import pack_pixels, color_histogram, top_colors, count_colors
+
+
+@given(arrays(np.uint8, (50, 3), elements=st.integers(min_value=0, max_value=3)))
+def test_pack_pixels_uint8_rgb(pixels):
+    keys = pack_pixels(pixels)
+    expected = (
+        pixels[:, 0].astype(np.uint64) << 16
+        | pixels[:, 1].astype(np.uint64) << 8
+        | pixels[:, 2].astype(np.uint64)
+    )
+    assert keys.dtype == np.uint64
+    assert np.array_equal(keys, expected)
+
+
+def test_pack_pixels_wide_pixels():
+    pixels = np.array([[1, 2, 3, 4, 5], [1, 2, 3, 4, 5], [5, 4, 3, 2, 1]], np.uint16)
+    keys = pack_pixels(pixels)
+    assert keys.shape == (3,)
+    assert keys[0] == keys[1]
+    assert keys[0] != keys[2]
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int64, np.float32])
+@pytest.mark.parametrize("depth", [1, 3, 4])
+def test_color_histogram_matches_unique(dtype, depth):
+    pixels = np.random.RandomState(0).randint(0, 6, (2000, depth)).astype(dtype)
+    colors, counts = color_histogram(pixels)
+    expected_colors, expected_counts = np.unique(pixels, axis=0, return_counts=True)
+
+    order = np.lexsort(colors.T[::-1])
+    assert colors.dtype == pixels.dtype
+    assert np.array_equal(colors[order], expected_colors)
+    assert np.array_equal(counts[order], expected_counts)
+
+
+def test_color_histogram_empty():
+    colors, counts = color_histogram(np.empty((0, 3), np.uint8))
+    assert colors.shape == (0, 3)
+    assert counts.shape == (0,)
+
+
+def test_top_colors_modal_triple():
+    # The per-band mode of these pixels is [1, 1, 1], which never occurs
+    pixels = np.array(
+        [[1, 2, 2], [2, 1, 2], [2, 2, 1], [1, 1, 9], [1, 9, 1], [9, 1, 1], [7, 7, 7]]
+        + [[4, 5, 6]] * 2,
+        np.uint8,
+    )
+    colors, counts = top_colors(pixels, k=2)
+    assert colors.tolist() == [[4, 5, 6], [1, 1, 9]]
+    assert counts.tolist() == [2, 1]
+
+
+def test_top_colors_tie_breaks_low():
+    pixels = np.array([[3, 0, 0], [0, 0, 7], [3, 0, 0], [0, 0, 7]], np.uint16)
+    colors, counts = top_colors(pixels)
+    assert colors.tolist() == [[0, 0, 7]]
+    assert counts.tolist() == [2]
+
+
+@given(arrays(np.uint8, (64, 3), elements=st.integers(min_value=0, max_value=2)))
+def test_count_colors(pixels):
+    candidates = [[0, 0, 0], [2, 1, 0], [255, 255, 255]]
+    expected = [int((pixels == c).all(axis=1).sum()) for c in candidates]
+    assert count_colors(pixels, candidates) == expected
@@ -1,9 +1,17 @@
 import rasterio
 import hypothesis.strategies as st
-from hypothesis import given
+from hypothesis import given, settings
 from hypothesis.extra.numpy import arrays
 import numpy as np
-from rio_alpha.islossy import count_ndv_regions
+import pytest
+from rasterio.windows import Window
+from rio_alpha.islossy import (
+    RegionCounter,
+    count_ndv_regions,
+    count_ndv_regions_windowed,
+    plan_region_windows,
+    region_windows,
+)
 
 
 def test_count_ndv_regions_should_return_0():
@@ -41,8 +49,93 @@ def test_count_ndv_regions(ndv, img):
     assert isinstance(n_labels, int)
 
 
+def test_count_ndv_regions_windowed_matches_full_read():
+    with rasterio.open(
+        "tests/fixtures/ca_chilliwack/" "2012_30cm_594_5450.tiny.tif"
+    ) as src:
+        ndv = (255, 255, 255)
+        for rows, cols in [(4, 666), (8, 50), (256, 1024)]:
+            windows = region_windows(src, rows, cols)
+            assert count_ndv_regions_windowed(src, ndv, windows=windows) == 14666
+
+
+def test_count_ndv_regions_windowed_early_exit():
+    with rasterio.open(
+        "tests/fixtures/ca_chilliwack/" "2012_30cm_594_5450.tiny.tif"
+    ) as src:
+        windows = region_windows(src, 4, 666)
+        read = []
+
+        def tracking_windows():
+            for window in windows:
+                read.append(window)
+                yield window
+
+        regions = count_ndv_regions_windowed(
+            src, (255, 255, 255), threshold=10, windows=tracking_windows()
+        )
+        assert 10 <= regions < 14666
+        assert len(read) < len(windows)
+
+
+@settings(deadline=None)
+@given(
+    arrays(np.bool_, (17, 23)),
+    st.integers(min_value=1, max_value=17),
+    st.integers(min_value=1, max_value=23),
+)
+def test_region_counter_windows(nodata, rows, cols):
+    img = np.where(nodata, 0, 1).astype(np.uint8)[np.newaxis].repeat(3, axis=0)
+    expected = count_ndv_regions(img, (0, 0, 0))
+
+    counter = RegionCounter(*nodata.shape)
+    for row in range(0, nodata.shape[0], rows):
+        for col in range(0, nodata.shape[1], cols):
+            window = Window(col, row, cols, rows)
+            counter.update(nodata[row : row + rows, col : col + cols], window)
+            assert counter.closed <= counter.count
+    assert counter.count == counter.closed == expected
+
+
 arr_str = arrays(
     np.uint8,
     (8, 8, 3),
     elements=st.integers(min_value=1, max_value=np.iinfo("uint8").max),
 )
+
+
+@pytest.mark.parametrize("max_memory", [None, 2**20, 200000, 60000])
+def test_plan_region_windows(max_memory):
+    with rasterio.open(
+        "tests/fixtures/ca_chilliwack/" "2012_30cm_594_5450.tiny.tif"
+    ) as src:
+        windows, factor = plan_region_windows(src, max_memory)
+        assert factor == 1
+        assert sum(w.width * w.height for w in windows) == src.width * src.height
+        if max_memory:
+            largest = max(w.width * w.height for w in windows)
+            assert largest * 19 + 16 * (src.width + src.height) <= max_memory
+        regions = count_ndv_regions_windowed(src, (255, 255, 255), windows=windows)
+        assert regions == 14666
+
+
+def test_plan_region_windows_decimated(caplog):
+    with rasterio.open(
+        "tests/fixtures/ca_chilliwack/" "2012_30cm_594_5450.tiny.tif"
+    ) as src:
+        windows, factor = plan_region_windows(src, 20000)
+        assert factor == 2
+        assert "counted at 1/2 resolution" in caplog.text
+        assert sum(w.width * w.height for w in windows) == 333 * 333
+        regions = count_ndv_regions_windowed(
+            src, (255, 255, 255), windows=windows, factor=factor
+        )
+        assert 10 <= regions < 14666
+
+
+def test_plan_region_windows_too_small():
+    with rasterio.open(
+        "tests/fixtures/ca_chilliwack/" "2012_30cm_594_5450.tiny.tif"
+    ) as src:
+        with pytest.raises(ValueError):
+            plan_region_windows(src, 40)
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+import rasterio
+
+from rio_alpha.findnodata import _block_evidence
+from rio_alpha.sampling import (
+    BlockSampler,
+    block_windows,
+    separation,
+    tile_separation,
+)
+
+
+@pytest.fixture
+def collar_tif(tmpdir):
+    """A 2048 x 2048 noisy RGB GeoTIFF of 256 x 256 tiles, with a 0 collar"""
+    path = str(tmpdir.join("collar.tif"))
+    rng = np.random.RandomState(0)
+    data = rng.randint(1, 255, (3, 2048, 2048)).astype("uint8")
+    data[:, 1024:1100] = 128
+    data[:, :300] = 0
+    data[:, :, :300] = 0
+    data[:, -200:] = 0
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=2048,
+        height=2048,
+        count=3,
+        dtype="uint8",
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+    ) as dst:
+        dst.write(data)
+    return path
+
+
+def test_separation():
+    assert separation([0.5, 0.6, 0.4], [0.1, 0.0, 0.2]) > 0.99
+    assert separation([0.1, 0.0, 0.2], [0.5, 0.6, 0.4]) < 0.01
+    assert separation([0.5, 0.0, 0.5, 0.0], [0.0, 0.5, 0.0, 0.5]) == 0.5
+    assert separation([0.5], [0.1]) == 0.5
+    assert separation([0.5, 0.5], [0.1, 0.1]) == 1.0
+
+
+def test_tile_separation():
+    img = np.ones((64, 64, 3), dtype="uint8")
+    assert tile_separation(img, img[0, :1]) == 1.0
+
+    # 2s cover the top half, 1s the bottom half
+    img[:32] = 2
+    colors = np.array([[2, 2, 2], [1, 1, 1]], dtype="uint8")
+    assert tile_separation(img, colors) == 0.5
+    img[32:40] = 2
+    assert tile_separation(img, colors) > 0.75
+
+
+def test_block_windows(collar_tif):
+    with rasterio.open(collar_tif) as src:
+        windows = block_windows(src)
+        assert block_windows(src) == windows
+        assert block_windows(src, seed=1) != windows
+
+    blocks = [(w.row_off // 256, w.col_off // 256) for w in windows]
+    assert sorted(blocks) == [(row, col) for row in range(8) for col in range(8)]
+    # The first round takes one block of each 2 x 2 cell of blocks
+    assert len({(row // 2, col // 2) for row, col in blocks[:16]}) == 16
+    border = [row in (0, 7) or col in (0, 7) for row, col in blocks]
+    assert sum(border[:16]) > 12 * 16 / 64.0
+
+
+def test_block_windows_partial_blocks(tmpdir):
+    path = str(tmpdir.join("partial.tif"))
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=300,
+        height=20,
+        count=3,
+        dtype="uint8",
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+    ) as dst:
+        dst.write(np.zeros((3, 20, 300), dtype="uint8"))
+    with rasterio.open(path) as src:
+        windows = block_windows(src)
+    assert sorted((w.col_off, w.width, w.height) for w in windows) == [
+        (0, 256, 20),
+        (256, 44, 20),
+    ]
+
+
+def test_block_sampler():
+    sampler = BlockSampler(3, "uint8")
+    block = np.ones((16, 16, 3), dtype="uint8")
+    block[:, 8:] = 2
+    block[:4, 8:] = 3
+    sampler.add(block)
+    assert sampler.confidence == 0.5
+    # The 1s lead the first block and the 2s the second one
+    sampler.add(np.where(block == 3, 3, 3 - block))
+    assert sampler.pixels == 512
+    assert sampler.leaders().tolist() == [[1, 1, 1], [2, 2, 2]]
+    assert sampler.histogram.count([3, 3, 3]) == 64
+    assert sampler.histogram.count([4, 4, 4]) == 0
+    assert sampler.continuous().tolist() == [1, 1, 1]
+    assert sampler.confidence == 0.5
+
+
+def test_block_evidence_stops_early(collar_tif):
+    with rasterio.open(collar_tif) as src:
+        evidence = _block_evidence(src)
+    assert evidence["original"] == [0, 0, 0]
+    assert evidence["continuous"] == [0, 0, 0]
+    assert evidence["confidence"] >= 0.99
+    assert evidence["blocks"] <= 8
+
+
+def test_block_evidence_limits(collar_tif):
+    with rasterio.open(collar_tif) as src:
+        assert _block_evidence(src, target=1.1, max_blocks=10)["blocks"] == 10
+        assert _block_evidence(src, target=1.1, max_pixels=2**18)["blocks"] == 4
@@ -0,0 +1,51 @@
+import logging
+
+from rasterio.windows import Window
+
+from rio_alpha.stats import BUCKETS, StageStats, _timed
+
+
+def test_timed():
+    assert _timed(None, "read", 10, sum, [1, 2]) == 3
+
+    timings = []
+    assert _timed(timings, "read", 10, sum, [1, 2]) == 3
+    ((stage, seconds, nbytes, worker),) = timings
+    assert (stage, nbytes) == ("read", 10)
+    assert seconds >= 0
+    assert worker.endswith("/MainThread")
+
+
+def test_stage_stats():
+    stats = StageStats()
+    stats.record("read", 0.00005, 100, "a")
+    stats.record("read", 0.3, 200, "b")
+    stats.record_all([("mask", 0.001, 100, "a"), ("read", 0.1, 50, "a")])
+
+    stages = stats.to_dict()["stages"]
+    assert list(stages) == ["read", "mask"]
+    read = stages["read"]
+    assert read["count"] == 3
+    assert read["bytes"] == 350
+    assert read["min"] == 0.00005
+    assert read["max"] == 0.3
+    assert read["histogram"]["bounds"] == BUCKETS
+    assert sum(read["histogram"]["counts"]) == 3
+    assert read["histogram"]["counts"][0] == 1
+    assert read["workers"] == {
+        "a": {"count": 2, "seconds": 0.10005},
+        "b": {"count": 1, "seconds": 0.3},
+    }
+    assert stages["mask"]["count"] == 1
+
+
+def test_stage_stats_logs(caplog):
+    caplog.set_level(logging.DEBUG, logger="rio_alpha.stats")
+    StageStats().record("write", 0.5, 1000, "a", Window(10, 20, 30, 40))
+
+    (record,) = caplog.records
+    assert record.stage == "write"
+    assert record.seconds == 0.5
+    assert record.bytes == 1000
+    assert record.worker == "a"
+    assert record.window == [10, 20, 30, 40]
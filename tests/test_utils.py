@@ -10,13 +10,22 @@ from scipy.stats import mode
 from rio_alpha.utils import (
     _parse_single,
     _parse_ndv,
+    _parse_filter,
+    _parse_memory,
+    _parse_manifest,
+    _split_memory,
     _convert_rgb,
     _find_continuous_rgb,
+    _find_runs,
     _group,
     _compute_continuous,
     _search_image_edge,
     _evaluate_count,
+    _sample_factor,
+    _read_edges,
+    _read_sample,
 )
+from rio_alpha.histogram import count_colors
 
 
 @given(st.integers(min_value=1, max_value=np.iinfo("uint16").max))
@@ -46,6 +55,65 @@ def test_parse_ndv(ndv):
     assert isinstance(ndvals[0], float)
 
 
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("1024", 1024),
+        ("64K", 65536),
+        ("512M", 512 * 2**20),
+        ("2g", 2**31),
+        ("3 GiB", 3 * 2**30),
+    ],
+)
+def test_parse_memory(value, expected):
+    assert _parse_memory(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "M", "1.5G", "2T", "-1"])
+def test_parse_memory_fail(value):
+    with pytest.raises(ValueError) as excinfo:
+        _parse_memory(value)
+    assert "not a memory size" in str(excinfo.value)
+
+
+def test_split_memory():
+    assert _split_memory(2**20) == (3 * 2**18, 2**18)
+    with pytest.raises(ValueError) as excinfo:
+        _split_memory(2**20 - 1)
+    assert "at least 1M" in str(excinfo.value)
+
+
+def test_parse_filter():
+    assert _parse_filter("sieve:16") == ("sieve", 16)
+    assert _parse_filter(" Open : 2 ") == ("open", 2)
+
+
+@pytest.mark.parametrize("value", ["", "open", "open:", "open:1.5", ":2"])
+def test_parse_filter_fail(value):
+    with pytest.raises(ValueError) as excinfo:
+        _parse_filter(value)
+    assert "is not a filter" in str(excinfo.value)
+
+
+def test_parse_manifest():
+    lines = [
+        "# source destination\n",
+        "a.tif b.tif\n",
+        "\n",
+        "  c d.tif\twith space.tif \n",
+    ]
+    assert _parse_manifest(lines) == [
+        ("a.tif", "b.tif"),
+        ("c d.tif", "with space.tif"),
+    ]
+
+
+def test_parse_manifest_fail():
+    with pytest.raises(ValueError) as excinfo:
+        _parse_manifest(["a.tif b.tif", "a.tif"])
+    assert "Line 2" in str(excinfo.value)
+
+
 @given(st.lists(st.integers(min_value=1, max_value=np.iinfo("uint16").max), min_size=4))
 def test_parse_ndv_fail_bands(ndv):
     with pytest.raises(ValueError) as excinfo:
@@ -87,9 +155,26 @@ def test_convert_rgb_dim_zero(rgb_orig):
 @given(arr_str, st.integers(min_value=0, max_value=1))
 def test_find_continuous_rgb(arr_str, num_axis):
     diff_array = np.diff(arr_str, axis=num_axis)
-    diff_array = np.insert(diff_array, 0, [99, 99, 99], axis=num_axis)
-    val_list = (arr_str[diff_array == [0, 0, 0]]).tolist()
-    assert sorted(_find_continuous_rgb(arr_str, num_axis)) == sorted(val_list)
+    same = np.all(diff_array == 0, axis=-1)
+    same = np.insert(same, 0, False, axis=num_axis)
+    assert np.array_equal(_find_continuous_rgb(arr_str, num_axis), arr_str[same])
+
+
+def test_find_runs():
+    line = [[1, 1, 1], [1, 1, 1], [1, 1, 1], [2, 2, 2], [2, 2, 2], [3, 3, 3]]
+    other = [[2, 2, 2], [2, 2, 2], [2, 2, 2], [2, 2, 2], [3, 3, 3], [2, 2, 2]]
+    rgb = np.array([line, other, line], dtype=np.uint8)
+
+    colors, counts, longest = _find_runs(rgb, 1)
+    assert colors.tolist() == [[1, 1, 1], [2, 2, 2]]
+    assert counts.tolist() == [4, 5]
+    assert longest.tolist() == [3, 4]
+
+    colors, counts, longest = _find_runs(rgb, 0)
+    assert colors.tolist() == [[2, 2, 2]]
+    assert counts.tolist() == [2]
+    assert longest.tolist() == [3]
+    assert np.array_equal(_find_runs(np.rollaxis(rgb, 1), 1)[0], colors)
 
 
 @given(st.integers(min_value=4, max_value=30))
@@ -111,14 +196,15 @@ def test_group_error(lst, loc):
 
 @given(arr_str, st.integers(min_value=0, max_value=1))
 def test_compute_continuous(rgb_mod, loc):
-    if len(_find_continuous_rgb(rgb_mod, loc)) < 3:
+    continuous_pixels = _find_continuous_rgb(rgb_mod, loc)
+    if len(continuous_pixels) == 0:
         with pytest.raises(IndexError):
             _compute_continuous(rgb_mod, loc)[0]
     else:
-        assert (
-            _compute_continuous(rgb_mod, loc)[0]
-            == _group(_find_continuous_rgb(rgb_mod, loc), 3, [])[0]
-        )
+        candidate, arr = _compute_continuous(rgb_mod, loc)
+        counts = [np.all(continuous_pixels == p, axis=1).sum() for p in arr]
+        assert np.array_equal(arr, continuous_pixels)
+        assert np.all(continuous_pixels == candidate, axis=1).sum() == max(counts)
 
 
 @pytest.fixture
@@ -215,7 +301,63 @@ def test_search_image_edge_ca2(test_fixtures):
 
     assert img_edge.shape[0] == rgb_mod.shape[0] * 4
     assert full == [242, 0]
-    assert cont == [7048, 0]
+    assert cont == [6013, 0]
+
+
+def _edges(img):
+    return np.concatenate((img[0], img[:, -1], img[-1], img[:, 0]), axis=0)
+
+
+def test_read_edges_tiled():
+    src_path = "tests/fixtures/dg_flame/dg_flame_021223331233.tiny.tif"
+    with rio.open(src_path) as src:
+        edges = _read_edges(src, 10)
+        full = np.rollaxis(src.read(), 0, 3)
+    assert np.array_equal(edges, _edges(full))
+
+
+def test_read_edges_striped():
+    src_path = "tests/fixtures/fi_all/W4441A.tiny.tif"
+    with rio.open(src_path) as src:
+        edges = _read_edges(src, 3)
+        full = np.rollaxis(src.read(), 0, 3)
+    # Rows are read whole, columns on the rows of the sample
+    assert len(edges) == 2 * 600 + 2 * 200
+    assert np.array_equal(edges[:600], full[0])
+    assert np.array_equal(edges[600:800], full[1::3, -1])
+    assert np.array_equal(edges[800:1400], full[-1])
+    assert np.array_equal(edges[1400:], full[1::3, 0])
+
+
+def test_read_edges_thin_collar(tmpdir):
+    """A collar thinner than the sample's stride is only on full
+    resolution edges"""
+    src_path = str(tmpdir.join("collar.tif"))
+    data = np.random.RandomState(0).randint(1, 255, (3, 1000, 1000)).astype("uint8")
+    data[:, 400:600] = 128
+    data[:, :2] = data[:, -2:] = data[:, :, :2] = data[:, :, -2:] = 0
+    with rio.open(
+        src_path,
+        "w",
+        driver="GTiff",
+        width=1000,
+        height=1000,
+        count=3,
+        dtype="uint8",
+        tiled=True,
+    ) as dst:
+        dst.write(data)
+
+    with rio.open(src_path) as src:
+        sample = _read_sample(src)
+        edges = _read_edges(src, _sample_factor(src.height, src.width))
+
+    candidates = [[0, 0, 0], [1, 1, 1]]
+    assert count_colors(_edges(sample), candidates)[0] == 0
+    assert count_colors(edges, candidates)[0] == 4000
+    assert _search_image_edge(sample, *candidates, edges=edges)[0] == count_colors(
+        edges, candidates
+    )
 
 
 def test_evaluate_count_original():
@@ -246,3 +388,30 @@ def test_convert_rgba(test_fixtures):
     a, _ = test_fixtures
     amod = _convert_rgb(a)[0]
     assert amod.shape == (167, 167, 3)
+
+
+@given(
+    st.integers(min_value=1, max_value=5000), st.integers(min_value=1, max_value=5000)
+)
+def test_sample_factor(rows, cols):
+    mod = _sample_factor(rows, cols)
+    assert mod >= 1
+    assert min(rows, cols) < 200 or -(-min(rows, cols) // mod) <= 200
+
+
+def test_read_sample_matches_convert_rgb_shape():
+    src_path = "tests/fixtures/ca_chilliwack/2012_30cm_592_5452.tiny.tif"
+    with rio.open(src_path) as src:
+        sample = _read_sample(src)
+        full = np.rollaxis(src.read(), 0, 3)
+
+    assert sample.shape == _convert_rgb(full)[0].shape
+    assert sample.dtype == full.dtype
+    # The sample is already at discovery size and is not decimated again
+    assert _convert_rgb(sample)[0].shape == sample.shape
+
+
+def test_read_sample_small_image():
+    src_path = "tests/fixtures/dk_all/320_ECW_UTM32-EUREF89.tiny.tif"
+    with rio.open(src_path) as src:
+        assert np.array_equal(_read_sample(src), np.rollaxis(src.read(), 0, 3))